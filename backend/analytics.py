@@ -0,0 +1,209 @@
+"""Revenue analytics over incrementally maintained rollups.
+
+Triggers on subscriptions and payments (migration 7) keep three summary
+tables current inside the same transaction as every write, whichever code
+path makes it:
+
+- analytics_subscription_counts: subscriptions per plan and status right now
+- analytics_daily_subscriptions: subscriptions created, or entering a status,
+  per UTC day and plan
+- analytics_daily_payments: payment count and amount per UTC day, plan,
+  outcome and failure reason
+
+Reports read only these tables, so their cost depends on the number of plans
+and days asked for, not on how much history has accumulated. With sharded
+storage every shard keeps its own rollups. The report functions take one
+connection per shard and add them up.
+"""
+from datetime import datetime, timedelta, timezone
+
+import archive
+import queries
+
+# Subscriptions that count as current customers and those that bring in revenue
+SUBSCRIBED_STATUSES = ('active', 'expiring_soon', 'trialing')
+PAYING_STATUSES = ('active', 'expiring_soon')
+CHURN_EVENTS = ('cancelled', 'expired')
+MONTHS_PER_CYCLE = {'monthly': 1, 'yearly': 12}
+
+
+def _window_start(days):
+    # Days are UTC, matching the CURRENT_TIMESTAMP defaults the rollups key on
+    return (datetime.now(timezone.utc).date() - timedelta(days=days - 1)).isoformat()
+
+
+def _rate(part, whole):
+    return round(part / whole, 4) if whole else None
+
+
+def _rows(conns, sql, params=()):
+    rows = []
+    for conn in conns:
+        rows.extend(conn.execute(sql, params).fetchall())
+    return rows
+
+
+def subscription_summary(conns):
+    """Active subscribers and MRR, overall and per plan"""
+    rows = _rows(conns, '''
+        SELECT c.plan_id, p.name, p.price, p.billing_cycle, c.status, c.subscriptions
+        FROM analytics_subscription_counts c
+        JOIN plans p ON p.id = c.plan_id
+        WHERE c.subscriptions != 0
+    ''')
+
+    plans = {}
+    for row in sorted(rows, key=lambda row: row['plan_id']):
+        plan = plans.setdefault(row['plan_id'], {
+            'plan_id': row['plan_id'],
+            'name': row['name'],
+            'billing_cycle': row['billing_cycle'],
+            'active_subscribers': 0,
+            'mrr': 0.0,
+            'by_status': {}
+        })
+        plan['by_status'][row['status']] = plan['by_status'].get(row['status'], 0) + row['subscriptions']
+        if row['status'] in SUBSCRIBED_STATUSES:
+            plan['active_subscribers'] += row['subscriptions']
+        if row['status'] in PAYING_STATUSES:
+            plan['mrr'] += row['subscriptions'] * row['price'] / MONTHS_PER_CYCLE.get(row['billing_cycle'], 1)
+
+    for plan in plans.values():
+        plan['mrr'] = round(plan['mrr'], 2)
+    mrr = round(sum(plan['mrr'] for plan in plans.values()), 2)
+    return {
+        'active_subscribers': sum(plan['active_subscribers'] for plan in plans.values()),
+        'mrr': mrr,
+        'arr': round(mrr * 12, 2),
+        'plans': list(plans.values())
+    }
+
+
+def payment_stats(conns, days):
+    """Payment volume, revenue and failure rates over the last `days` UTC days"""
+    start = _window_start(days)
+    rows = _rows(conns, queries.ANALYTICS_DAILY_PAYMENTS, (start,))
+
+    daily = {}
+    reasons = {}
+    totals = {'completed': 0, 'failed': 0, 'revenue': 0.0}
+    for row in sorted(rows, key=lambda row: row['day']):
+        day = daily.setdefault(row['day'], {'day': row['day'], 'completed': 0, 'failed': 0, 'revenue': 0.0})
+        if row['status'] == 'completed':
+            day['completed'] += row['payments']
+            day['revenue'] += row['amount']
+            totals['completed'] += row['payments']
+            totals['revenue'] += row['amount']
+        else:
+            day['failed'] += row['payments']
+            totals['failed'] += row['payments']
+            reason = row['failure_reason'] or 'unknown'
+            reasons[reason] = reasons.get(reason, 0) + row['payments']
+
+    attempts = totals['completed'] + totals['failed']
+    for day in daily.values():
+        day['revenue'] = round(day['revenue'], 2)
+        day['failure_rate'] = _rate(day['failed'], day['completed'] + day['failed'])
+    return {
+        'window': {'start': start, 'days': days},
+        'payments': attempts,
+        'completed': totals['completed'],
+        'failed': totals['failed'],
+        'failure_rate': _rate(totals['failed'], attempts),
+        'revenue': round(totals['revenue'], 2),
+        'failures_by_reason': [
+            {'error_reason': reason, 'failures': count, 'share': _rate(count, totals['failed'])}
+            for reason, count in sorted(reasons.items(), key=lambda item: -item[1])
+        ],
+        'daily': list(daily.values())
+    }
+
+
+def churn_stats(conns, days):
+    """New subscriptions and churn (cancellations plus lapsed expiries) over the last `days` UTC days.
+
+    churn_rate is churned / (currently subscribed + churned): the share of
+    the customers present during the window who left.
+    """
+    start = _window_start(days)
+    rows = _rows(conns, '''
+        SELECT day, event, SUM(subscriptions) AS subscriptions
+        FROM analytics_daily_subscriptions
+        WHERE day >= ?
+        GROUP BY day, event
+    ''', (start,))
+    subscribed = sum(row[0] for row in _rows(conns, f'''
+        SELECT COALESCE(SUM(subscriptions), 0) FROM analytics_subscription_counts
+        WHERE status IN ({', '.join('?' * len(SUBSCRIBED_STATUSES))})
+    ''', SUBSCRIBED_STATUSES))
+
+    daily = {}
+    totals = {'created': 0, 'cancelled': 0, 'expired': 0}
+    for row in sorted(rows, key=lambda row: row['day']):
+        if row['event'] not in totals:
+            continue
+        day = daily.setdefault(row['day'], {'day': row['day'], 'created': 0, 'cancelled': 0, 'expired': 0})
+        day[row['event']] += row['subscriptions']
+        totals[row['event']] += row['subscriptions']
+
+    churned = sum(totals[event] for event in CHURN_EVENTS)
+    return {
+        'window': {'start': start, 'days': days},
+        'active_subscribers': subscribed,
+        'new_subscriptions': totals['created'],
+        'cancelled': totals['cancelled'],
+        'expired': totals['expired'],
+        'churned': churned,
+        'churn_rate': _rate(churned, subscribed + churned),
+        'daily': list(daily.values())
+    }
+
+
+def rebuild(conn):
+    """Recompute the rollups from the source tables, e.g. after a manual data fix.
+
+    Current counts and daily 'created' events are derived in full. Daily
+    payments are derived from archive.archived_before() on: earlier days may
+    count payments that now live in archive segments, so they are kept as
+    is. Status transitions (cancelled, expired, ...) are only recorded as
+    they happen, so their history is kept as is too.
+    """
+    archived_before = archive.archived_before()
+    payments_from = archived_before.date().isoformat() if archived_before else ''
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('DELETE FROM analytics_subscription_counts')
+        conn.execute('DELETE FROM analytics_daily_payments WHERE day >= ?', (payments_from,))
+        conn.execute("DELETE FROM analytics_daily_subscriptions WHERE event = 'created'")
+        conn.execute('''
+            INSERT INTO analytics_subscription_counts (plan_id, status, subscriptions)
+            SELECT plan_id, status, COUNT(*) FROM subscriptions GROUP BY plan_id, status
+        ''')
+        conn.execute('''
+            INSERT INTO analytics_daily_subscriptions (day, plan_id, event, subscriptions)
+            SELECT date(created_at), plan_id, 'created', COUNT(*) FROM subscriptions
+            GROUP BY date(created_at), plan_id
+        ''')
+        conn.execute('''
+            INSERT INTO analytics_daily_payments (day, plan_id, status, failure_reason, payments, amount)
+            SELECT date(p.payment_date), s.plan_id, p.status, coalesce(p.failure_reason, ''), COUNT(*), SUM(p.amount)
+            FROM payments p JOIN subscriptions s ON s.id = p.subscription_id
+            WHERE date(p.payment_date) >= ?
+            GROUP BY 1, 2, 3, 4
+        ''', (payments_from,))
+        counts = conn.execute('''
+            SELECT
+                (SELECT COUNT(*) FROM analytics_subscription_counts),
+                (SELECT COUNT(*) FROM analytics_daily_subscriptions),
+                (SELECT COUNT(*) FROM analytics_daily_payments)
+        ''').fetchone()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return {
+        'subscription_counts': counts[0],
+        'daily_subscriptions': counts[1],
+        'daily_payments': counts[2],
+        'payments_rebuilt_from': payments_from or None
+    }
@@ -1,73 +1,93 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
 from datetime import datetime, timedelta
+from functools import wraps
+from operator import itemgetter
+import click
+import hmac
+import io
+import itertools
+import math
 import sqlite3
 import os
 import json
-import random
+import base64
+import threading
 import time
+import uuid
+import analytics
+import archive
+import billing
+import db
+import export
+import importer
+import lifecycle
+import metrics
+import queries
+import read_cache
+import shards
+import simulator
+from serialization import Extra, Flag, FastJSONProvider, Nested, Raw, RowMapper, encode, json_text_response, raw_object
+from bootstrap import Bootstrap
+from db import db_connection
+from events import EventBroker, format_sse
+from idempotency import idempotent
+from migrations import migrate
+from query_plans import find_table_scans
+from payment_queue import PaymentQueue
+from plan_catalog import PlanCatalog
+from txid import new_transaction_id
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 CORS(app)
 
-DATABASE = os.path.join(os.path.dirname(__file__), 'subscription.db')
+# 'sync' processes payments inside the request, 'async' queues them on the
+# background worker pool and answers 202 with a payment attempt ID
+PAYMENT_PROCESSING_MODE = os.environ.get('PAYMENT_PROCESSING_MODE', 'sync')
+MAX_ATTEMPT_WAIT_SECONDS = 30
+PLAN_CACHE_MAX_AGE = 60
+PAYMENTS_PAGE_SIZE = 20
+MAX_PAYMENTS_PAGE_SIZE = 100
+MAX_STATUS_BATCH_SIZE = 1000
+MAX_ANALYTICS_DAYS = 366
+# Open event streams re-check the database and send a keep-alive this often,
+# and are closed after SSE_MAX_STREAM_SECONDS (EventSource reconnects itself)
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', 15))
+SSE_MAX_STREAM_SECONDS = float(os.environ.get('SSE_MAX_STREAM_SECONDS', 60))
+SSE_RETRY_MS = 3000
+# Each stream served through Flask holds a server thread while it is open, so
+# a process serves at most this many and answers 503 beyond that. Keep it well
+# below the worker's thread count (32 in gunicorn.conf.py) so other requests
+# always find a thread. The ASGI server holds streams as coroutines instead.
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', 8))
+SSE_BUSY_RETRY_SECONDS = 10
+
+# Admin endpoints require this token in the X-Admin-Token header, and are
+# disabled when it is not set
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
 
 def init_db():
     """Initialize the database with required tables"""
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
+    with db_connection() as conn:
+        init_schema(conn)
+        shards.router.initialize(conn)
+        for path in shards.router.paths()[1:]:
+            init_shard(conn, path)
+
+def init_shard(control, path):
+    """Give a shard the schema, its ID sequences and a copy of the plan catalog"""
+    with db_connection(path) as shard:
+        init_schema(shard)
+        shards.seed_sequences(shard)
+        shards.copy_plans(control, shard)
+        shard.commit()
+
+def init_schema(conn):
+    """Apply schema migrations and seed the default plans on an open connection"""
+    migrate(conn)
     
-    # Users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE NOT NULL,
-            name TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Plans table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS plans (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            price REAL NOT NULL,
-            billing_cycle TEXT NOT NULL,
-            features TEXT NOT NULL,
-            is_active BOOLEAN DEFAULT 1
-        )
-    ''')
-    
-    # Subscriptions table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS subscriptions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            plan_id INTEGER NOT NULL,
-            status TEXT NOT NULL,
-            start_date TIMESTAMP NOT NULL,
-            end_date TIMESTAMP NOT NULL,
-            next_billing_date TIMESTAMP,
-            auto_renew BOOLEAN DEFAULT 1,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            FOREIGN KEY (plan_id) REFERENCES plans (id)
-        )
-    ''')
-    
-    # Payments table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            subscription_id INTEGER NOT NULL,
-            amount REAL NOT NULL,
-            status TEXT NOT NULL,
-            payment_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            transaction_id TEXT UNIQUE,
-            FOREIGN KEY (subscription_id) REFERENCES subscriptions (id)
-        )
-    ''')
+    cursor = conn.cursor()
     
     # Insert default plans if they don't exist
     cursor.execute('SELECT COUNT(*) FROM plans')
@@ -86,27 +106,207 @@ def init_db():
         ''', default_plans)
     
     conn.commit()
-    conn.close()
+    plan_catalog.invalidate()
+
+@app.cli.command('check-query-plans')
+def check_query_plans():
+    """Fail if any endpoint query falls back to a full table scan"""
+    init_db()
+    with db_connection() as conn:
+        problems = find_table_scans(conn)
+    for name, detail in problems:
+        click.echo(f'{name}: {detail}')
+    if problems:
+        raise SystemExit(1)
+    click.echo('All endpoint queries use indexes')
+
+@app.cli.command('billing-run')
+@click.option('--window-end', type=click.DateTime(), help='Bill subscriptions due up to this time (default: now)')
+@click.option('--window-start', type=click.DateTime(), help='Skip subscriptions due before this time')
+@click.option('--resume', 'run_id', type=int, help='Resume an interrupted run from its last checkpoint')
+@click.option('--chunk-size', type=int, default=billing.BILLING_CHUNK_SIZE, show_default=True)
+@click.option('--workers', type=int, default=billing.BILLING_WORKERS, show_default=True)
+def billing_run_command(window_end, window_start, run_id, chunk_size, workers):
+    """Renew every auto-renewing subscription that is due"""
+    init_db()
+    
+    def report(processed, elapsed):
+        click.echo(f'{processed} renewed in {elapsed:.1f}s ({processed / elapsed if elapsed else 0:.0f}/s)')
+    
+    run = billing.run_billing(window_end=window_end, window_start=window_start, run_id=run_id,
+                              chunk_size=chunk_size, workers=workers, progress=report)
+    click.echo(json.dumps(run, indent=2, default=str))
+
+@app.cli.command('export')
+@click.argument('table', type=click.Choice(sorted(export.EXPORT_TABLES)))
+@click.option('--format', 'fmt', type=click.Choice(sorted(export.EXPORT_FORMATS)), default='ndjson', show_default=True)
+@click.option('--start', type=click.DateTime(), help='Only rows dated at or after this time')
+@click.option('--end', type=click.DateTime(), help='Only rows dated before this time')
+@click.option('--after-id', type=int, help='Resume after the last exported id')
+@click.option('--chunk-size', type=int, default=export.EXPORT_CHUNK_SIZE, show_default=True)
+@click.option('--include-archive', is_flag=True, help='Stream archived payments first, then the payments table')
+@click.option('-o', '--output', type=click.File('w'), default='-', help='Output file (default: stdout)')
+def export_command(table, fmt, start, end, after_id, chunk_size, include_archive, output):
+    """Stream a table as NDJSON or CSV"""
+    init_db()
+    if include_archive and table != 'payments':
+        raise click.UsageError('--include-archive only applies to payments')
+    if include_archive and after_id:
+        raise click.UsageError('An export that includes archived payments cannot be resumed with --after-id')
+    earliest = export.archived_range_start(table, start)
+    if earliest and not include_archive:
+        raise click.UsageError(f'Payments before {earliest.date()} are archived; pass --include-archive '
+                               f'to export them too, or --start {earliest.date()} or later')
+    for piece in export.stream_export(table, fmt, start, end, after_id, chunk_size, include_archive):
+        output.write(piece)
+
+@app.cli.command('import')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), help='Input format (default: from the file extension)')
+@click.option('--chunk-size', type=int, default=importer.IMPORT_CHUNK_SIZE, show_default=True)
+def import_command(source, fmt, chunk_size):
+    """Bulk import users and plan assignments from NDJSON or CSV"""
+    init_db()
+    fmt = fmt or ('csv' if source.name.endswith('.csv') else 'ndjson')
+    report = importer.import_rows(importer.read_rows(source, fmt), chunk_size)
+    click.echo(json.dumps(report, indent=2))
+
+@app.cli.command('lifecycle-sweep')
+@click.option('--batch-size', type=int, default=lifecycle.SWEEP_BATCH_SIZE, show_default=True)
+@click.option('--max-rows-per-second', type=int, default=lifecycle.SWEEP_MAX_ROWS_PER_SECOND, show_default=True,
+              help='Rate limit across batches (0 disables it)')
+def lifecycle_sweep_command(batch_size, max_rows_per_second):
+    """Move subscriptions to expiring_soon/expired based on their end dates"""
+    init_db()
+    report = lifecycle.sweep(batch_size=batch_size, max_rows_per_second=max_rows_per_second)
+    click.echo(json.dumps(report, indent=2))
+
+@app.cli.command('archive-payments')
+@click.option('--horizon-days', type=int, default=archive.ARCHIVE_HORIZON_DAYS, show_default=True,
+              help='Archive payments older than this many days')
+@click.option('--batch-size', type=int, default=archive.ARCHIVE_BATCH_SIZE, show_default=True,
+              help='Subscriptions per archive transaction')
+def archive_payments_command(horizon_days, batch_size):
+    """Move old payments out of the payments table into compressed archive segments"""
+    init_db()
+    report = archive.run_archive(horizon_days=horizon_days, batch_size=batch_size)
+    click.echo(json.dumps(report, indent=2))
+
+@app.cli.command('analytics-rebuild')
+def analytics_rebuild_command():
+    """Recompute the analytics rollups from subscriptions and payments"""
+    init_db()
+    for path in shards.router.paths():
+        with db_connection(path) as conn:
+            click.echo(json.dumps({'database': path, **analytics.rebuild(conn)}, indent=2))
+
+@app.cli.command('rebalance-shards')
+@click.option('--shards', 'count', type=int, required=True, help='Number of shards to spread the buckets over')
+@click.option('--dry-run', is_flag=True, help='Only report how many buckets and rows would move')
+def rebalance_shards_command(count, dry_run):
+    """Move user buckets between shard files. Stop the API first, then set DB_SHARDS to the new count"""
+    with db_connection() as conn:
+        init_schema(conn)
+        if not dry_run:
+            for index in range(1, count):
+                init_shard(conn, shards.shard_path(index))
+    
+    def report(done, total):
+        if done % 64 == 0 or done == total:
+            click.echo(f'{done}/{total} buckets moved', err=True)
+    
+    click.echo(json.dumps(shards.rebalance(count, dry_run=dry_run, report=report), indent=2))
+
+@app.cli.command('simulate-payments')
+@click.option('--count', type=int, default=100000, show_default=True)
+@click.option('--profile', type=click.Choice(sorted(simulator.PROFILES)), default=simulator.PAYMENT_SIMULATOR_PROFILE, show_default=True)
+@click.option('--seed', type=int, help='Seed for a reproducible run')
+@click.option('--success-rate', type=float, help="Override the profile's success rate")
+def simulate_payments_command(count, profile, seed, success_rate):
+    """Decide a batch of simulated payment outcomes and summarise them"""
+    engine = simulator.PaymentSimulator.from_profile(profile, seed=seed, success_rate=success_rate)
+    started = time.perf_counter()
+    outcomes = engine.decide_batch(count)
+    delays = engine.delays(count)
+    elapsed = time.perf_counter() - started
+    failures = {}
+    for outcome in outcomes:
+        if not outcome.success:
+            failures[outcome.failure.reason] = failures.get(outcome.failure.reason, 0) + 1
+    delays.sort()
+    click.echo(json.dumps({
+        'simulator': engine.describe(),
+        'attempts': count,
+        'succeeded': count - sum(failures.values()),
+        'failures_by_reason': dict(sorted(failures.items(), key=lambda item: -item[1])),
+        'latency_seconds': {
+            'mean': round(sum(delays) / count, 4) if count else None,
+            'p50': round(delays[count // 2], 4) if count else None,
+            'p99': round(delays[int(count * 0.99)], 4) if count else None
+        },
+        'decisions_per_second': round(count / elapsed) if elapsed else None
+    }, indent=2))
+
+def require_admin(view):
+    """Reject requests without the admin token; without ADMIN_TOKEN configured, reject all of them"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({'error': 'Admin endpoints are disabled; set ADMIN_TOKEN to enable them'}), 403
+        token = request.headers.get('X-Admin-Token', '')
+        if not hmac.compare_digest(token, ADMIN_TOKEN):
+            return jsonify({'error': 'Admin token required'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+lifecycle_sweeper = lifecycle.LifecycleSweeper(f'{db.DATABASE}.sweeper.lock', logger=app.logger)
+
+def warm_process():
+    """Load the plan catalog and shard map and open pooled connections ahead of traffic"""
+    plan_catalog.snapshot()
+    for path in shards.router.paths():
+        db.warm_pool(path)
+    # Attempts a previous worker lost on crash or restart
+    lifecycle.recover_stale_attempts()
+
+# Schema setup runs once per deployment; see bootstrap.py and gunicorn.conf.py
+bootstrapper = Bootstrap(f'{db.DATABASE}.bootstrap.lock', init_db, warm_process, logger=app.logger)
+
+@app.before_request
+def start_request_timer():
+    bootstrapper.ensure()
+    g.request_started = time.perf_counter()
+    metrics.start_request()
+    lifecycle_sweeper.ensure_started()
 
-def get_db():
-    """Get database connection"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.http_request_duration.observe(time.perf_counter() - started, request.method, endpoint)
+        metrics.http_requests.inc(request.method, endpoint, response.status_code)
+        queries, sql_seconds = metrics.request_totals()
+        metrics.request_sql_queries.observe(queries, endpoint)
+        metrics.request_sql_duration.observe(sql_seconds, endpoint)
+    return response
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics for this worker process"""
+    return app.response_class(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     return jsonify({'status': 'healthy', 'message': 'Subscription API is running'}), 200
 
-@app.route('/api/plans', methods=['GET'])
-def get_plans():
-    """Get all available subscription plans"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM plans WHERE is_active = 1')
-    plans = cursor.fetchall()
-    conn.close()
+def load_active_plans():
+    """Load the active plans for the plan catalog cache"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(queries.ACTIVE_PLANS)
+        plans = cursor.fetchall()
     
     result = []
     for plan in plans:
@@ -117,30 +317,36 @@ def get_plans():
             'billing_cycle': plan['billing_cycle'],
             'features': json.loads(plan['features'])
         })
-    
-    return jsonify(result), 200
+    return result
+
+plan_catalog = PlanCatalog(load_active_plans, app.json.dumps)
+
+def cached_json_response(body, etag):
+    """Serve pre-serialized JSON, answering 304 when the client's ETag matches"""
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = PLAN_CACHE_MAX_AGE
+    return response.make_conditional(request)
+
+@app.route('/api/plans', methods=['GET'])
+def get_plans():
+    """Get all available subscription plans"""
+    catalog = plan_catalog.snapshot()
+    return cached_json_response(catalog.list_body, catalog.list_etag)
 
 @app.route('/api/plans/<int:plan_id>', methods=['GET'])
 def get_plan(plan_id):
     """Get a specific plan by ID"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM plans WHERE id = ? AND is_active = 1', (plan_id,))
-    plan = cursor.fetchone()
-    conn.close()
+    cached = plan_catalog.snapshot().plan_bodies.get(plan_id)
     
-    if not plan:
+    if not cached:
         return jsonify({'error': 'Plan not found'}), 404
     
-    return jsonify({
-        'id': plan['id'],
-        'name': plan['name'],
-        'price': plan['price'],
-        'billing_cycle': plan['billing_cycle'],
-        'features': json.loads(plan['features'])
-    }), 200
+    return cached_json_response(*cached)
 
 @app.route('/api/subscribe', methods=['POST'])
+@idempotent('subscribe')
 def subscribe():
     """Create a new subscription"""
     data = request.json
@@ -151,59 +357,242 @@ def subscribe():
     if not all([email, name, plan_id]):
         return jsonify({'error': 'Missing required fields'}), 400
     
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    # Get or create user
-    cursor.execute('SELECT id FROM users WHERE email = ?', (email,))
-    user = cursor.fetchone()
-    if not user:
-        cursor.execute('INSERT INTO users (email, name) VALUES (?, ?)', (email, name))
-        user_id = cursor.lastrowid
-    else:
-        user_id = user['id']
-    
-    # Check if user already has an active subscription
-    cursor.execute('''
-        SELECT id FROM subscriptions 
-        WHERE user_id = ? AND status IN ('active', 'trialing')
-    ''', (user_id,))
-    existing = cursor.fetchone()
-    if existing:
-        return jsonify({'error': 'User already has an active subscription'}), 400
-    
-    # Get plan details
-    cursor.execute('SELECT * FROM plans WHERE id = ? AND is_active = 1', (plan_id,))
-    plan = cursor.fetchone()
-    if not plan:
-        conn.close()
-        return jsonify({'error': 'Plan not found'}), 404
-    
-    # Calculate dates
-    start_date = datetime.now()
-    if plan['billing_cycle'] == 'monthly':
-        end_date = start_date + timedelta(days=30)
-    else:  # yearly
-        end_date = start_date + timedelta(days=365)
-    
-    next_billing_date = end_date
-    
-    # Create subscription
-    cursor.execute('''
-        INSERT INTO subscriptions (user_id, plan_id, status, start_date, end_date, next_billing_date, auto_renew)
-        VALUES (?, ?, 'pending', ?, ?, ?, 1)
-    ''', (user_id, plan_id, start_date, end_date, next_billing_date))
-    subscription_id = cursor.lastrowid
+    with db_connection(shards.router.path_for_email(email)) as conn:
+        cursor = conn.cursor()
+        
+        # Get or create user
+        cursor.execute(queries.USER_ID_BY_EMAIL, (email,))
+        user = cursor.fetchone()
+        if not user:
+            user_id = shards.router.new_id(conn, 'users', shards.bucket_for_email(email))
+            cursor.execute('INSERT INTO users (id, email, name) VALUES (?, ?, ?)', (user_id, email, name))
+            user_id = cursor.lastrowid
+        else:
+            user_id = user['id']
+        
+        # Check if user already has an active subscription
+        cursor.execute(queries.ACTIVE_SUBSCRIPTION_OF_USER, (user_id,))
+        existing = cursor.fetchone()
+        if existing:
+            return jsonify({'error': 'User already has an active subscription'}), 400
+        
+        # Get plan details
+        cursor.execute(queries.ACTIVE_PLAN, (plan_id,))
+        plan = cursor.fetchone()
+        if not plan:
+            return jsonify({'error': 'Plan not found'}), 404
+        
+        # Calculate dates
+        start_date = datetime.now()
+        if plan['billing_cycle'] == 'monthly':
+            end_date = start_date + timedelta(days=30)
+        else:  # yearly
+            end_date = start_date + timedelta(days=365)
+        
+        next_billing_date = end_date
+        
+        # Create subscription
+        subscription_id = shards.router.new_id(conn, 'subscriptions', shards.bucket_for_id(user_id))
+        cursor.execute('''
+            INSERT INTO subscriptions (id, user_id, plan_id, status, start_date, end_date, next_billing_date, auto_renew)
+            VALUES (?, ?, ?, 'pending', ?, ?, ?, 1)
+        ''', (subscription_id, user_id, plan_id, start_date, end_date, next_billing_date))
+        subscription_id = cursor.lastrowid
+        
+        conn.commit()
     
-    conn.commit()
-    conn.close()
+    read_cache.user_changed(email)
+    read_cache.subscription_changed(subscription_id, user_id)
     
     return jsonify({
         'subscription_id': subscription_id,
         'message': 'Subscription created. Proceed to payment.'
     }), 201
 
+event_broker = EventBroker()
+metrics.registry.gauge('sse_open_streams', 'Open subscription event streams in this process', event_broker.subscriber_count)
+sse_stream_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+sse_streams_refused = metrics.registry.counter('sse_streams_refused_total', 'Event streams refused at SSE_MAX_STREAMS')
+
+def load_status_snapshot(conn, subscription_id):
+    """Current status fields and latest payment of a subscription, or None"""
+    row = conn.execute(queries.STATUS_SNAPSHOT, (subscription_id,)).fetchone()
+    if not row:
+        return None
+    last_payment = None
+    if row['payment_id'] is not None:
+        last_payment = (row['payment_id'], row['amount'], row['payment_status'], row['transaction_id'], row['payment_date'])
+    archived = archive.latest(conn, subscription_id)
+    if archived and (last_payment is None or (archived[4], archived[0]) > (last_payment[4], last_payment[0])):
+        last_payment = tuple(archived)
+    return {
+        'subscription_id': row['id'],
+        'status': row['status'],
+        'end_date': row['end_date'],
+        'next_billing_date': row['next_billing_date'],
+        'auto_renew': bool(row['auto_renew']),
+        'last_payment': dict(zip(archive.PAGE_COLUMNS, last_payment)) if last_payment else None
+    }
+
+def notify_subscription(conn, subscription_id, event):
+    """Push a subscription's new status to its open event streams after a commit"""
+    if event_broker.has_subscribers(subscription_id):
+        snapshot = load_status_snapshot(conn, subscription_id)
+        if snapshot:
+            event_broker.publish(subscription_id, event, snapshot)
+
+def find_payable_subscription(cursor, subscription_id):
+    """Look up a subscription awaiting payment.
+
+    Returns (subscription, None), or (None, (error payload, HTTP status)).
+    """
+    cursor.execute(queries.SUBSCRIPTION_WITH_PRICE, (subscription_id,))
+    subscription = cursor.fetchone()
+    
+    if not subscription:
+        return None, ({'error': 'Subscription not found'}, 404)
+    
+    if subscription['status'] != 'pending':
+        return None, ({'error': 'Subscription is not in pending state'}, 400)
+    
+    return subscription, None
+
+# Gateway latency and outcomes, configured from PAYMENT_SIMULATOR_* (see simulator.py)
+payment_simulator = simulator.PaymentSimulator.from_environment()
+
+def process_payment(subscription_id, amount, force_success=None, force_failure_reason=None):
+    """Run the simulated gateway and record the outcome.
+
+    Returns the response payload and HTTP status code. Used directly by the
+    synchronous endpoint and by the payment worker pool.
+    """
+    processing_delay = payment_simulator.delay()
+    if processing_delay:
+        time.sleep(processing_delay)
+    metrics.payment_gateway_duration.observe(processing_delay)
+    return record_payment(subscription_id, amount, force_success, force_failure_reason)
+
+def record_payment(subscription_id, amount, force_success=None, force_failure_reason=None):
+    """Decide the outcome of a payment whose gateway delay has elapsed and store it"""
+    transaction_id = new_transaction_id()
+    
+    success, failure = payment_simulator.decide(force_success, force_failure_reason)
+    
+    with db_connection(shards.router.path_for_id(subscription_id)) as conn:
+        cursor = conn.cursor()
+        payment_id = shards.router.new_id(conn, 'payments', shards.bucket_for_id(subscription_id))
+        
+        if success:
+            # Successful payment
+            # Update subscription status
+            cursor.execute('''
+                UPDATE subscriptions 
+                SET status = 'active' 
+                WHERE id = ?
+                RETURNING user_id
+            ''', (subscription_id,))
+            user_id = cursor.fetchone()['user_id']
+            
+            # Create payment record
+            cursor.execute('''
+                INSERT INTO payments (id, subscription_id, amount, status, transaction_id)
+                VALUES (?, ?, ?, 'completed', ?)
+            ''', (payment_id, subscription_id, amount, transaction_id))
+            
+            conn.commit()
+            read_cache.subscription_changed(subscription_id, user_id)
+            notify_subscription(conn, subscription_id, 'payment')
+            
+            metrics.payment_outcomes.inc('completed')
+            return {
+                'success': True,
+                'transaction_id': transaction_id,
+                'message': 'Payment processed successfully',
+                'amount': amount,
+                'currency': 'USD',
+                'status': 'completed',
+                'processed_at': datetime.now().isoformat()
+            }, 200
+        else:
+            # Create failed payment record with failure details
+            cursor.execute('''
+                INSERT INTO payments (id, subscription_id, amount, status, transaction_id, failure_reason)
+                VALUES (?, ?, ?, 'failed', ?, ?)
+            ''', (payment_id, subscription_id, amount, transaction_id, failure.reason))
+            
+            # Update subscription status
+            cursor.execute('''
+                UPDATE subscriptions 
+                SET status = 'payment_failed' 
+                WHERE id = ?
+                RETURNING user_id
+            ''', (subscription_id,))
+            user_id = cursor.fetchone()['user_id']
+            
+            conn.commit()
+            read_cache.subscription_changed(subscription_id, user_id)
+            notify_subscription(conn, subscription_id, 'payment')
+            
+            metrics.payment_outcomes.inc('failed')
+            metrics.payment_failures.inc(failure.code, failure.reason)
+            return {
+                'success': False,
+                'transaction_id': transaction_id,
+                'message': failure.message,
+                'error_code': failure.code,
+                'error_reason': failure.reason,
+                'amount': amount,
+                'currency': 'USD',
+                'status': 'failed',
+                'processed_at': datetime.now().isoformat()
+            }, 400
+
+def run_payment_attempt(attempt_id, subscription_id, amount, force_success, force_failure_reason):
+    """Worker pool entry point: process a queued attempt and store its result"""
+    path = shards.router.path_for_id(subscription_id)
+    with db_connection(path) as conn:
+        claimed = conn.execute('''
+            UPDATE payment_attempts 
+            SET status = 'processing', updated_at = CURRENT_TIMESTAMP 
+            WHERE id = ? AND status = 'queued'
+        ''', (attempt_id,)).rowcount
+        conn.commit()
+    if not claimed:
+        # Expired by recovery while it waited; its subscription was reopened
+        return
+    
+    try:
+        result, http_status = process_payment(subscription_id, amount, force_success, force_failure_reason)
+        status = result['status']
+    except Exception:
+        app.logger.exception('Payment attempt %s failed unexpectedly', attempt_id)
+        result, http_status = {'error': 'Payment processing error'}, 500
+        status = 'error'
+    
+    with db_connection(path) as conn:
+        conn.execute('''
+            UPDATE payment_attempts 
+            SET status = ?, http_status = ?, result = ?, updated_at = CURRENT_TIMESTAMP 
+            WHERE id = ?
+        ''', (status, http_status, json.dumps(result), attempt_id))
+        conn.commit()
+
+payment_queue = PaymentQueue(run_payment_attempt)
+metrics.registry.gauge('payment_queue_pending', 'Payment attempts queued or running in this process', payment_queue.pending_count)
+
+def serialize_payment_attempt(attempt):
+    return {
+        'attempt_id': attempt['id'],
+        'subscription_id': attempt['subscription_id'],
+        'status': attempt['status'],
+        'http_status': attempt['http_status'],
+        'result': json.loads(attempt['result']) if attempt['result'] else None,
+        'created_at': attempt['created_at'],
+        'updated_at': attempt['updated_at']
+    }
+
 @app.route('/api/payment/simulate', methods=['POST'])
+@idempotent('simulate_payment')
 def simulate_payment():
     """Simulate realistic payment processing with various failure scenarios"""
     
@@ -212,307 +601,423 @@ def simulate_payment():
     payment_method = data.get('payment_method', {})
     force_success = data.get('force_success')  # Explicitly force success/failure
     force_failure_reason = data.get('force_failure_reason')  # Force specific failure
+    process_async = data.get('async', PAYMENT_PROCESSING_MODE == 'async')
     
     if not subscription_id:
         return jsonify({'error': 'Missing subscription_id'}), 400
     
-    conn = get_db()
-    cursor = conn.cursor()
+    with db_connection(shards.router.path_for_id(subscription_id)) as conn:
+        cursor = conn.cursor()
+        
+        subscription, error = find_payable_subscription(cursor, subscription_id)
+        if error:
+            payload, status = error
+            return jsonify(payload), status
+        
+        if process_async:
+            # Claim the subscription so a second submit cannot queue another attempt
+            cursor.execute('''
+                UPDATE subscriptions 
+                SET status = 'processing' 
+                WHERE id = ? AND status = 'pending'
+            ''', (subscription_id,))
+            if cursor.rowcount == 0:
+                return jsonify({'error': 'Subscription is not in pending state'}), 400
+            
+            attempt_id = shards.router.new_attempt_id(subscription_id, uuid.uuid4().hex)
+            cursor.execute('''
+                INSERT INTO payment_attempts (id, subscription_id, status)
+                VALUES (?, ?, 'queued')
+            ''', (attempt_id, subscription_id))
+            
+            conn.commit()
+            read_cache.subscription_changed(subscription_id, subscription['user_id'])
+            notify_subscription(conn, subscription_id, 'payment')
     
-    # Get subscription details
-    cursor.execute('''
-        SELECT s.*, p.price, p.billing_cycle 
-        FROM subscriptions s 
-        JOIN plans p ON s.plan_id = p.id 
-        WHERE s.id = ?
-    ''', (subscription_id,))
-    subscription = cursor.fetchone()
+    if not process_async:
+        # The gateway delay runs without holding on to a pooled connection
+        result, http_status = process_payment(subscription_id, subscription['price'], force_success, force_failure_reason)
+        return jsonify(result), http_status
     
-    if not subscription:
-        conn.close()
-        return jsonify({'error': 'Subscription not found'}), 404
+    payment_queue.submit(attempt_id, subscription_id, subscription['price'], force_success, force_failure_reason)
     
-    if subscription['status'] != 'pending':
-        conn.close()
-        return jsonify({'error': 'Subscription is not in pending state'}), 400
-    
-    # Simulate realistic payment processing delay (1-3 seconds)
-    processing_delay = random.uniform(1.0, 3.0)
-    time.sleep(processing_delay)
-    
-    # Generate realistic transaction ID
-    transaction_id = f'TXN{datetime.now().strftime("%Y%m%d")}{random.randint(100000, 999999)}'
-    
-    # Determine payment outcome
-    if force_success is not None:
-        # Explicitly set success/failure
-        success = force_success
-    elif force_failure_reason:
-        # Force a specific failure type
-        success = False
-    else:
-        # Realistic payment success rate (95% success, 5% failure)
-        success = random.random() > 0.05
-    
-    # Payment failure scenarios with realistic reasons
-    failure_scenarios = [
-        {
-            'code': 'card_declined',
-            'reason': 'insufficient_funds',
-            'message': 'Your card was declined due to insufficient funds. Please use a different payment method.'
-        },
-        {
-            'code': 'card_declined',
-            'reason': 'generic_decline',
-            'message': 'Your card was declined. Please contact your bank or use a different card.'
-        },
-        {
-            'code': 'card_declined',
-            'reason': 'expired_card',
-            'message': 'Your card has expired. Please use a different payment method.'
-        },
-        {
-            'code': 'processing_error',
-            'reason': 'network_error',
-            'message': 'Payment processing encountered a network error. Please try again.'
-        },
-        {
-            'code': 'authentication_required',
-            'reason': '3d_secure_failed',
-            'message': 'Payment authentication failed. Please try again with a different card.'
-        },
-        {
-            'code': 'card_declined',
-            'reason': 'lost_card',
-            'message': 'Your card was declined. Please contact your bank.'
-        },
-        {
-            'code': 'card_declined',
-            'reason': 'stolen_card',
-            'message': 'Your card was declined for security reasons. Please use a different payment method.'
-        }
-    ]
-    
-    if success:
-        # Successful payment
-        # Update subscription status
-        cursor.execute('''
-            UPDATE subscriptions 
-            SET status = 'active' 
-            WHERE id = ?
-        ''', (subscription_id,))
-        
-        # Create payment record
-        cursor.execute('''
-            INSERT INTO payments (subscription_id, amount, status, transaction_id)
-            VALUES (?, ?, 'completed', ?)
-        ''', (subscription_id, subscription['price'], transaction_id))
-        
-        conn.commit()
-        conn.close()
-        
-        return jsonify({
-            'success': True,
-            'transaction_id': transaction_id,
-            'message': 'Payment processed successfully',
-            'amount': subscription['price'],
-            'currency': 'USD',
-            'status': 'completed',
-            'processed_at': datetime.now().isoformat()
-        }), 200
-    else:
-        # Failed payment - select a realistic failure scenario
-        if force_failure_reason:
-            # Find the specific failure reason
-            failure = next((f for f in failure_scenarios if f['reason'] == force_failure_reason), failure_scenarios[0])
-        else:
-            # Random failure scenario
-            failure = random.choice(failure_scenarios)
-        
-        # Create failed payment record with failure details
-        cursor.execute('''
-            INSERT INTO payments (subscription_id, amount, status, transaction_id)
-            VALUES (?, ?, 'failed', ?)
-        ''', (subscription_id, subscription['price'], transaction_id))
+    return jsonify({
+        'attempt_id': attempt_id,
+        'subscription_id': subscription_id,
+        'status': 'queued',
+        'status_url': f'/api/payment/attempts/{attempt_id}',
+        'message': 'Payment queued for processing'
+    }), 202
+
+@app.route('/api/payment/attempts/<attempt_id>', methods=['GET'])
+def get_payment_attempt(attempt_id):
+    """Get the state of a queued payment attempt, optionally waiting for it to finish"""
+    wait = request.args.get('wait', 0, type=float)
+    # nan would never reach the deadline
+    if not math.isfinite(wait):
+        return jsonify({'error': 'Invalid wait'}), 400
+    wait = min(max(wait, 0), MAX_ATTEMPT_WAIT_SECONDS)
+    deadline = time.monotonic() + wait
+    
+    path = shards.router.path_for_attempt(attempt_id)
+    while True:
+        with db_connection(path) as conn:
+            cursor = conn.cursor()
+            cursor.execute(queries.PAYMENT_ATTEMPT, (attempt_id,))
+            attempt = cursor.fetchone()
         
-        # Update subscription status
-        cursor.execute('''
-            UPDATE subscriptions 
-            SET status = 'payment_failed' 
-            WHERE id = ?
-        ''', (subscription_id,))
+        if not attempt:
+            return jsonify({'error': 'Payment attempt not found'}), 404
         
-        conn.commit()
-        conn.close()
+        remaining = deadline - time.monotonic()
+        if attempt['status'] not in ('queued', 'processing') or remaining <= 0:
+            return jsonify(serialize_payment_attempt(attempt)), 200
         
-        return jsonify({
-            'success': False,
-            'transaction_id': transaction_id,
-            'message': failure['message'],
-            'error_code': failure['code'],
-            'error_reason': failure['reason'],
-            'amount': subscription['price'],
-            'currency': 'USD',
-            'status': 'failed',
-            'processed_at': datetime.now().isoformat()
-        }), 400
+        # Attempts queued by this process can be waited on directly, anything
+        # handled by another worker process is polled from the database
+        if not payment_queue.wait(attempt_id, remaining):
+            time.sleep(min(0.25, remaining))
+
+# Response shapes, mapped straight from rows to JSON text; plan features are
+# stored as JSON and embedded without being parsed
+USER_SUBSCRIPTION = RowMapper({
+    'id': 'id',
+    'plan_name': 'plan_name',
+    'price': 'price',
+    'billing_cycle': 'billing_cycle',
+    'features': Raw('features'),
+    'status': 'status',
+    'start_date': 'start_date',
+    'end_date': 'end_date',
+    'next_billing_date': 'next_billing_date',
+    'auto_renew': Flag('auto_renew'),
+    'last_payment': Nested('last_payment_status', {
+        'status': 'last_payment_status',
+        'transaction_id': 'last_payment_transaction_id',
+        'payment_date': 'last_payment_date'
+    })
+})
+
+SUBSCRIPTION_STATUS = RowMapper({
+    'id': 'id',
+    'user': Nested('user_id', {
+        'id': 'user_id',
+        'name': 'user_name',
+        'email': 'email'
+    }),
+    'plan': Nested('plan_id', {
+        'id': 'plan_id',
+        'name': 'plan_name',
+        'price': 'price',
+        'billing_cycle': 'billing_cycle',
+        'features': Raw('features')
+    }),
+    'status': 'status',
+    'start_date': 'start_date',
+    'end_date': 'end_date',
+    'next_billing_date': 'next_billing_date',
+    'auto_renew': Flag('auto_renew'),
+    'payments': Extra(),
+    'payments_next_cursor': Extra()
+})
+
+PAYMENT = RowMapper({
+    'id': 'id',
+    'amount': 'amount',
+    'status': 'status',
+    'transaction_id': 'transaction_id',
+    'payment_date': 'payment_date'
+})
 
 @app.route('/api/subscriptions/<int:user_id>', methods=['GET'])
 def get_user_subscriptions(user_id):
     """Get all subscriptions for a user"""
-    conn = get_db()
+    path = shards.router.path_for_id(user_id)
+    body = read_cache.user_subscriptions.get_or_load(user_id, path, lambda: load_user_subscriptions_body(path, user_id))
+    return json_text_response(app, body)
+
+def load_user_subscriptions_body(path, user_id):
+    with db_connection(path) as conn:
+        cursor = query_user_subscriptions(conn, user_id)
+        return USER_SUBSCRIPTION.array(cursor.fetchall(), cursor.description)
+
+def query_user_subscriptions(conn, user_id):
+    """Run the user subscriptions query, newest first, and return its cursor"""
     cursor = conn.cursor()
+    cursor.execute(queries.USER_SUBSCRIPTIONS, (user_id, user_id, user_id))
+    return cursor
+
+def parse_page_size(value):
+    if value is None:
+        return PAYMENTS_PAGE_SIZE
+    limit = int(value)
+    if limit < 1:
+        raise ValueError('page size must be positive')
+    return min(limit, MAX_PAYMENTS_PAGE_SIZE)
+
+def encode_payment_cursor(payment):
+    # Rows come from the payments table or the archive, read by position
+    position = json.dumps([payment[4], payment[0]])
+    return base64.urlsafe_b64encode(position.encode()).decode().rstrip('=')
+
+def decode_payment_cursor(token):
+    """Decode a next_cursor token into its (payment_date, id) position"""
+    if not token:
+        return None
+    try:
+        payment_date, payment_id = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (TypeError, ValueError):
+        raise ValueError('malformed cursor')
+    if not isinstance(payment_date, str) or not isinstance(payment_id, int):
+        raise ValueError('malformed cursor')
+    return payment_date, payment_id
+
+def fetch_payment_page(conn, subscription_id, limit, after=None):
+    """Read one page of payments, newest first, using (payment_date, id) as the keyset.
     
-    cursor.execute('''
-        SELECT s.*, p.name as plan_name, p.price, p.billing_cycle, p.features,
-               u.email, u.name as user_name
-        FROM subscriptions s
-        JOIN plans p ON s.plan_id = p.id
-        JOIN users u ON s.user_id = u.id
-        WHERE s.user_id = ?
-        ORDER BY s.created_at DESC
-    ''', (user_id,))
-    
-    subscriptions = cursor.fetchall()
-    conn.close()
-    
-    result = []
-    for sub in subscriptions:
-        # Get latest payment
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM payments 
-            WHERE subscription_id = ? 
-            ORDER BY payment_date DESC 
-            LIMIT 1
-        ''', (sub['id'],))
-        payment = cursor.fetchone()
-        conn.close()
-        
-        result.append({
-            'id': sub['id'],
-            'plan_name': sub['plan_name'],
-            'price': sub['price'],
-            'billing_cycle': sub['billing_cycle'],
-            'features': json.loads(sub['features']),
-            'status': sub['status'],
-            'start_date': sub['start_date'] if sub['start_date'] else None,
-            'end_date': sub['end_date'] if sub['end_date'] else None,
-            'next_billing_date': sub['next_billing_date'] if sub['next_billing_date'] else None,
-            'auto_renew': bool(sub['auto_renew']),
-            'last_payment': {
-                'status': payment['status'] if payment else None,
-                'transaction_id': payment['transaction_id'] if payment else None,
-                'payment_date': payment['payment_date'] if payment else None
-            } if payment else None
-        })
+    Reading stops one row past the page, which only tells us whether another
+    page exists. Archived payments are merged in only when the page reaches
+    past the newest of them. Returns the page as JSON array text and the next
+    cursor.
+    """
+    cursor = conn.cursor()
+    if after:
+        cursor.execute(queries.PAYMENT_PAGE_AFTER, (subscription_id, after[0], after[1], limit + 1))
+    else:
+        cursor.execute(queries.PAYMENT_PAGE, (subscription_id, limit + 1))
     
-    return jsonify(result), 200
+    payments = archive.merge_page(conn, subscription_id, cursor.fetchmany(limit + 1), limit, after)
+    next_cursor = encode_payment_cursor(payments[limit - 1]) if len(payments) > limit else None
+    return PAYMENT.array(payments[:limit], cursor.description), next_cursor
 
 @app.route('/api/subscriptions/status/<int:subscription_id>', methods=['GET'])
 def get_subscription_status(subscription_id):
-    """Get detailed status of a subscription"""
-    conn = get_db()
-    cursor = conn.cursor()
+    """Get detailed status of a subscription with the first page of its payments"""
+    try:
+        limit = parse_page_size(request.args.get('payments_limit'))
+    except ValueError:
+        return jsonify({'error': 'Invalid payments_limit'}), 400
     
-    cursor.execute('''
-        SELECT s.*, p.name as plan_name, p.price, p.billing_cycle, p.features,
-               u.email, u.name as user_name
-        FROM subscriptions s
-        JOIN plans p ON s.plan_id = p.id
-        JOIN users u ON s.user_id = u.id
-        WHERE s.id = ?
-    ''', (subscription_id,))
+    path = shards.router.path_for_id(subscription_id)
+    if limit == PAYMENTS_PAGE_SIZE:
+        # Only the default page is cached, so a write evicts a single entry
+        body = read_cache.subscription_status.get_or_load(
+            subscription_id, path, lambda: load_subscription_status_body(path, subscription_id, limit))
+    else:
+        body = load_subscription_status_body(path, subscription_id, limit)
     
-    subscription = cursor.fetchone()
-    if not subscription:
-        conn.close()
+    if body is None:
         return jsonify({'error': 'Subscription not found'}), 404
     
-    # Get all payments for this subscription
-    cursor.execute('''
-        SELECT * FROM payments 
-        WHERE subscription_id = ? 
-        ORDER BY payment_date DESC
-    ''', (subscription_id,))
-    payments = cursor.fetchall()
+    return json_text_response(app, body)
+
+def load_subscription_status_body(path, subscription_id, limit):
+    """JSON body of a subscription's status with its first payments page, or None"""
+    with db_connection(path) as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute(queries.SUBSCRIPTION_STATUS, (subscription_id,))
+        
+        subscription = cursor.fetchone()
+        if not subscription:
+            return None
+        
+        payments, next_cursor = fetch_payment_page(conn, subscription_id, limit)
     
-    conn.close()
+    return SUBSCRIPTION_STATUS.object(subscription, cursor.description,
+                                      payments=payments, payments_next_cursor=encode(next_cursor))
+
+@app.route('/api/subscriptions/status:batch', methods=['POST'])
+def get_subscription_statuses():
+    """Get the status of many subscriptions, each shaped like GET /api/subscriptions/status/<id>"""
+    data = request.get_json(silent=True) or {}
+    subscription_ids = data.get('subscription_ids')
+    if (not isinstance(subscription_ids, list) or not subscription_ids
+            or not all(isinstance(value, int) and not isinstance(value, bool) for value in subscription_ids)):
+        return jsonify({'error': 'subscription_ids must be a non-empty list of integers'}), 400
+    if len(subscription_ids) > MAX_STATUS_BATCH_SIZE:
+        return jsonify({'error': f'At most {MAX_STATUS_BATCH_SIZE} subscription_ids per request'}), 400
+    payments_limit = data.get('payments_limit')
+    # int() would truncate 5.5 and accept true
+    if payments_limit is not None and (not isinstance(payments_limit, int) or isinstance(payments_limit, bool)):
+        return jsonify({'error': 'Invalid payments_limit'}), 400
+    try:
+        limit = parse_page_size(payments_limit)
+    except ValueError:
+        return jsonify({'error': 'Invalid payments_limit'}), 400
     
-    return jsonify({
-        'id': subscription['id'],
-        'user': {
-            'id': subscription['user_id'],
-            'name': subscription['user_name'],
-            'email': subscription['email']
-        },
-        'plan': {
-            'id': subscription['plan_id'],
-            'name': subscription['plan_name'],
-            'price': subscription['price'],
-            'billing_cycle': subscription['billing_cycle'],
-            'features': json.loads(subscription['features'])
-        },
-        'status': subscription['status'],
-        'start_date': subscription['start_date'],
-        'end_date': subscription['end_date'],
-        'next_billing_date': subscription['next_billing_date'],
-        'auto_renew': bool(subscription['auto_renew']),
-        'payments': [{
-            'id': p['id'],
-            'amount': p['amount'],
-            'status': p['status'],
-            'transaction_id': p['transaction_id'],
-            'payment_date': p['payment_date']
-        } for p in payments]
-    }), 200
+    # Each ID once, in request order; every shard is read with the same few queries
+    subscription_ids = list(dict.fromkeys(subscription_ids))
+    by_path = {}
+    for subscription_id in subscription_ids:
+        by_path.setdefault(shards.router.path_for_id(subscription_id), []).append(subscription_id)
+    bodies = {}
+    for path, ids in by_path.items():
+        bodies.update(load_subscription_status_bodies(path, ids, limit))
+    
+    return json_text_response(app, raw_object(
+        subscriptions='[' + ','.join(bodies[i] for i in subscription_ids if i in bodies) + ']',
+        not_found=encode([i for i in subscription_ids if i not in bodies])
+    ))
 
-@app.route('/api/subscriptions/<int:subscription_id>/renew', methods=['POST'])
-def renew_subscription(subscription_id):
-    """Handle subscription renewal"""
-    conn = get_db()
-    cursor = conn.cursor()
+def load_subscription_status_bodies(path, subscription_ids, limit):
+    """Status bodies of subscriptions on one shard, by ID, from three set-based queries.
     
-    cursor.execute('''
-        SELECT s.*, p.price, p.billing_cycle 
-        FROM subscriptions s 
-        JOIN plans p ON s.plan_id = p.id 
-        WHERE s.id = ?
-    ''', (subscription_id,))
-    subscription = cursor.fetchone()
+    The payments query reads at most limit + 1 index entries per
+    subscription and returns them grouped by subscription, newest first.
+    """
+    with db_connection(path) as conn:
+        cursor = conn.execute(queries.SUBSCRIPTION_STATUSES, (json.dumps(subscription_ids),))
+        subscriptions = cursor.fetchall()
+        if not subscriptions:
+            return {}
+        
+        found = [subscription['id'] for subscription in subscriptions]
+        payments = conn.execute(queries.PAYMENT_PAGES, (json.dumps(found), limit + 1))
+        pages = {key: list(rows) for key, rows in itertools.groupby(payments.fetchall(), key=itemgetter(5))}
+        archived = archive.members_of(conn, found)
     
-    if not subscription:
-        conn.close()
+    bodies = {}
+    for subscription in subscriptions:
+        subscription_id = subscription['id']
+        page = archive.merge_entries(archived.get(subscription_id), pages.get(subscription_id, []), limit)
+        next_cursor = encode_payment_cursor(page[limit - 1]) if len(page) > limit else None
+        bodies[subscription_id] = SUBSCRIPTION_STATUS.object(
+            subscription, cursor.description,
+            payments=PAYMENT.array(page[:limit], payments.description),
+            payments_next_cursor=encode(next_cursor)
+        )
+    return bodies
+
+@app.route('/api/subscriptions/<int:subscription_id>/payments', methods=['GET'])
+def get_subscription_payments(subscription_id):
+    """Get one page of a subscription's payment history, newest first"""
+    try:
+        limit = parse_page_size(request.args.get('limit'))
+        after = decode_payment_cursor(request.args.get('cursor'))
+    except ValueError:
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
+    
+    with db_connection(shards.router.path_for_id(subscription_id)) as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id FROM subscriptions WHERE id = ?', (subscription_id,))
+        if not cursor.fetchone():
+            return jsonify({'error': 'Subscription not found'}), 404
+        
+        payments, next_cursor = fetch_payment_page(conn, subscription_id, limit, after)
+    
+    return json_text_response(app, raw_object(
+        subscription_id=encode(subscription_id),
+        payments=payments,
+        next_cursor=encode(next_cursor)
+    ))
+
+@app.route('/api/subscriptions/<int:subscription_id>/events', methods=['GET'])
+def subscription_events(subscription_id):
+    """Server-Sent Events stream of a subscription's status changes"""
+    if not sse_stream_slots.acquire(blocking=False):
+        sse_streams_refused.inc()
+        response = jsonify({
+            'error': 'Too many open event streams; poll the status instead',
+            'status_url': f'/api/subscriptions/status/{subscription_id}'
+        })
+        response.status_code = 503
+        response.headers['Retry-After'] = str(SSE_BUSY_RETRY_SECONDS)
+        return response
+    
+    # Subscribe before reading the first snapshot so no change falls in between
+    subscriber = event_broker.subscribe(subscription_id)
+    path = shards.router.path_for_id(subscription_id)
+    try:
+        with db_connection(path) as conn:
+            snapshot = load_status_snapshot(conn, subscription_id)
+    except Exception:
+        event_broker.unsubscribe(subscriber)
+        sse_stream_slots.release()
+        raise
+    if not snapshot:
+        event_broker.unsubscribe(subscriber)
+        sse_stream_slots.release()
         return jsonify({'error': 'Subscription not found'}), 404
     
-    if subscription['status'] not in ['active', 'expiring_soon']:
-        conn.close()
-        return jsonify({'error': 'Subscription cannot be renewed'}), 400
+    def stream():
+        yield f'retry: {SSE_RETRY_MS}\n\n' + format_sse('status', snapshot)
+        last = snapshot
+        deadline = time.monotonic() + SSE_MAX_STREAM_SECONDS
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            message = subscriber.get(min(SSE_HEARTBEAT_SECONDS, remaining))
+            if message:
+                event, data = message
+            else:
+                # Changes made by other worker processes never reach this
+                # broker, so compare against the database on each heartbeat
+                with db_connection(path) as conn:
+                    event, data = 'status', load_status_snapshot(conn, subscription_id)
+                if data is None:
+                    return
+            if data == last:
+                if not message:
+                    yield ': keep-alive\n\n'
+                continue
+            last = data
+            yield format_sse(event, data)
     
-    # Calculate new dates
-    current_end = datetime.fromisoformat(subscription['end_date'])
-    if subscription['billing_cycle'] == 'monthly':
-        new_end = current_end + timedelta(days=30)
-    else:
-        new_end = current_end + timedelta(days=365)
-    
-    # Update subscription
-    cursor.execute('''
-        UPDATE subscriptions 
-        SET end_date = ?, next_billing_date = ?, status = 'active'
-        WHERE id = ?
-    ''', (new_end, new_end, subscription_id))
-    
-    # Create payment record
-    transaction_id = f'TXN{random.randint(100000, 999999)}'
-    cursor.execute('''
-        INSERT INTO payments (subscription_id, amount, status, transaction_id)
-        VALUES (?, ?, 'completed', ?)
-    ''', (subscription_id, subscription['price'], transaction_id))
+    response = app.response_class(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
     
-    conn.commit()
-    conn.close()
+    def close_stream():
+        # The server closes every response, even one whose client left before
+        # the generator started
+        event_broker.unsubscribe(subscriber)
+        sse_stream_slots.release()
+    response.call_on_close(close_stream)
+    return response
+
+@app.route('/api/subscriptions/<int:subscription_id>/renew', methods=['POST'])
+@idempotent('renew_subscription')
+def renew_subscription(subscription_id):
+    """Handle subscription renewal"""
+    with db_connection(shards.router.path_for_id(subscription_id)) as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute(queries.SUBSCRIPTION_WITH_PRICE, (subscription_id,))
+        subscription = cursor.fetchone()
+        
+        if not subscription:
+            return jsonify({'error': 'Subscription not found'}), 404
+        
+        if subscription['status'] not in ['active', 'expiring_soon']:
+            return jsonify({'error': 'Subscription cannot be renewed'}), 400
+        
+        # Calculate new dates
+        current_end = datetime.fromisoformat(subscription['end_date'])
+        if subscription['billing_cycle'] == 'monthly':
+            new_end = current_end + timedelta(days=30)
+        else:
+            new_end = current_end + timedelta(days=365)
+        
+        # Update subscription
+        cursor.execute('''
+            UPDATE subscriptions 
+            SET end_date = ?, next_billing_date = ?, status = 'active'
+            WHERE id = ?
+        ''', (new_end, new_end, subscription_id))
+        
+        # Create payment record
+        transaction_id = new_transaction_id()
+        payment_id = shards.router.new_id(conn, 'payments', shards.bucket_for_id(subscription_id))
+        cursor.execute('''
+            INSERT INTO payments (id, subscription_id, amount, status, transaction_id)
+            VALUES (?, ?, ?, 'completed', ?)
+        ''', (payment_id, subscription_id, subscription['price'], transaction_id))
+        
+        conn.commit()
+        read_cache.subscription_changed(subscription_id, subscription['user_id'])
+        notify_subscription(conn, subscription_id, 'renewed')
     
     return jsonify({
         'success': True,
@@ -524,24 +1029,24 @@ def renew_subscription(subscription_id):
 @app.route('/api/subscriptions/<int:subscription_id>/cancel', methods=['POST'])
 def cancel_subscription(subscription_id):
     """Cancel a subscription (no auto-renewal)"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM subscriptions WHERE id = ?', (subscription_id,))
-    subscription = cursor.fetchone()
-    
-    if not subscription:
-        conn.close()
-        return jsonify({'error': 'Subscription not found'}), 404
-    
-    cursor.execute('''
-        UPDATE subscriptions 
-        SET auto_renew = 0, status = 'cancelled'
-        WHERE id = ?
-    ''', (subscription_id,))
-    
-    conn.commit()
-    conn.close()
+    with db_connection(shards.router.path_for_id(subscription_id)) as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT * FROM subscriptions WHERE id = ?', (subscription_id,))
+        subscription = cursor.fetchone()
+        
+        if not subscription:
+            return jsonify({'error': 'Subscription not found'}), 404
+        
+        cursor.execute('''
+            UPDATE subscriptions 
+            SET auto_renew = 0, status = 'cancelled'
+            WHERE id = ?
+        ''', (subscription_id,))
+        
+        conn.commit()
+        read_cache.subscription_changed(subscription_id, subscription['user_id'])
+        notify_subscription(conn, subscription_id, 'cancelled')
     
     return jsonify({
         'success': True,
@@ -558,45 +1063,201 @@ def create_user():
     if not all([email, name]):
         return jsonify({'error': 'Missing email or name'}), 400
     
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute('INSERT INTO users (email, name) VALUES (?, ?)', (email, name))
-        user_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+    with db_connection(shards.router.path_for_email(email)) as conn:
+        cursor = conn.cursor()
         
-        return jsonify({
-            'id': user_id,
-            'email': email,
-            'name': name
-        }), 201
-    except sqlite3.IntegrityError:
-        conn.close()
-        return jsonify({'error': 'User with this email already exists'}), 400
+        try:
+            user_id = shards.router.new_id(conn, 'users', shards.bucket_for_email(email))
+            cursor.execute('INSERT INTO users (id, email, name) VALUES (?, ?, ?)', (user_id, email, name))
+            user_id = cursor.lastrowid
+            conn.commit()
+            read_cache.user_changed(email)
+            
+            return jsonify({
+                'id': user_id,
+                'email': email,
+                'name': name
+            }), 201
+        except sqlite3.IntegrityError:
+            return jsonify({'error': 'User with this email already exists'}), 400
 
 @app.route('/api/users/<email>', methods=['GET'])
 def get_user_by_email(email):
     """Get user by email"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE email = ?', (email,))
-    user = cursor.fetchone()
-    conn.close()
+    path = shards.router.path_for_email(email)
+    body = read_cache.users.get_or_load(email, path, lambda: load_user_body(path, email))
     
-    if not user:
+    if body is None:
         return jsonify({'error': 'User not found'}), 404
     
-    return jsonify({
+    return json_text_response(app, body)
+
+def load_user_body(path, email):
+    """JSON body of a user looked up by email, or None"""
+    with db_connection(path) as conn:
+        cursor = conn.cursor()
+        cursor.execute(queries.USER_BY_EMAIL, (email,))
+        user = cursor.fetchone()
+    
+    if not user:
+        return None
+    
+    return app.json.dumps({
         'id': user['id'],
         'email': user['email'],
         'name': user['name'],
         'created_at': user['created_at']
-    }), 200
+    })
+
+@app.route('/api/admin/billing/run', methods=['POST'])
+@require_admin
+def start_billing_run():
+    """Start (or resume) a billing run in the background"""
+    data = request.get_json(silent=True) or {}
+    
+    try:
+        window_end = datetime.fromisoformat(data['window_end']) if data.get('window_end') else datetime.now()
+        window_start = datetime.fromisoformat(data['window_start']) if data.get('window_start') else None
+        chunk_size = int(data.get('chunk_size', billing.BILLING_CHUNK_SIZE))
+        workers = int(data.get('workers', billing.BILLING_WORKERS))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid billing run parameters'}), 400
+    
+    run_id = data.get('resume_run_id')
+    if run_id is not None:
+        run = billing.get_run(run_id)
+        if not run:
+            return jsonify({'error': 'Billing run not found'}), 404
+        if run['status'] == 'completed':
+            return jsonify({'error': 'Billing run already completed'}), 400
+    else:
+        run_id = billing.create_run(window_end, window_start)
+    
+    def run_in_background():
+        try:
+            billing.run_billing(run_id=run_id, chunk_size=chunk_size, workers=workers)
+        except Exception:
+            app.logger.exception('Billing run %s failed', run_id)
+    
+    threading.Thread(target=run_in_background, name=f'billing-run-{run_id}', daemon=True).start()
+    
+    return jsonify({
+        'run_id': run_id,
+        'status': 'running',
+        'status_url': f'/api/admin/billing/runs/{run_id}'
+    }), 202
+
+@app.route('/api/admin/billing/runs/<int:run_id>', methods=['GET'])
+@require_admin
+def get_billing_run(run_id):
+    """Get progress and throughput of a billing run"""
+    run = billing.get_run(run_id)
+    if not run:
+        return jsonify({'error': 'Billing run not found'}), 404
+    return jsonify(run), 200
+
+def analytics_days():
+    days = request.args.get('days', 30, type=int)
+    if not 1 <= days <= MAX_ANALYTICS_DAYS:
+        return None
+    return days
+
+@app.route('/api/analytics/summary', methods=['GET'])
+@require_admin
+def get_analytics_summary():
+    """MRR and active subscribers, overall and per plan"""
+    with shards.router.connections() as conns:
+        return jsonify(analytics.subscription_summary(conns)), 200
+
+@app.route('/api/analytics/payments', methods=['GET'])
+@require_admin
+def get_analytics_payments():
+    """Payment volume, revenue and failure rates by error_reason over ?days="""
+    days = analytics_days()
+    if days is None:
+        return jsonify({'error': f'days must be between 1 and {MAX_ANALYTICS_DAYS}'}), 400
+    with shards.router.connections() as conns:
+        return jsonify(analytics.payment_stats(conns, days)), 200
+
+@app.route('/api/analytics/churn', methods=['GET'])
+@require_admin
+def get_analytics_churn():
+    """New subscriptions, cancellations, expiries and churn rate over ?days="""
+    days = analytics_days()
+    if days is None:
+        return jsonify({'error': f'days must be between 1 and {MAX_ANALYTICS_DAYS}'}), 400
+    with shards.router.connections() as conns:
+        return jsonify(analytics.churn_stats(conns, days)), 200
+
+@app.route('/api/admin/lifecycle/sweep', methods=['POST'])
+@require_admin
+def run_lifecycle_sweep():
+    """Run a lifecycle sweep now and report what changed"""
+    data = request.get_json(silent=True) or {}
+    try:
+        batch_size = int(data.get('batch_size', lifecycle.SWEEP_BATCH_SIZE))
+        max_rows_per_second = int(data.get('max_rows_per_second', lifecycle.SWEEP_MAX_ROWS_PER_SECOND))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid sweep parameters'}), 400
+    if batch_size < 1:
+        return jsonify({'error': 'batch_size must be positive'}), 400
+    
+    return jsonify(lifecycle.sweep(batch_size=batch_size, max_rows_per_second=max_rows_per_second)), 200
+
+@app.route('/api/admin/import', methods=['POST'])
+@require_admin
+def import_users():
+    """Bulk import users and plan assignments from an NDJSON or CSV body"""
+    fmt = request.args.get('format') or ('csv' if 'csv' in (request.content_type or '') else 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+        return jsonify({'error': 'format must be ndjson or csv'}), 400
+    
+    # Rows are parsed straight off the request stream, never buffered whole
+    source = io.TextIOWrapper(request.stream, encoding='utf-8', newline='' if fmt == 'csv' else None)
+    report = importer.import_rows(importer.read_rows(source, fmt))
+    return jsonify(report), 200
+
+@app.route('/api/admin/export/<table>', methods=['GET'])
+@require_admin
+def export_table(table):
+    """Stream a full table dump as NDJSON or CSV"""
+    if table not in export.EXPORT_TABLES:
+        return jsonify({'error': 'Unknown export table'}), 404
+    
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in export.EXPORT_FORMATS:
+        return jsonify({'error': 'format must be ndjson or csv'}), 400
+    
+    try:
+        start = datetime.fromisoformat(request.args['start']) if request.args.get('start') else None
+        end = datetime.fromisoformat(request.args['end']) if request.args.get('end') else None
+        after_id = int(request.args.get('after_id', 0))
+    except ValueError:
+        return jsonify({'error': 'Invalid start, end or after_id'}), 400
+    
+    include_archive = request.args.get('include_archive', '0') in ('1', 'true')
+    if include_archive and table != 'payments':
+        return jsonify({'error': 'include_archive only applies to payments'}), 400
+    if include_archive and after_id:
+        return jsonify({'error': 'An export that includes archived payments cannot be resumed with after_id'}), 400
+    
+    earliest = export.archived_range_start(table, start)
+    if earliest and not include_archive:
+        return jsonify({
+            'error': f'Payments before {earliest.date()} are archived; pass include_archive=1 to export them too, '
+                     f'or start the range there or later',
+            'archived_before': earliest.date().isoformat()
+        }), 400
+    
+    response = app.response_class(
+        export.stream_export(table, fmt, start, end, after_id, include_archive=include_archive),
+        mimetype=export.EXPORT_FORMATS[fmt]
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename={table}.{fmt}'
+    return response
 
 if __name__ == '__main__':
-    init_db()
+    bootstrapper.ensure()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
 
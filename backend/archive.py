@@ -0,0 +1,275 @@
+"""Hot/cold archival of old payments.
+
+Payments older than ARCHIVE_HORIZON_DAYS are moved out of the payments table
+into gzip-compressed NDJSON segments under ARCHIVE_DIR, one directory per
+month of payment_date:
+
+    <ARCHIVE_DIR>/2024-03/<shard>-<run>.ndjson.gz
+
+Within a segment, each subscription's payments from one run form their own
+gzip member, newest first. The payment_archive table, on the same shard as
+the subscription, indexes every member: its byte range, payment count, and
+oldest and newest (payment_date, id) positions, plus the newest payment
+itself. So one subscription's history is read with a seek and a small
+decompress, and never by scanning a segment.
+
+A run writes and fsyncs a batch's segment data first. Then one transaction
+records the index rows and deletes the payments from the hot table, so a
+crash leaves at most unreferenced bytes in a segment. Runs take a lock file
+in ARCHIVE_DIR, so two runs never archive the same rows.
+
+The payment history endpoints read the hot table first. They open archived
+members only when a page reaches past the newest archived payment, which in
+practice means paging beyond the horizon. Analytics rollups keep archived
+payments, since they are never decremented on delete, and a rollup rebuild
+leaves the days before archived_before() alone. Payment exports read
+the hot table only unless asked to include the archive (iter_archived()),
+so without it they refuse date ranges that start before archived_before().
+"""
+import gzip
+import json
+import os
+import re
+import time
+from datetime import datetime, timedelta
+
+import db
+import metrics
+import queries
+import shards
+from billing import format_timestamp
+from db import db_connection
+from filelock import FileLock
+
+ARCHIVE_HORIZON_DAYS = int(os.environ.get('ARCHIVE_HORIZON_DAYS', 365))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 500))
+ARCHIVE_COMPRESS_LEVEL = 6
+MONTH_DIR = re.compile(r'\d{4}-\d{2}')
+
+# Column order of archived rows, matching the payment history query
+PAGE_COLUMNS = ('id', 'amount', 'status', 'transaction_id', 'payment_date')
+ARCHIVED_COLUMNS = ('id', 'subscription_id', 'amount', 'status', 'transaction_id', 'payment_date', 'failure_reason')
+
+payments_archived = metrics.registry.counter('payments_archived_total', 'Payments moved to archive segments')
+archive_reads = metrics.registry.counter('payment_archive_reads_total', 'Archive members read to serve payment history')
+
+
+def archive_dir():
+    root, _ = os.path.splitext(db.DATABASE)
+    return os.environ.get('ARCHIVE_DIR') or f'{root}-archive'
+
+
+def archived_before():
+    """Start of the month after the newest archived month, or None if nothing was archived.
+
+    Payments dated before it may live in segments rather than in the payments table.
+    """
+    try:
+        months = [name for name in os.listdir(archive_dir()) if MONTH_DIR.fullmatch(name)]
+    except FileNotFoundError:
+        return None
+    if not months:
+        return None
+    year, month = map(int, max(months).split('-'))
+    return datetime(year + month // 12, month % 12 + 1, 1)
+
+
+def _position(row):
+    # (payment_date, id) keyset position of a payment history row
+    return row[4], row[0]
+
+
+def members(conn, subscription_id, after=None):
+    """Index entries holding payments of a subscription before `after`, newest first"""
+    if after is None:
+        return conn.execute(queries.ARCHIVE_MEMBERS, (subscription_id,)).fetchall()
+    return conn.execute(queries.ARCHIVE_MEMBERS_BEFORE, (subscription_id, after[0], after[1])).fetchall()
+
+
+def read_payments(entry):
+    """The archived payments of one index entry, as dicts of ARCHIVED_COLUMNS, newest first"""
+    with open(os.path.join(archive_dir(), entry['segment']), 'rb') as handle:
+        handle.seek(entry['byte_offset'])
+        data = gzip.decompress(handle.read(entry['byte_length']))
+    archive_reads.inc()
+    return [json.loads(line) for line in data.splitlines()]
+
+
+def read_member(entry):
+    """The archived payments of one index entry, as payment history rows, newest first"""
+    return [tuple(payment[column] for column in PAGE_COLUMNS) for payment in read_payments(entry)]
+
+
+def iter_archived(start=None, end=None):
+    """Yield every archived payment dated in [start, end) as a dict, one member at a time.
+
+    Members are read through the index, shard by shard in segment order, so
+    bytes a crashed run left unreferenced are never exported.
+    """
+    start, end = format_timestamp(start), format_timestamp(end)
+    for path in shards.router.paths():
+        with db_connection(path) as conn:
+            entries = conn.execute('SELECT * FROM payment_archive ORDER BY segment, byte_offset')
+            for entry in entries:
+                if start is not None and entry['newest_date'] < start:
+                    continue
+                if end is not None and entry['oldest_date'] >= end:
+                    continue
+                for payment in read_payments(entry):
+                    if start is not None and payment['payment_date'] < start:
+                        continue
+                    if end is not None and payment['payment_date'] >= end:
+                        continue
+                    yield payment
+
+
+def members_of(conn, subscription_ids):
+    """Index entries of many subscriptions in one query, as {subscription_id: entries newest first}"""
+    entries = {}
+    for entry in conn.execute(queries.ARCHIVE_MEMBERS_OF, (json.dumps(subscription_ids),)):
+        entries.setdefault(entry['subscription_id'], []).append(entry)
+    return entries
+
+
+def merge_page(conn, subscription_id, hot, limit, after=None):
+    """Extend a page of hot payment rows (up to limit + 1) with archived ones where they belong.
+
+    Archived members are opened only if the page, including its look-ahead
+    row, would reach past the newest archived payment.
+    """
+    return merge_entries(members(conn, subscription_id, after), hot, limit, after)
+
+
+def merge_entries(entries, hot, limit, after=None):
+    """merge_page() over index entries that were already looked up"""
+    if not entries:
+        return hot
+    if len(hot) > limit and _position(hot[limit]) > (entries[0]['newest_date'], entries[0]['newest_id']):
+        return hot
+    rows = list(hot)
+    for entry in entries:
+        if len(rows) > limit and (entry['newest_date'], entry['newest_id']) < _position(rows[limit]):
+            break
+        rows.extend(row for row in read_member(entry) if after is None or _position(row) < after)
+        rows.sort(key=_position, reverse=True)
+        del rows[limit + 1:]
+    return rows
+
+
+def latest(conn, subscription_id):
+    """Newest archived payment of a subscription as an index row, or None"""
+    return conn.execute(queries.ARCHIVE_LATEST, (subscription_id,)).fetchone()
+
+
+class _SegmentWriter:
+    """Appends gzip members to this run's segment files, one file per month"""
+
+    def __init__(self, root, shard, run):
+        self.root = root
+        self.name = f'{shard}-{run}.ndjson.gz'
+        self._files = {}
+
+    def append(self, month, lines):
+        handle = self._files.get(month)
+        if handle is None:
+            os.makedirs(os.path.join(self.root, month), exist_ok=True)
+            handle = self._files[month] = open(os.path.join(self.root, month, self.name), 'ab')
+        member = gzip.compress(''.join(lines).encode('utf-8'), ARCHIVE_COMPRESS_LEVEL, mtime=0)
+        offset = handle.tell()
+        handle.write(member)
+        return f'{month}/{self.name}', offset, len(member)
+
+    def sync(self):
+        for handle in self._files.values():
+            handle.flush()
+            os.fsync(handle.fileno())
+
+    def close(self):
+        for handle in self._files.values():
+            handle.close()
+        self._files.clear()
+
+
+def _archive_batch(conn, writer, subscription_ids, cutoff):
+    rows = conn.execute(queries.ARCHIVE_OLD_PAYMENTS.format(columns=', '.join(ARCHIVED_COLUMNS)),
+                        (json.dumps(subscription_ids), cutoff)).fetchall()
+    if not rows:
+        return 0
+
+    # One member per (month, subscription); rows arrive newest first
+    groups = {}
+    for row in rows:
+        groups.setdefault((row['payment_date'][:7], row['subscription_id']), []).append(row)
+    index = []
+    for (month, subscription_id), payments in groups.items():
+        lines = [json.dumps(dict(zip(ARCHIVED_COLUMNS, payment))) + '\n' for payment in payments]
+        segment, offset, length = writer.append(month, lines)
+        newest, oldest = payments[0], payments[-1]
+        index.append((subscription_id, newest['payment_date'], newest['id'], oldest['payment_date'], oldest['id'],
+                      len(payments), segment, offset, length,
+                      newest['amount'], newest['status'], newest['transaction_id']))
+    writer.sync()
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany('''
+            INSERT INTO payment_archive (
+                subscription_id, newest_date, newest_id, oldest_date, oldest_id, payments,
+                segment, byte_offset, byte_length, newest_amount, newest_status, newest_transaction_id
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', index)
+        conn.execute('DELETE FROM payments WHERE id IN (SELECT value FROM json_each(?))',
+                     (json.dumps([row['id'] for row in rows]),))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(rows)
+
+
+def run_archive(horizon_days=ARCHIVE_HORIZON_DAYS, batch_size=ARCHIVE_BATCH_SIZE, now=None):
+    """Archive every payment older than the horizon; returns counts and timing"""
+    now = now or datetime.now()
+    cutoff = format_timestamp(now - timedelta(days=horizon_days))
+    root = archive_dir()
+    os.makedirs(root, exist_ok=True)
+    lock = FileLock(os.path.join(root, '.lock'))
+    if not lock.acquire(blocking=False):
+        raise RuntimeError('Another archive run is in progress')
+
+    started = time.perf_counter()
+    run = now.strftime('%Y%m%dT%H%M%S') + f'-{os.getpid()}'
+    archived = 0
+    batches = 0
+    try:
+        for shard, path in enumerate(shards.router.paths()):
+            writer = _SegmentWriter(root, shard, run)
+            try:
+                with db_connection(path) as conn:
+                    last_id = -1
+                    while True:
+                        # Walk subscriptions in id order; old payments are found per
+                        # subscription through the payment history index
+                        ids = [row[0] for row in conn.execute(
+                            queries.ARCHIVE_SUBSCRIPTION_BATCH, (last_id, batch_size))]
+                        if not ids:
+                            break
+                        last_id = ids[-1]
+                        moved = _archive_batch(conn, writer, ids, cutoff)
+                        archived += moved
+                        batches += 1
+                        if moved:
+                            payments_archived.inc(amount=moved)
+            finally:
+                writer.close()
+    finally:
+        lock.release()
+
+    elapsed = time.perf_counter() - started
+    return {
+        'cutoff': cutoff,
+        'archived': archived,
+        'batches': batches,
+        'archive_dir': root,
+        'duration_seconds': round(elapsed, 3)
+    }
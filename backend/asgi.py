@@ -0,0 +1,292 @@
+"""ASGI entry point for high-concurrency deployments.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+Serves the same API as the WSGI app. The two endpoints that spend most of
+their time waiting run natively on the event loop:
+
+- POST /api/payment/simulate awaits the simulated gateway with asyncio.sleep
+  and only uses a thread for its two short database calls.
+- GET /api/subscriptions/<id>/events keeps each open stream as a coroutine,
+  not a thread.
+
+Every other request, and any payment request the native path does not
+handle (queued payments, Idempotency-Key, malformed bodies), is passed to the
+Flask app on a thread pool. That keeps routes, payloads and status codes
+identical to the WSGI deployment. SQLite calls from the native handlers run
+on a dedicated DB executor sized like the connection pool.
+"""
+import asyncio
+import io
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app as api
+import metrics
+import shards
+from db import POOL_SIZE, db_connection
+from events import AsyncSubscriber, format_sse
+
+# Threads for requests handed to the Flask app (some block, e.g. ?wait=)
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 32))
+# Threads for SQLite calls made by the native handlers
+DB_THREADS = int(os.environ.get('DB_THREADS', POOL_SIZE))
+
+EVENTS_PATH = re.compile(r'^/api/subscriptions/(\d+)/events$')
+PAYMENT_PATH = '/api/payment/simulate'
+
+_END = object()
+
+
+def _header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _cors_headers(scope):
+    # Same headers flask-cors adds to the WSGI responses
+    origin = _header(scope, b'origin')
+    if origin:
+        return [(b'access-control-allow-origin', origin.encode('latin-1')), (b'vary', b'Origin')]
+    return [(b'access-control-allow-origin', b'*')]
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+def _wsgi_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    for key, value in scope['headers']:
+        name = key.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+        name = f'HTTP_{name}'
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+    return environ
+
+
+class AsyncAPI:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self._wsgi_executor = None
+        self._db_executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.run_db(api.bootstrapper.ensure)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for executor in (self._wsgi_executor, self._db_executor):
+                    if executor:
+                        executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def run_db(self, func, *args):
+        if self._db_executor is None:
+            self._db_executor = ThreadPoolExecutor(DB_THREADS, thread_name_prefix='db')
+        return asyncio.get_running_loop().run_in_executor(self._db_executor, func, *args)
+
+    def _run_wsgi(self, func, *args):
+        if self._wsgi_executor is None:
+            self._wsgi_executor = ThreadPoolExecutor(WSGI_THREADS, thread_name_prefix='wsgi')
+        return asyncio.get_running_loop().run_in_executor(self._wsgi_executor, func, *args)
+
+    async def _http(self, scope, receive, send):
+        path, method = scope['path'], scope['method']
+        if method == 'POST' and path == PAYMENT_PATH:
+            body = await _read_body(receive)
+            if await self._simulate_payment(scope, body, send):
+                return
+            await self._wsgi(scope, body, send)
+            return
+        match = EVENTS_PATH.match(path)
+        if method == 'GET' and match:
+            await self._subscription_events(scope, receive, send, int(match.group(1)))
+            return
+        await self._wsgi(scope, await _read_body(receive), send)
+
+    async def _send_json(self, scope, send, payload, status, endpoint, started):
+        # Serialized by Flask's JSON provider so bodies match the WSGI app byte for byte
+        response = api.app.json.response(payload)
+        headers = [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in response.headers.items()]
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers + _cors_headers(scope)})
+        await send({'type': 'http.response.body', 'body': response.get_data()})
+        metrics.http_request_duration.observe(time.perf_counter() - started, scope['method'], endpoint)
+        metrics.http_requests.inc(scope['method'], endpoint, status)
+
+    async def _simulate_payment(self, scope, body, send):
+        """Handle a synchronous payment on the event loop; False defers to Flask"""
+        started = time.perf_counter()
+        content_type = _header(scope, b'content-type') or ''
+        if _header(scope, b'idempotency-key') or not content_type.startswith('application/json'):
+            return False
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return False
+        if not isinstance(data, dict) or data.get('async', api.PAYMENT_PROCESSING_MODE == 'async'):
+            return False
+        subscription_id = data.get('subscription_id')
+        if not subscription_id:
+            return False
+
+        subscription, error = await self.run_db(_find_payable_subscription, subscription_id)
+        if error:
+            payload, status = error
+            await self._send_json(scope, send, payload, status, PAYMENT_PATH, started)
+            return True
+
+        processing_delay = api.payment_simulator.delay()
+        if processing_delay:
+            await asyncio.sleep(processing_delay)
+        metrics.payment_gateway_duration.observe(processing_delay)
+        result, status = await self.run_db(
+            api.record_payment, subscription_id, subscription['price'],
+            data.get('force_success'), data.get('force_failure_reason')
+        )
+        await self._send_json(scope, send, result, status, PAYMENT_PATH, started)
+        return True
+
+    async def _subscription_events(self, scope, receive, send, subscription_id):
+        started = time.perf_counter()
+        endpoint = '/api/subscriptions/<int:subscription_id>/events'
+        subscriber = AsyncSubscriber(subscription_id, asyncio.get_running_loop())
+        # Subscribe before reading the first snapshot so no change falls in between
+        api.event_broker.subscribe(subscription_id, subscriber)
+        try:
+            snapshot = await self.run_db(_load_status_snapshot, subscription_id)
+            if not snapshot:
+                await self._send_json(scope, send, {'error': 'Subscription not found'}, 404, endpoint, started)
+                return
+
+            async def watch_disconnect():
+                while (await receive())['type'] != 'http.disconnect':
+                    pass
+                subscriber.close()
+            watcher = asyncio.ensure_future(watch_disconnect())
+
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [
+                    (b'content-type', b'text/event-stream; charset=utf-8'),
+                    (b'cache-control', b'no-cache'),
+                    (b'x-accel-buffering', b'no')
+                ] + _cors_headers(scope)
+            })
+            metrics.http_requests.inc(scope['method'], endpoint, 200)
+            first = f'retry: {api.SSE_RETRY_MS}\n\n' + format_sse('status', snapshot)
+            await send({'type': 'http.response.body', 'body': first.encode(), 'more_body': True})
+
+            last = snapshot
+            deadline = time.monotonic() + api.SSE_MAX_STREAM_SECONDS
+            try:
+                while not subscriber.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    message = await subscriber.get(min(api.SSE_HEARTBEAT_SECONDS, remaining))
+                    if subscriber.closed:
+                        break
+                    if message:
+                        event, data = message
+                    else:
+                        # Changes made by other worker processes never reach this broker
+                        event, data = 'status', await self.run_db(_load_status_snapshot, subscription_id)
+                        if data is None:
+                            break
+                    if data == last:
+                        if not message:
+                            await send({'type': 'http.response.body', 'body': b': keep-alive\n\n', 'more_body': True})
+                        continue
+                    last = data
+                    await send({'type': 'http.response.body', 'body': format_sse(event, data).encode(), 'more_body': True})
+                if not subscriber.closed:
+                    await send({'type': 'http.response.body', 'body': b''})
+            finally:
+                watcher.cancel()
+        finally:
+            api.event_broker.unsubscribe(subscriber)
+
+    async def _wsgi(self, scope, body, send):
+        """Run the request through the Flask app on the WSGI thread pool"""
+        environ = _wsgi_environ(scope, body)
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers]
+
+        def call_app():
+            iterable = self.wsgi_app(environ, start_response)
+            iterator = iter(iterable)
+            return iterable, iterator, next(iterator, _END)
+
+        iterable, iterator, chunk = await self._run_wsgi(call_app)
+        try:
+            await send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+            # Streamed responses (exports) are pulled one chunk at a time
+            while chunk is not _END:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await self._run_wsgi(next, iterator, _END)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(iterable, 'close'):
+                await self._run_wsgi(iterable.close)
+
+
+def _find_payable_subscription(subscription_id):
+    with db_connection(shards.router.path_for_id(subscription_id)) as conn:
+        return api.find_payable_subscription(conn.cursor(), subscription_id)
+
+
+def _load_status_snapshot(subscription_id):
+    with db_connection(shards.router.path_for_id(subscription_id)) as conn:
+        return api.load_status_snapshot(conn, subscription_id)
+
+
+app = AsyncAPI(api.app)
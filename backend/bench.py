@@ -0,0 +1,456 @@
+"""Load-test and benchmark harness for the subscription API.
+
+Drives a weighted mix of real API calls against a throwaway SQLite file and
+prints per-endpoint latency percentiles and throughput as JSON:
+
+    python bench.py --duration 20 --concurrency 16 --payment-latency-scale 0
+    python bench.py --server gunicorn --workers 4 --payment-mode async -o after.json
+    python bench.py --server uvicorn --workers 1 --concurrency 2000 --mix payment=1 --payment-latency-scale 1
+    python bench.py --server gunicorn --workers 4 --shards 4 --mix subscribe=1,payment=1,renew=1
+    python bench.py --mix status_batch=1,status_loop=1 --batch-size 200 --history 1
+
+The default "client" server runs the Flask app in-process through its test
+client. "gunicorn" starts a real gunicorn master on a free port and talks to
+it over HTTP, and "uvicorn" does the same for the ASGI entry point (asgi.py).
+"""
+import argparse
+import http.client
+import itertools
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_MIX = 'plans=40,subscribe=15,payment=15,status=20,renew=5,user_subscriptions=5'
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    # Nearest-rank percentile
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+class ClientTransport:
+    """Runs requests through the Flask test client in this process"""
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, json=body, headers=headers)
+        return response.status_code, response.get_json(silent=True)
+
+    def close(self):
+        pass
+
+
+class HTTPTransport:
+    """Runs requests over keep-alive HTTP connections, one per thread"""
+
+    def __init__(self, host, port, process=None):
+        self.host = host
+        self.port = port
+        self.process = process
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        payload = json.dumps(body) if body is not None else None
+        request_headers = {'Content-Type': 'application/json', **(headers or {})}
+        try:
+            conn.request(method, path, body=payload, headers=request_headers)
+            response = conn.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            self._local.conn = None
+            conn.close()
+            raise
+        try:
+            parsed = json.loads(data) if data else None
+        except ValueError:
+            parsed = None
+        return response.status, parsed
+
+    def close(self):
+        if self.process:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                # Queued async payments keep workers busy past the graceful stop
+                self.process.kill()
+                self.process.wait()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(command, port, env):
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env)
+    transport = HTTPTransport('127.0.0.1', port, process)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if transport.request('GET', '/api/health')[0] == 200:
+                transport._local.conn = None
+                return transport
+        except OSError:
+            time.sleep(0.1)
+    transport.close()
+    raise RuntimeError(f'{command[2]} did not start')
+
+
+def start_gunicorn(env, workers, threads, worker_class):
+    port = free_port()
+    command = [
+        sys.executable, '-m', 'gunicorn', 'app:app',
+        '--bind', f'127.0.0.1:{port}',
+        '--workers', str(workers),
+        '--threads', str(threads),
+        '--worker-class', worker_class,
+        '--log-level', 'warning'
+    ]
+    return start_server(command, port, env)
+
+
+def start_uvicorn(env, workers, backlog):
+    port = free_port()
+    command = [
+        sys.executable, '-m', 'uvicorn', 'asgi:app',
+        '--host', '127.0.0.1',
+        '--port', str(port),
+        '--workers', str(workers),
+        '--backlog', str(backlog),
+        '--log-level', 'warning'
+    ]
+    return start_server(command, port, env)
+
+
+class Workload:
+    """Shared state for the virtual users: which subscriptions exist and in what state"""
+
+    def __init__(self, transport, mix, payment_mode, rng_seed, batch_size=100):
+        self.transport = transport
+        self.mix = mix
+        self.payment_mode = payment_mode
+        self.rng_seed = rng_seed
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.pending = []
+        self.active = []
+        self.user_ids = []
+        self.emails = itertools.count()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, name, started, status, ok_statuses):
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.latencies[name].append(elapsed)
+            if status not in ok_statuses:
+                self.errors[name] += 1
+
+    def subscribe(self, rng, queue_for_payment=True):
+        email = f'bench-{os.getpid()}-{next(self.emails)}@example.com'
+        body = {'email': email, 'name': 'Bench User', 'plan_id': rng.randint(1, 6)}
+        started = time.perf_counter()
+        status, data = self.transport.request('POST', '/api/subscribe', body)
+        self.record('subscribe', started, status, (201,))
+        if status != 201:
+            return None
+        if queue_for_payment:
+            with self.lock:
+                self.pending.append(data['subscription_id'])
+        return data['subscription_id']
+
+    def payment(self, rng):
+        with self.lock:
+            subscription_id = self.pending.pop() if self.pending else None
+        if subscription_id is None:
+            subscription_id = self.subscribe(rng, queue_for_payment=False)
+            if subscription_id is None:
+                return
+        body = {'subscription_id': subscription_id, 'async': self.payment_mode == 'async'}
+        started = time.perf_counter()
+        status, _ = self.transport.request('POST', '/api/payment/simulate', body)
+        self.record('payment', started, status, (200, 202, 400))
+        if status in (200, 202):
+            with self.lock:
+                self.active.append(subscription_id)
+
+    def _random_active(self, rng):
+        with self.lock:
+            return rng.choice(self.active) if self.active else None
+
+    def status(self, rng):
+        subscription_id = self._random_active(rng)
+        if subscription_id is None:
+            return
+        started = time.perf_counter()
+        status, _ = self.transport.request('GET', f'/api/subscriptions/status/{subscription_id}')
+        self.record('status', started, status, (200,))
+
+    def _status_ids(self, rng):
+        with self.lock:
+            return [rng.choice(self.active) for _ in range(self.batch_size)] if self.active else None
+
+    def status_batch(self, rng):
+        subscription_ids = self._status_ids(rng)
+        if subscription_ids is None:
+            return
+        started = time.perf_counter()
+        status, _ = self.transport.request('POST', '/api/subscriptions/status:batch', {'subscription_ids': subscription_ids})
+        self.record('status_batch', started, status, (200,))
+
+    def status_loop(self, rng):
+        # The same statuses as status_batch, one GET per ID; timed as one operation
+        subscription_ids = self._status_ids(rng)
+        if subscription_ids is None:
+            return
+        started = time.perf_counter()
+        failed = 0
+        for subscription_id in subscription_ids:
+            status, _ = self.transport.request('GET', f'/api/subscriptions/status/{subscription_id}')
+            failed += status != 200
+        self.record('status_loop', started, 400 if failed else 200, (200,))
+
+    def renew(self, rng):
+        subscription_id = self._random_active(rng)
+        if subscription_id is None:
+            return
+        started = time.perf_counter()
+        status, _ = self.transport.request('POST', f'/api/subscriptions/{subscription_id}/renew')
+        # A queued async payment may not have activated the subscription yet
+        self.record('renew', started, status, (200, 400))
+
+    def user_subscriptions(self, rng):
+        with self.lock:
+            user_id = rng.choice(self.user_ids) if self.user_ids else None
+        if user_id is None:
+            return
+        started = time.perf_counter()
+        status, _ = self.transport.request('GET', f'/api/subscriptions/{user_id}')
+        self.record('user_subscriptions', started, status, (200,))
+
+    def plans(self, rng):
+        started = time.perf_counter()
+        status, _ = self.transport.request('GET', '/api/plans')
+        self.record('plans', started, status, (200, 304))
+
+    def run_user(self, index, deadline, max_requests):
+        rng = random.Random(self.rng_seed + index)
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        done = 0
+        while time.monotonic() < deadline and (max_requests is None or done < max_requests):
+            operation = rng.choices(names, weights)[0]
+            try:
+                getattr(self, operation)(rng)
+            except OSError:
+                with self.lock:
+                    self.errors[operation] += 1
+            done += 1
+
+
+def seed_database(subscriptions, history):
+    """Pre-populate users and active subscriptions directly in SQLite.
+
+    Each seeded user gets `history` subscriptions with one payment each, so
+    /api/subscriptions/<user_id> is measured against long histories. With
+    --shards every user is written to its own shard, IDs included.
+    """
+    sys.path.insert(0, BACKEND_DIR)
+    from datetime import datetime, timedelta
+
+    import shards
+    from db import db_connection
+
+    now = datetime.now()
+    users = max(1, subscriptions // max(1, history))
+    emails = [f'seed-{i}@example.com' for i in range(users)]
+    by_shard = defaultdict(list)
+    for index, email in enumerate(emails):
+        by_shard[shards.router.shard_for_bucket(shards.bucket_for_email(email))].append(index)
+
+    user_ids = [None] * users
+    active = []
+    for shard, members in sorted(by_shard.items()):
+        with db_connection(shards.shard_path(shard)) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            ids = shards.router.new_ids(conn, 'users', [shards.bucket_for_email(emails[i]) for i in members])
+            for index, user_id in zip(members, ids):
+                user_ids[index] = conn.execute('INSERT INTO users (id, email, name) VALUES (?, ?, ?)',
+                                               (user_id, emails[index], 'Seed User')).lastrowid
+            members = set(members)
+            owned = [i for i in range(subscriptions) if i % users in members]
+            ids = shards.router.new_ids(conn, 'subscriptions', [shards.bucket_for_id(user_ids[i % users]) for i in owned])
+            subscription_ids = []
+            for i, subscription_id in zip(owned, ids):
+                status = 'active' if i % history == history - 1 else 'cancelled'
+                subscription_id = conn.execute('''
+                    INSERT INTO subscriptions (id, user_id, plan_id, status, start_date, end_date, next_billing_date, auto_renew)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+                ''', (subscription_id, user_ids[i % users], 1 + i % 6, status, now,
+                      now + timedelta(days=30), now + timedelta(days=30))).lastrowid
+                subscription_ids.append(subscription_id)
+                if status == 'active':
+                    active.append(subscription_id)
+            ids = shards.router.new_ids(conn, 'payments', [shards.bucket_for_id(i) for i in subscription_ids])
+            conn.executemany('''
+                INSERT INTO payments (id, subscription_id, amount, status, transaction_id)
+                VALUES (?, ?, 9.99, 'completed', 'SEED' || ?)
+            ''', [(payment_id, i, i) for payment_id, i in zip(ids, subscription_ids)])
+            conn.commit()
+    return user_ids, active
+
+
+def summarize(workload, elapsed):
+    endpoints = {}
+    all_latencies = []
+    for name, values in sorted(workload.latencies.items()):
+        values.sort()
+        all_latencies.extend(values)
+        endpoints[name] = {
+            'requests': len(values),
+            'errors': workload.errors.get(name, 0),
+            'requests_per_second': round(len(values) / elapsed, 2),
+            'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+            'max_ms': round(values[-1] * 1000, 3)
+        }
+    all_latencies.sort()
+    total = {
+        'requests': len(all_latencies),
+        'errors': sum(workload.errors.values()),
+        'requests_per_second': round(len(all_latencies) / elapsed, 2) if elapsed else None,
+        'p50_ms': round(percentile(all_latencies, 0.50) * 1000, 3) if all_latencies else None,
+        'p95_ms': round(percentile(all_latencies, 0.95) * 1000, 3) if all_latencies else None,
+        'p99_ms': round(percentile(all_latencies, 0.99) * 1000, 3) if all_latencies else None
+    }
+    return endpoints, total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=['client', 'gunicorn', 'uvicorn'], default='client')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn/uvicorn worker processes')
+    parser.add_argument('--threads', type=int, default=1, help='gunicorn threads per worker')
+    parser.add_argument('--worker-class', default='sync', help='gunicorn worker class')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run')
+    parser.add_argument('--requests', type=int, help='stop each virtual user after this many requests')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f'weighted endpoint mix (default: {DEFAULT_MIX})')
+    parser.add_argument('--payment-latency-scale', type=float, default=0.0,
+                        help='multiplier for the simulated gateway delay; 1 is production-like, 0 disables it')
+    parser.add_argument('--payment-profile', default='default',
+                        help='payment simulator profile (success rate, latency and failure mix, see simulator.py)')
+    parser.add_argument('--payment-mode', choices=['sync', 'async'], default='sync')
+    parser.add_argument('--shards', type=int, default=1, help='spread users over this many SQLite files (DB_SHARDS)')
+    parser.add_argument('--seed-subscriptions', type=int, default=1000)
+    parser.add_argument('--history', type=int, default=10, help='seeded subscriptions per user')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='subscriptions per status_batch request and status_loop run')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the request mix and the payment simulator')
+    parser.add_argument('-o', '--output', help='also write the JSON report to this file')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='subscription-bench-')
+    database = os.path.join(workdir, 'bench.db')
+    env = dict(os.environ)
+    env['DATABASE_PATH'] = database
+    env['PAYMENT_LATENCY_SCALE'] = str(args.payment_latency_scale)
+    env['PAYMENT_PROCESSING_MODE'] = args.payment_mode
+    env['PAYMENT_SIMULATOR_PROFILE'] = args.payment_profile
+    env['PAYMENT_SIMULATOR_SEED'] = str(args.seed)
+    env['DB_SHARDS'] = str(args.shards)
+    os.environ.update(env)
+
+    sys.path.insert(0, BACKEND_DIR)
+    import app as api
+    api.init_db()
+    user_ids, active = seed_database(args.seed_subscriptions, args.history)
+
+    if args.server == 'gunicorn':
+        transport = start_gunicorn(env, args.workers, args.threads, args.worker_class)
+    elif args.server == 'uvicorn':
+        transport = start_uvicorn(env, args.workers, max(2048, args.concurrency))
+    else:
+        transport = ClientTransport(api.app)
+
+    workload = Workload(transport, args.mix, args.payment_mode, args.seed, args.batch_size)
+    workload.user_ids = user_ids
+    workload.active = active
+
+    deadline = time.monotonic() + args.duration
+    threads = [
+        threading.Thread(target=workload.run_user, args=(i, deadline, args.requests))
+        for i in range(args.concurrency)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    transport.close()
+
+    endpoints, total = summarize(workload, elapsed)
+    report = {
+        'config': {
+            'server': args.server,
+            'workers': args.workers if args.server != 'client' else None,
+            'threads': args.threads if args.server == 'gunicorn' else None,
+            'worker_class': args.worker_class if args.server == 'gunicorn' else None,
+            'concurrency': args.concurrency,
+            'duration_seconds': round(elapsed, 3),
+            'mix': args.mix,
+            'payment_latency_scale': args.payment_latency_scale,
+            'payment_profile': args.payment_profile,
+            'payment_mode': args.payment_mode,
+            'shards': args.shards,
+            'seed_subscriptions': args.seed_subscriptions,
+            'history': args.history,
+            'batch_size': args.batch_size
+        },
+        'endpoints': endpoints,
+        'total': total
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as handle:
+            handle.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""Batch billing runs.
+
+A run renews every auto-renewing subscription whose next_billing_date falls
+inside a time window. Due subscriptions are walked in (next_billing_date, id)
+order and handed out in chunks to a pool of workers. Each worker renews its
+chunk inside one write transaction with executemany. Progress is
+checkpointed in billing_runs, so an interrupted run can be resumed. With
+sharded storage the shards are billed one after another, and the checkpoint
+records which shard the run has reached.
+"""
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import queries
+import read_cache
+import shards
+from db import db_connection
+
+BILLING_CHUNK_SIZE = int(os.environ.get('BILLING_CHUNK_SIZE', 1000))
+BILLING_WORKERS = int(os.environ.get('BILLING_WORKERS', 4))
+
+BILLING_CYCLE_DAYS = {'monthly': 30, 'yearly': 365}
+
+
+def format_timestamp(value):
+    # Same text format the sqlite3 datetime adapter writes, so range
+    # comparisons against stored dates are plain string comparisons
+    return value.isoformat(' ') if isinstance(value, datetime) else value
+
+
+def create_run(window_end, window_start=None):
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO billing_runs (window_start, window_end, status, cursor_date, cursor_id)
+            VALUES (?, ?, 'running', ?, 0)
+        ''', (format_timestamp(window_start), format_timestamp(window_end), format_timestamp(window_start) or ''))
+        conn.commit()
+        return cursor.lastrowid
+
+
+def get_run(run_id):
+    with db_connection() as conn:
+        run = conn.execute('SELECT * FROM billing_runs WHERE id = ?', (run_id,)).fetchone()
+    return dict(run) if run else None
+
+
+def _update_run(run_id, **fields):
+    assignments = ', '.join(f'{name} = ?' for name in fields)
+    with db_connection() as conn:
+        conn.execute(
+            f'UPDATE billing_runs SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+            (*fields.values(), run_id)
+        )
+        conn.commit()
+
+
+def _next_due_chunk(path, cursor_date, cursor_id, window_end, chunk_size):
+    with db_connection(path) as conn:
+        return conn.execute(queries.BILLING_NEXT_DUE, (cursor_date, cursor_id, window_end, chunk_size)).fetchall()
+
+
+def bill_chunk(subscription_ids, window_end, path=None):
+    """Renew one chunk of subscriptions in a single transaction.
+
+    Rows are re-checked under the write lock, so a subscription that was
+    renewed or cancelled since it was selected is skipped rather than billed
+    twice. Returns (renewed count, amount billed).
+    """
+    with db_connection(path) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        rows = conn.execute(queries.BILLING_RENEW_CHUNK, (json.dumps(subscription_ids), window_end)).fetchall()
+
+        updates = []
+        payments = []
+        for row in rows:
+            new_end = datetime.fromisoformat(row['end_date']) + timedelta(days=BILLING_CYCLE_DAYS[row['billing_cycle']])
+            updates.append((new_end, new_end, row['id']))
+            # One payment per subscription and billing period
+            period = datetime.fromisoformat(row['next_billing_date'])
+            transaction_id = f'TXN{period.strftime("%Y%m%d")}R{row["id"]}'
+            payments.append((row['id'], row['price'], transaction_id))
+
+        conn.executemany('''
+            UPDATE subscriptions
+            SET end_date = ?, next_billing_date = ?, status = 'active'
+            WHERE id = ?
+        ''', updates)
+        payment_ids = shards.router.new_ids(conn, 'payments', [shards.bucket_for_id(row['id']) for row in rows])
+        conn.executemany('''
+            INSERT INTO payments (id, subscription_id, amount, status, transaction_id)
+            VALUES (?, ?, ?, 'completed', ?)
+        ''', [(payment_id, *payment) for payment_id, payment in zip(payment_ids, payments)])
+        conn.commit()
+    for row in rows:
+        read_cache.subscription_changed(row['id'], row['user_id'])
+
+    return len(rows), sum(payment[1] for payment in payments)
+
+
+def run_billing(window_end=None, window_start=None, run_id=None,
+                chunk_size=BILLING_CHUNK_SIZE, workers=BILLING_WORKERS, progress=None):
+    """Run (or resume) a billing run and return its final billing_runs row.
+
+    Pass run_id to resume an interrupted run from its last checkpoint; the
+    window is then taken from the stored run.
+    """
+    if run_id is None:
+        run_id = create_run(window_end or datetime.now(), window_start)
+    run = get_run(run_id)
+    if run is None:
+        raise ValueError(f'Billing run {run_id} not found')
+    if run['status'] == 'completed':
+        return run
+
+    window_end = run['window_end']
+    cursor_shard, cursor_date, cursor_id = run['cursor_shard'], run['cursor_date'], run['cursor_id']
+    processed, amount = run['processed'], run['amount']
+    started = time.monotonic()
+    processed_at_start = processed
+    _update_run(run_id, status='running')
+
+    # Chunks finish out of order; the checkpoint only advances past a chunk
+    # once every chunk before it has been committed
+    in_flight = deque()
+
+    def advance_checkpoint(max_in_flight):
+        nonlocal processed, amount
+        while in_flight and (in_flight[0][0].done() or len(in_flight) > max_in_flight):
+            future, chunk_cursor = in_flight.popleft()
+            renewed, billed = future.result()
+            processed += renewed
+            amount += billed
+            _update_run(run_id, cursor_shard=chunk_cursor[0], cursor_date=chunk_cursor[1],
+                        cursor_id=chunk_cursor[2], processed=processed, amount=round(amount, 2))
+            if progress:
+                progress(processed, time.monotonic() - started)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='billing-worker') as executor:
+            paths = shards.router.paths()
+            for shard in range(cursor_shard, len(paths)):
+                if shard != cursor_shard:
+                    cursor_date, cursor_id = run['window_start'] or '', 0
+                while True:
+                    chunk = _next_due_chunk(paths[shard], cursor_date, cursor_id, window_end, chunk_size)
+                    if not chunk:
+                        break
+                    cursor_date, cursor_id = chunk[-1]['next_billing_date'], chunk[-1]['id']
+                    future = executor.submit(bill_chunk, [row['id'] for row in chunk], window_end, paths[shard])
+                    in_flight.append((future, (shard, cursor_date, cursor_id)))
+                    advance_checkpoint(max_in_flight=workers * 2)
+            advance_checkpoint(max_in_flight=0)
+    except Exception as exc:
+        _update_run(run_id, status='failed', error=str(exc))
+        raise
+
+    elapsed = time.monotonic() - started
+    _update_run(run_id, status='completed', finished_at=datetime.now(),
+                duration_seconds=round(elapsed, 3),
+                per_second=round((processed - processed_at_start) / elapsed, 1) if elapsed else None)
+    return get_run(run_id)
@@ -0,0 +1,112 @@
+"""One-time database bootstrap per deployment, and timed process startup.
+
+init_db() applies migrations, creates the shard map, seeds ID sequences and
+copies the plan catalog to every shard, which takes the write lock on every
+file. Bootstrap makes sure it runs once per deployment state instead of in
+every process:
+
+- After a successful init, a stamp in shard_meta on the control shard
+  records the schema version, shard count and plan catalog it was run for.
+  When the stamp still matches, startup costs two small reads.
+- Otherwise the process takes a lock file next to the database, checks the
+  stamp again and only then runs init. Workers that boot together wait for
+  the first one and then take the fast path.
+
+With gunicorn.conf.py, the master does this before forking (preload_app),
+and each worker warms its caches and connection pool before it accepts
+connections. Under any other server, each process bootstraps lazily on its
+first request.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+import shards
+from db import db_connection
+from filelock import FileLock
+from migrations import LATEST_VERSION
+
+
+def _stamp(conn):
+    """The stamp the current schema version, shard count and plan catalog call for"""
+    plans = conn.execute('SELECT id, name, price, billing_cycle, features, is_active FROM plans ORDER BY id').fetchall()
+    digest = hashlib.sha1(repr((LATEST_VERSION, shards.router.count, [tuple(plan) for plan in plans])).encode())
+    # shard_meta holds integers; 62 bits keep it positive
+    return int.from_bytes(digest.digest()[:8], 'big') >> 2
+
+
+def _is_current(conn):
+    try:
+        recorded = conn.execute("SELECT value FROM shard_meta WHERE name = 'bootstrap'").fetchone()
+        return bool(recorded) and recorded[0] == _stamp(conn)
+    except sqlite3.OperationalError:
+        # No schema yet
+        return False
+
+
+class Bootstrap:
+    """Runs initialize() once per deployment state and warm() once per process"""
+
+    def __init__(self, lock_path, initialize, warm, logger=None):
+        self.lock_path = lock_path
+        self.logger = logger
+        self._initialize = initialize
+        self._warm = warm
+        self._lock = threading.Lock()
+        self._ready_pid = None
+        self.report = {}
+        metrics.registry.gauge('process_startup_seconds', 'Time this process took to bootstrap and warm up',
+                               lambda: self.report.get('startup_seconds', 0))
+
+    def prepare(self):
+        """Bring the database up to date; returns how ('current' or 'initialized') and how long it took"""
+        started = time.perf_counter()
+        result = 'current'
+        if not self._check():
+            with FileLock(self.lock_path):
+                if not self._check():
+                    self._initialize()
+                    with db_connection() as conn:
+                        conn.execute("INSERT OR REPLACE INTO shard_meta (name, value) VALUES ('bootstrap', ?)",
+                                     (_stamp(conn),))
+                        conn.commit()
+                    result = 'initialized'
+        return result, time.perf_counter() - started
+
+    def _check(self):
+        # A missing shard file needs the full init even if the stamp matches
+        if not all(os.path.exists(shards.shard_path(index)) for index in range(shards.router.count)):
+            return False
+        with db_connection() as conn:
+            return _is_current(conn)
+
+    def ensure(self, started=None):
+        """Prepare the database and warm this process, once per process.
+
+        started is a time.perf_counter() value from when the process began
+        booting (e.g. right after fork), so the report covers all of startup.
+        """
+        if self._ready_pid == os.getpid():
+            return
+        with self._lock:
+            if self._ready_pid == os.getpid():
+                return
+            began = time.perf_counter()
+            schema, schema_seconds = self.prepare()
+            warm_started = time.perf_counter()
+            self._warm()
+            finished = time.perf_counter()
+            self.report = {
+                'schema': schema,
+                'schema_seconds': round(schema_seconds, 4),
+                'warm_seconds': round(finished - warm_started, 4),
+                'startup_seconds': round(finished - (began if started is None else started), 4)
+            }
+            self._ready_pid = os.getpid()
+        if self.logger:
+            self.logger.info('Process %s ready in %.1f ms (schema %s in %.1f ms, warm-up %.1f ms)',
+                             os.getpid(), self.report['startup_seconds'] * 1000, schema,
+                             schema_seconds * 1000, self.report['warm_seconds'] * 1000)
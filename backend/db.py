@@ -0,0 +1,152 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+DATABASE = os.environ.get('DATABASE_PATH', os.path.join(os.path.dirname(__file__), 'subscription.db'))
+
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 16))
+# Connections each worker opens per shard before its first request
+POOL_WARM = int(os.environ.get('DB_POOL_WARM', 2))
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KB = 16 * 1024
+MMAP_SIZE = 256 * 1024 * 1024
+STATEMENT_CACHE_SIZE = 256
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that reports statement counts and execution time to metrics"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.record_query(time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            metrics.record_query(time.perf_counter() - started)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connect(path):
+    """Open a connection with the pragmas every request relies on"""
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        check_same_thread=False,
+        factory=InstrumentedConnection
+    )
+    metrics.connections_opened.inc()
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    conn.execute(f'PRAGMA cache_size = -{CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    return conn
+
+
+class ConnectionPool:
+    """Per-process pool of idle SQLite connections for one database file"""
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._pid = os.getpid()
+
+    def acquire(self):
+        if os.getpid() != self._pid:
+            # Connections must not be shared with a forked child; drop the
+            # inherited ones without closing them (the parent still owns them)
+            self._idle = queue.LifoQueue(maxsize=self.size)
+            self._pid = os.getpid()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect(self.path)
+
+    def release(self, conn):
+        # Never hand out a connection with a half-finished transaction, e.g.
+        # when a handler returned early or raised before committing
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def idle_count(self):
+        return self._idle.qsize()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path=None):
+    path = path or DATABASE
+    pool = _pools.get(path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(path, ConnectionPool(path))
+    return pool
+
+
+def warm_pool(path=None, count=POOL_WARM):
+    """Open up to count connections now, so the first requests do not pay for them"""
+    pool = get_pool(path)
+    conns = [pool.acquire() for _ in range(min(count, pool.size))]
+    for conn in conns:
+        pool.release(conn)
+
+
+def close_pools():
+    """Close every idle pooled connection, e.g. in a master process before it forks"""
+    for pool in list(_pools.values()):
+        pool.close_all()
+
+
+def idle_connections():
+    return sum(pool.idle_count() for pool in list(_pools.values()))
+
+
+metrics.registry.gauge('sqlite_pool_idle_connections', 'Idle pooled SQLite connections', idle_connections)
+
+
+@contextmanager
+def db_connection(path=None):
+    """Borrow a pooled connection; it is always returned, even on errors"""
+    pool = get_pool(path)
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
@@ -0,0 +1,110 @@
+"""In-process pub/sub for subscription status changes.
+
+Endpoints that change a subscription publish the new status snapshot here.
+Open Server-Sent Events streams subscribe by subscription ID and receive each
+change once instead of polling. The broker only reaches streams in the same
+worker process, so streams also re-read the status on every heartbeat to pick
+up changes made by other workers.
+"""
+import asyncio
+import json
+import threading
+from collections import deque
+
+# Events carry a full status snapshot, so a slow stream only needs the newest
+SUBSCRIBER_QUEUE_SIZE = 16
+
+
+def format_sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+class Subscriber:
+    """Message queue for one open stream, drained by a blocking get()"""
+
+    def __init__(self, key, maxlen=SUBSCRIBER_QUEUE_SIZE):
+        self.key = key
+        self._messages = deque(maxlen=maxlen)
+        self._ready = threading.Condition()
+
+    def deliver(self, message):
+        with self._ready:
+            self._messages.append(message)
+            self._ready.notify()
+
+    def get(self, timeout):
+        """Return the next (event, data) message, or None after timeout seconds"""
+        with self._ready:
+            if not self._messages:
+                self._ready.wait(timeout)
+            return self._messages.popleft() if self._messages else None
+
+
+class AsyncSubscriber:
+    """Message queue for a stream served from an asyncio event loop.
+
+    deliver() may be called from any thread; get() runs on the loop.
+    """
+
+    def __init__(self, key, loop, maxlen=SUBSCRIBER_QUEUE_SIZE):
+        self.key = key
+        self.closed = False
+        self._loop = loop
+        self._messages = deque(maxlen=maxlen)
+        self._ready = asyncio.Event()
+
+    def deliver(self, message):
+        self._messages.append(message)
+        try:
+            self._loop.call_soon_threadsafe(self._ready.set)
+        except RuntimeError:
+            # The loop has shut down; nobody is left to read the message
+            pass
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+
+    async def get(self, timeout):
+        if not self._messages and not self.closed:
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._ready.clear()
+        return self._messages.popleft() if self._messages else None
+
+
+class EventBroker:
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, key, subscriber=None):
+        subscriber = subscriber or Subscriber(key)
+        with self._lock:
+            self._subscribers.setdefault(key, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.key)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[subscriber.key]
+
+    def has_subscribers(self, key):
+        # Lets publishers skip building a snapshot nobody is listening for
+        return key in self._subscribers
+
+    def publish(self, key, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(key, ()))
+        for subscriber in subscribers:
+            subscriber.deliver((event, data))
+        return len(subscribers)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
@@ -0,0 +1,144 @@
+"""Streaming table exports for reconciliation.
+
+Rows are read from a single SQLite cursor in id order and fetched in chunks
+with fetchmany, then written out as NDJSON or CSV one chunk at a time. Memory
+use stays flat however large the table is. Every row carries its id, so an
+interrupted export can be resumed with after_id set to the last id received.
+With sharded storage there is one cursor per shard, merged by id, so the
+export stays in global id order and after_id still resumes it.
+
+Payments are exported from the hot table unless include_archive is set.
+Then archived payments in the range are streamed first, read through the
+archive index, followed by the hot rows in id order. Archived rows are not
+in id order, so such an export cannot be resumed with after_id. Without
+include_archive, a payments export whose range starts before
+archive.archived_before() would silently miss archived rows, so callers
+reject it (see archived_range_start).
+"""
+import csv
+import heapq
+import io
+import itertools
+import json
+import os
+from operator import itemgetter
+
+import archive
+import shards
+from billing import format_timestamp
+
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 1000))
+
+# table -> (exported columns, column the date-range filter applies to)
+EXPORT_TABLES = {
+    'users': (('id', 'email', 'name', 'created_at'), 'created_at'),
+    'subscriptions': (
+        ('id', 'user_id', 'plan_id', 'status', 'start_date', 'end_date',
+         'next_billing_date', 'auto_renew', 'created_at'),
+        'created_at'
+    ),
+    'payments': (
+        ('id', 'subscription_id', 'amount', 'status', 'payment_date', 'transaction_id', 'failure_reason'),
+        'payment_date'
+    )
+}
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+
+def archived_range_start(table, start=None):
+    """The earliest start a payments export can use without missing archived rows, if start is earlier; else None"""
+    if table != 'payments':
+        return None
+    boundary = archive.archived_before()
+    if boundary is None or (start is not None and start >= boundary):
+        return None
+    return boundary
+
+
+def export_query(table, start=None, end=None, after_id=None):
+    """Build the SELECT for an export; start is inclusive, end exclusive"""
+    columns, date_column = EXPORT_TABLES[table]
+    conditions = ['id > ?']
+    params = [after_id or 0]
+    if start is not None:
+        conditions.append(f'{date_column} >= ?')
+        params.append(format_timestamp(start))
+    if end is not None:
+        conditions.append(f'{date_column} < ?')
+        params.append(format_timestamp(end))
+    sql = f'SELECT {", ".join(columns)} FROM {table} WHERE {" AND ".join(conditions)} ORDER BY id'
+    return sql, params
+
+
+def iter_row_chunks(table, start=None, end=None, after_id=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield lists of row tuples straight from the cursor(s).
+
+    The connections stay checked out until the generator is exhausted or
+    closed, and each shard is read from one snapshot.
+    """
+    sql, params = export_query(table, start, end, after_id)
+    with shards.router.connections() as conns:
+        cursors = [conn.execute(sql, params) for conn in conns]
+        if len(cursors) == 1:
+            rows_in_order = cursors[0]
+        else:
+            rows_in_order = heapq.merge(*(_iter_cursor(cursor, chunk_size) for cursor in cursors), key=itemgetter(0))
+        while True:
+            rows = list(itertools.islice(rows_in_order, chunk_size))
+            if not rows:
+                break
+            yield rows
+
+
+def _iter_cursor(cursor, chunk_size):
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def _ndjson_chunks(columns, chunks):
+    for rows in chunks:
+        yield ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+
+
+def _csv_chunks(columns, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # Header only, for an export with no rows
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def iter_archived_chunks(start=None, end=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield lists of archived payment row tuples, in export column order"""
+    columns = EXPORT_TABLES['payments'][0]
+    rows = (tuple(payment[column] for column in columns) for payment in archive.iter_archived(start, end))
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def stream_export(table, fmt='ndjson', start=None, end=None, after_id=None, chunk_size=EXPORT_CHUNK_SIZE,
+                  include_archive=False):
+    """Yield the export as text, one chunk of rows per piece"""
+    columns = EXPORT_TABLES[table][0]
+    chunks = iter_row_chunks(table, start, end, after_id, chunk_size)
+    if include_archive:
+        chunks = itertools.chain(iter_archived_chunks(start, end, chunk_size), chunks)
+    if fmt == 'csv':
+        return _csv_chunks(columns, chunks)
+    return _ndjson_chunks(columns, chunks)
@@ -0,0 +1,40 @@
+"""gunicorn settings for the API.
+
+    cd backend && gunicorn -c gunicorn.conf.py app:app
+
+The app is preloaded in the master, which brings the database up to date
+once (see bootstrap.py) before any worker is forked. Each worker then warms
+its plan catalog, shard map and connection pool before it accepts
+connections, and logs how long its startup took. Command-line options
+override these settings; the worker count comes from WEB_CONCURRENCY or
+--workers.
+"""
+import os
+import time
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+worker_class = 'gthread'
+# Event streams take at most SSE_MAX_STREAMS (default 8) of these per worker
+threads = 32
+preload_app = True
+
+
+def on_starting(server):
+    import app
+    import db
+    schema, seconds = app.bootstrapper.prepare()
+    # Workers open their own connections; none should be inherited over fork
+    db.close_pools()
+    server.log.info('Database schema %s in %.1f ms', schema, seconds * 1000)
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    import app
+    app.bootstrapper.ensure(started=worker.forked_at)
+    report = app.bootstrapper.report
+    worker.log.info('Worker %s ready in %.1f ms (warm-up %.1f ms)', worker.pid,
+                    report['startup_seconds'] * 1000, report['warm_seconds'] * 1000)
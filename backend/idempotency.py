@@ -0,0 +1,208 @@
+"""Idempotency-Key support for endpoints that create payments or subscriptions.
+
+The first response for a key is stored in the idempotency_keys table, with
+an in-memory LRU/TTL layer in front of it. Replays return the stored
+response without running the view again. A duplicate that arrives while
+the first request is still running waits for that result instead of
+repeating the work.
+
+An in-progress row holds a lease of IDEMPOTENCY_LEASE_SECONDS. If the
+request that claimed it dies (crash, restart, killed worker) the row would
+otherwise block the key until the TTL runs out. Once the lease has expired,
+a retry with the same request takes the key over and runs the view. The
+lease must be longer than the slowest request.
+"""
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import current_app, jsonify, request
+
+from db import db_connection
+from ttl_cache import TTLCache
+
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 24 * 60 * 60))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000))
+IDEMPOTENCY_LEASE_SECONDS = int(os.environ.get('IDEMPOTENCY_LEASE_SECONDS', 60))
+IDEMPOTENCY_WAIT_SECONDS = 30
+MAX_KEY_LENGTH = 255
+
+response_cache = TTLCache(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_TTL_SECONDS)
+
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+class StoredResponse:
+    def __init__(self, fingerprint, status_code, body, content_type):
+        self.fingerprint = fingerprint
+        self.status_code = status_code
+        self.body = body
+        self.content_type = content_type
+
+    def replay(self):
+        response = current_app.response_class(self.body, status=self.status_code, content_type=self.content_type)
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+
+def request_fingerprint():
+    digest = hashlib.sha256()
+    digest.update(request.method.encode())
+    digest.update(request.path.encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def _claim(scope, key, fingerprint):
+    """Insert an in-progress row or take over one with an expired lease; returns None if claimed, else the existing row"""
+    now = datetime.now()
+    expired_before = now - timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)
+    locked_until = now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)
+    with db_connection() as conn:
+        conn.execute('''
+            DELETE FROM idempotency_keys
+            WHERE endpoint = ? AND idempotency_key = ? AND created_at < ?
+        ''', (scope, key, expired_before))
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO idempotency_keys (endpoint, idempotency_key, request_hash, status, created_at, locked_until)
+            VALUES (?, ?, ?, 'in_progress', ?, ?)
+        ''', (scope, key, fingerprint, now, locked_until))
+        if cursor.rowcount == 0:
+            # Only the same request may take over; rows from before leases count as expired
+            cursor = conn.execute('''
+                UPDATE idempotency_keys SET created_at = ?, locked_until = ?
+                WHERE endpoint = ? AND idempotency_key = ? AND request_hash = ?
+                  AND status = 'in_progress' AND (locked_until IS NULL OR locked_until < ?)
+            ''', (now, locked_until, scope, key, fingerprint, now))
+        conn.commit()
+        if cursor.rowcount == 1:
+            return None
+        return conn.execute('''
+            SELECT * FROM idempotency_keys WHERE endpoint = ? AND idempotency_key = ?
+        ''', (scope, key)).fetchone()
+
+
+def _load(scope, key):
+    with db_connection() as conn:
+        return conn.execute('''
+            SELECT * FROM idempotency_keys WHERE endpoint = ? AND idempotency_key = ?
+        ''', (scope, key)).fetchone()
+
+
+def _store(scope, key, stored):
+    with db_connection() as conn:
+        conn.execute('''
+            UPDATE idempotency_keys
+            SET status = 'completed', status_code = ?, body = ?, content_type = ?
+            WHERE endpoint = ? AND idempotency_key = ?
+        ''', (stored.status_code, stored.body, stored.content_type, scope, key))
+        conn.commit()
+
+
+def _release(scope, key):
+    with db_connection() as conn:
+        conn.execute('DELETE FROM idempotency_keys WHERE endpoint = ? AND idempotency_key = ?', (scope, key))
+        conn.commit()
+
+
+def _lease_expired(row):
+    if row['status'] != 'in_progress':
+        return False
+    return row['locked_until'] is None or row['locked_until'] < datetime.now().isoformat(' ')
+
+
+def _from_row(row):
+    return StoredResponse(row['request_hash'], row['status_code'], row['body'], row['content_type'])
+
+
+def _replay_or_reject(stored, fingerprint):
+    if stored.fingerprint != fingerprint:
+        return jsonify({'error': 'Idempotency-Key was already used for a different request'}), 422
+    return stored.replay()
+
+
+def idempotent(scope):
+    """Make a view replay its first response for a repeated Idempotency-Key"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get('Idempotency-Key')
+            if not key:
+                return view(*args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return jsonify({'error': 'Idempotency-Key is too long'}), 400
+
+            fingerprint = request_fingerprint()
+            cache_key = (scope, key)
+            deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+
+            while True:
+                stored = response_cache.get(cache_key)
+                if stored:
+                    return _replay_or_reject(stored, fingerprint)
+
+                # Duplicates inside this process wait on the running request
+                with _in_flight_lock:
+                    done = _in_flight.get(cache_key)
+                    if done is None:
+                        done = _in_flight[cache_key] = threading.Event()
+                        owner = True
+                    else:
+                        owner = False
+                if not owner:
+                    done.wait(max(0, deadline - time.monotonic()))
+                    if time.monotonic() >= deadline:
+                        return jsonify({'error': 'A request with this Idempotency-Key is still in progress'}), 409
+                    continue
+
+                try:
+                    existing = _claim(scope, key, fingerprint)
+                    if existing is None:
+                        return _run_and_store(view, args, kwargs, scope, key, fingerprint)
+                    if existing['status'] == 'completed':
+                        stored = _from_row(existing)
+                        response_cache.set(cache_key, stored)
+                        return _replay_or_reject(stored, fingerprint)
+                    if existing['request_hash'] != fingerprint:
+                        return jsonify({'error': 'Idempotency-Key was already used for a different request'}), 422
+                finally:
+                    with _in_flight_lock:
+                        _in_flight.pop(cache_key, None)
+                    done.set()
+
+                # Another worker process owns the key; poll for its result
+                while time.monotonic() < deadline:
+                    time.sleep(0.05)
+                    row = _load(scope, key)
+                    if row is None or _lease_expired(row):
+                        break
+                    if row['status'] == 'completed':
+                        stored = _from_row(row)
+                        response_cache.set(cache_key, stored)
+                        return _replay_or_reject(stored, fingerprint)
+                else:
+                    return jsonify({'error': 'A request with this Idempotency-Key is still in progress'}), 409
+        return wrapper
+    return decorator
+
+
+def _run_and_store(view, args, kwargs, scope, key, fingerprint):
+    try:
+        response = current_app.make_response(view(*args, **kwargs))
+    except Exception:
+        _release(scope, key)
+        raise
+
+    # Server errors are not stored so the client can retry them
+    if response.status_code >= 500 or response.is_streamed:
+        _release(scope, key)
+        return response
+
+    stored = StoredResponse(fingerprint, response.status_code, response.get_data(), response.content_type)
+    _store(scope, key, stored)
+    response_cache.set((scope, key), stored)
+    return response
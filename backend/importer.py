@@ -0,0 +1,226 @@
+"""Bulk import of users and their plan assignments.
+
+Rows are read from an NDJSON or CSV stream and processed in chunks. Each
+chunk is one write transaction. Existing users and active subscriptions are
+looked up for the whole chunk at once, and new users and subscriptions are
+inserted with executemany. With sharded storage each chunk is split by shard
+and every shard's part is written in its own transaction. A row that cannot be imported is reported with
+its line number and does not stop the rest of the import. Checks shared
+with /api/subscribe use the same error messages.
+
+Row fields: email and name (required); plan_id (optional, also creates a
+subscription); status (optional, one of IMPORT_STATUSES, default 'active');
+start_date (optional ISO date, default now).
+"""
+import csv
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import read_cache
+import shards
+from billing import BILLING_CYCLE_DAYS, format_timestamp
+
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 5000))
+IMPORT_STATUSES = ('active', 'pending', 'trialing')
+# Only the first errors are returned; the total is always counted
+MAX_REPORTED_ERRORS = 1000
+
+
+def read_rows(stream, fmt):
+    """Yield (line number, row dict or None) from a text stream"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_number, row if isinstance(row, dict) else None
+
+
+def _parse_row(row, plans):
+    """Validate one row; returns (fields, None) or (None, error message)"""
+    if row is None:
+        return None, 'Invalid JSON object'
+    email = row.get('email') or ''
+    name = row.get('name') or ''
+    # NDJSON values can be numbers, lists or objects
+    if not isinstance(email, str) or not isinstance(name, str):
+        return None, 'email and name must be strings'
+    email, name = email.strip(), name.strip()
+    if not email or not name:
+        return None, 'Missing required fields'
+
+    plan_id = row.get('plan_id')
+    if plan_id in (None, ''):
+        return (email, name, None, None, None), None
+    if isinstance(plan_id, bool) or (isinstance(plan_id, float) and not plan_id.is_integer()):
+        return None, 'Plan not found'
+    try:
+        plan_id = int(plan_id)
+    except (TypeError, ValueError):
+        return None, 'Plan not found'
+    if plan_id not in plans:
+        return None, 'Plan not found'
+
+    status = row.get('status') or 'active'
+    if not isinstance(status, str) or status not in IMPORT_STATUSES:
+        return None, f'status must be one of {", ".join(IMPORT_STATUSES)}'
+    try:
+        start_date = datetime.fromisoformat(row['start_date']) if row.get('start_date') else None
+    except (TypeError, ValueError):
+        return None, 'Invalid start_date'
+    return (email, name, plan_id, status, start_date), None
+
+
+class ImportReport:
+    def __init__(self):
+        self.rows = 0
+        self.users_created = 0
+        self.users_matched = 0
+        self.subscriptions_created = 0
+        self.failed = 0
+        self.errors = []
+        self.started = time.perf_counter()
+
+    def error(self, line_number, email, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line_number, 'email': email, 'error': message})
+
+    def as_dict(self):
+        elapsed = time.perf_counter() - self.started
+        return {
+            'rows': self.rows,
+            'users_created': self.users_created,
+            'users_matched': self.users_matched,
+            'subscriptions_created': self.subscriptions_created,
+            'failed': self.failed,
+            'errors': sorted(self.errors, key=lambda error: error['line']),
+            'errors_truncated': self.failed > len(self.errors),
+            'duration_seconds': round(elapsed, 3),
+            'rows_per_second': round(self.rows / elapsed, 1) if elapsed else None
+        }
+
+
+def _user_ids(conn, emails):
+    rows = conn.execute('''
+        SELECT id, email FROM users
+        WHERE email IN (SELECT value FROM json_each(?))
+    ''', (json.dumps(emails),))
+    return {email: user_id for user_id, email in rows}
+
+
+def _subscription_dates(start_date, billing_cycle):
+    end_date = start_date + timedelta(days=BILLING_CYCLE_DAYS[billing_cycle])
+    return format_timestamp(start_date), format_timestamp(end_date)
+
+
+def _import_chunk(conn, chunk, plans, default_dates, report):
+    """Import one chunk of (line number, fields) inside a single transaction"""
+    emails = list({fields[0] for _, fields in chunk})
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        user_ids = _user_ids(conn, emails)
+        report.users_matched += len(user_ids)
+
+        # First row wins for an email that appears twice in the chunk
+        new_users = {}
+        for _, (email, name, *_rest) in chunk:
+            if email not in user_ids and email not in new_users:
+                new_users[email] = name
+        if new_users:
+            new_user_ids = shards.router.new_ids(conn, 'users', [shards.bucket_for_email(email) for email in new_users])
+            conn.executemany('INSERT INTO users (id, email, name) VALUES (?, ?, ?)', [
+                (user_id, email, name) for user_id, (email, name) in zip(new_user_ids, new_users.items())
+            ])
+            user_ids.update(_user_ids(conn, list(new_users)))
+            report.users_created += len(new_users)
+
+        subscribing = [user_ids[fields[0]] for _, fields in chunk if fields[2] is not None]
+        has_active = set()
+        if subscribing:
+            has_active = {row[0] for row in conn.execute('''
+                SELECT DISTINCT user_id FROM subscriptions
+                WHERE user_id IN (SELECT value FROM json_each(?))
+                  AND status IN ('active', 'expiring_soon', 'trialing')
+            ''', (json.dumps(subscribing),))}
+
+        subscriptions = []
+        for line_number, (email, _name, plan_id, status, start_date) in chunk:
+            if plan_id is None:
+                continue
+            user_id = user_ids[email]
+            if user_id in has_active:
+                report.error(line_number, email, 'User already has an active subscription')
+                continue
+            if start_date:
+                start, end = _subscription_dates(start_date, plans[plan_id])
+            else:
+                start, end = default_dates[plans[plan_id]]
+            subscriptions.append((user_id, plan_id, status, start, end, end))
+            if status in ('active', 'trialing'):
+                has_active.add(user_id)
+
+        subscription_ids = shards.router.new_ids(
+            conn, 'subscriptions', [shards.bucket_for_id(subscription[0]) for subscription in subscriptions])
+        conn.executemany('''
+            INSERT INTO subscriptions (id, user_id, plan_id, status, start_date, end_date, next_billing_date, auto_renew)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+        ''', [(subscription_id, *subscription) for subscription_id, subscription in zip(subscription_ids, subscriptions)])
+        report.subscriptions_created += len(subscriptions)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    # New users and subscriptions were never cached; their users' lists may be
+    for user_id in {subscription[0] for subscription in subscriptions}:
+        read_cache.user_subscriptions.evict(user_id)
+
+
+def _import_by_shard(conns, chunk, plans, default_dates, report):
+    """Split a chunk by the shard of each row's user and import every part"""
+    legacy = shards.router.legacy_shard()
+    existing = set()
+    if legacy is not None:
+        existing = set(_user_ids(conns[legacy], list({fields[0] for _, fields in chunk})))
+    parts = {}
+    for item in chunk:
+        email = item[1][0]
+        shard = legacy if email in existing else shards.router.shard_for_bucket(shards.bucket_for_email(email))
+        parts.setdefault(shard, []).append(item)
+    for shard, part in sorted(parts.items()):
+        _import_chunk(conns[shard], part, plans, default_dates, report)
+
+
+def import_rows(rows, chunk_size=IMPORT_CHUNK_SIZE):
+    """Import (line number, row) pairs, e.g. from read_rows(); returns the report dict"""
+    report = ImportReport()
+    with shards.router.connections() as conns:
+        plans = dict(conns[0].execute('SELECT id, billing_cycle FROM plans WHERE is_active = 1').fetchall())
+        # Rows without a start_date share the same dates, formatted once per cycle
+        now = datetime.now()
+        default_dates = {cycle: _subscription_dates(now, cycle) for cycle in set(plans.values())}
+        chunk = []
+        for line_number, row in rows:
+            report.rows += 1
+            fields, error = _parse_row(row, plans)
+            if error:
+                email = row.get('email') if row else None
+                report.error(line_number, email if isinstance(email, str) else None, error)
+                continue
+            chunk.append((line_number, fields))
+            if len(chunk) >= chunk_size:
+                _import_by_shard(conns, chunk, plans, default_dates, report)
+                chunk = []
+        if chunk:
+            _import_by_shard(conns, chunk, plans, default_dates, report)
+    return report.as_dict()
@@ -0,0 +1,192 @@
+"""Subscription lifecycle sweeper.
+
+Moves subscriptions through the date-driven part of their lifecycle:
+
+- active -> expiring_soon once end_date is within EXPIRING_SOON_DAYS
+- active/expiring_soon -> expired once end_date has passed, when auto_renew
+  is off. Auto-renewing subscriptions get EXPIRY_GRACE_DAYS for a billing
+  run to renew them first.
+- cancelled -> expired once the paid period ends
+
+It also recovers payment attempts lost with a worker process: an attempt
+still queued or processing STALE_ATTEMPT_SECONDS after its last update is
+marked expired, and its subscription goes from processing back to pending
+so it can be paid again. Workers run that recovery once when they start.
+
+Each transition is a set-based UPDATE over the (status, end_date) index,
+applied in batches of at most batch_size rows. Each batch is its own short
+write transaction. The sweeper sleeps between batches to stay under
+max_rows_per_second, so it never holds the SQLite write lock long enough to
+stall request traffic. With sharded storage the shards are swept one after
+another under the same rate limit.
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import metrics
+import queries
+import read_cache
+import shards
+from billing import format_timestamp
+from db import db_connection
+from filelock import FileLock
+
+EXPIRING_SOON_DAYS = int(os.environ.get('EXPIRING_SOON_DAYS', 7))
+EXPIRY_GRACE_DAYS = int(os.environ.get('EXPIRY_GRACE_DAYS', 3))
+SWEEP_BATCH_SIZE = int(os.environ.get('SWEEP_BATCH_SIZE', 500))
+SWEEP_MAX_ROWS_PER_SECOND = int(os.environ.get('SWEEP_MAX_ROWS_PER_SECOND', 5000))
+# Queued/processing attempts untouched this long are treated as lost
+STALE_ATTEMPT_SECONDS = int(os.environ.get('STALE_ATTEMPT_SECONDS', 600))
+# Seconds between in-process sweeps; 0 leaves sweeping to the CLI
+LIFECYCLE_SWEEP_INTERVAL = float(os.environ.get('LIFECYCLE_SWEEP_INTERVAL', 0))
+
+# (transition name, new status, condition); :now, :grace and :soon are bound per sweep
+TRANSITIONS = [
+    ('expired', 'expired', '''
+        status IN ('active', 'expiring_soon') AND auto_renew = 0 AND end_date <= :now
+    '''),
+    ('expired_after_grace', 'expired', '''
+        status IN ('active', 'expiring_soon') AND auto_renew = 1 AND end_date <= :grace
+    '''),
+    ('cancelled_ended', 'expired', '''
+        status = 'cancelled' AND end_date <= :now
+    '''),
+    ('expiring_soon', 'expiring_soon', '''
+        status = 'active' AND end_date <= :soon
+    ''')
+]
+
+transitions_applied = metrics.registry.counter(
+    'lifecycle_transitions_total', 'Subscriptions moved by the lifecycle sweeper', ('transition',))
+attempts_recovered = metrics.registry.counter(
+    'payment_attempts_recovered_total', 'Stale payment attempts expired by recovery')
+sweep_duration = metrics.registry.histogram(
+    'lifecycle_sweep_duration_seconds', 'Lifecycle sweep duration')
+
+
+def recover_stale_attempts(stale_seconds=STALE_ATTEMPT_SECONDS):
+    """Expire attempts a lost worker left queued/processing and reopen their subscriptions.
+
+    Only subscriptions still in processing go back to pending: a recorded
+    payment has already moved them on. Returns the recovered attempt count.
+    """
+    # updated_at is written with CURRENT_TIMESTAMP, so compare on SQLite's clock
+    cutoff = f'-{int(stale_seconds)} seconds'
+    result = json.dumps({'error': 'Payment attempt was interrupted; the subscription can be paid again'})
+    recovered = 0
+    for path in shards.router.paths():
+        with db_connection(path) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute(queries.EXPIRE_STALE_ATTEMPTS, (result, cutoff)).fetchall()
+                reopened = []
+                if rows:
+                    reopened = conn.execute(queries.REOPEN_SUBSCRIPTIONS,
+                                            (json.dumps([row[0] for row in rows]),)).fetchall()
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        for subscription_id, user_id in reopened:
+            read_cache.subscription_changed(subscription_id, user_id)
+        recovered += len(rows)
+    if recovered:
+        attempts_recovered.inc(amount=recovered)
+    return recovered
+
+
+def sweep(now=None, batch_size=SWEEP_BATCH_SIZE, max_rows_per_second=SWEEP_MAX_ROWS_PER_SECOND):
+    """Apply every transition that is due; returns per-transition counts and timing"""
+    now = now or datetime.now()
+    params = {
+        'now': format_timestamp(now),
+        'grace': format_timestamp(now - timedelta(days=EXPIRY_GRACE_DAYS)),
+        'soon': format_timestamp(now + timedelta(days=EXPIRING_SOON_DAYS))
+    }
+    started = time.perf_counter()
+    counts = {name: 0 for name, _, _ in TRANSITIONS}
+    batches = 0
+    total = 0
+
+    for path in shards.router.paths():
+        with db_connection(path) as conn:
+            for name, new_status, condition in TRANSITIONS:
+                while True:
+                    conn.execute('BEGIN IMMEDIATE')
+                    try:
+                        rows = conn.execute(queries.LIFECYCLE_TRANSITION.format(condition=condition),
+                                            {**params, 'new_status': new_status, 'limit': batch_size}).fetchall()
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    for subscription_id, user_id in rows:
+                        read_cache.subscription_changed(subscription_id, user_id)
+                    changed = len(rows)
+                    batches += 1
+                    total += changed
+                    counts[name] += changed
+                    if changed:
+                        transitions_applied.inc(name, amount=changed)
+                    if changed < batch_size:
+                        break
+                    # Rate limit: let request traffic take the write lock in between
+                    if max_rows_per_second:
+                        pause = total / max_rows_per_second - (time.perf_counter() - started)
+                        if pause > 0:
+                            time.sleep(pause)
+
+    recovered = recover_stale_attempts()
+    elapsed = time.perf_counter() - started
+    sweep_duration.observe(elapsed)
+    return {
+        'swept_at': now.isoformat(),
+        'transitions': counts,
+        'attempts_recovered': recovered,
+        'updated': total,
+        'batches': batches,
+        'duration_seconds': round(elapsed, 3)
+    }
+
+
+class LifecycleSweeper:
+    """Runs sweep() every `interval` seconds in one worker process per deployment.
+
+    Every worker starts the timer thread. Only the worker holding the lock
+    file next to the database sweeps. If that worker exits, the next one to
+    try picks the lock up.
+    """
+
+    def __init__(self, lock_path, interval=LIFECYCLE_SWEEP_INTERVAL, logger=None):
+        self.lock = FileLock(lock_path)
+        self.interval = interval
+        self.logger = logger
+        self.last_report = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        # Started lazily so the thread lives in the forked worker, not the master
+        if not self.interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='lifecycle-sweeper', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self.lock.acquire(blocking=False):
+                continue
+            try:
+                self.last_report = sweep()
+                if self.logger and (self.last_report['updated'] or self.last_report['attempts_recovered']):
+                    self.logger.info('Lifecycle sweep: %s', self.last_report)
+            except Exception:
+                if self.logger:
+                    self.logger.exception('Lifecycle sweep failed')
@@ -0,0 +1,156 @@
+"""Minimal in-process metrics with Prometheus text exposition.
+
+Counters and histograms are cheap enough to update on every request and
+every SQL statement: one lock and a couple of additions each. Values are
+per worker process, so each gunicorn worker reports its own series.
+"""
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for labelvalues, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labelvalues)} {value}')
+        return lines
+
+
+class Gauge:
+    """Gauge whose value is read from a callback at scrape time"""
+
+    def __init__(self, name, documentation, callback):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def render(self):
+        return [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} gauge',
+            f'{self.name} {self.callback()}'
+        ]
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                # Per-bucket counts (last slot is +Inf), then sum
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((labels, (list(series[0]), series[1])) for labels, series in self._series.items())
+        names = self.labelnames + ('le',)
+        for labelvalues, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(names, labelvalues + (bound,))} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labelvalues)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, labelvalues)} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    'http_requests_total', 'HTTP requests handled', ('method', 'endpoint', 'status'))
+http_request_duration = registry.histogram(
+    'http_request_duration_seconds', 'HTTP request latency', ('method', 'endpoint'))
+request_sql_queries = registry.histogram(
+    'http_request_sql_queries', 'SQL statements executed per request', ('endpoint',), buckets=COUNT_BUCKETS)
+request_sql_duration = registry.histogram(
+    'http_request_sql_duration_seconds', 'Time spent in SQL per request', ('endpoint',))
+# The _count series doubles as the total number of statements executed
+sql_query_duration = registry.histogram('sqlite_query_duration_seconds', 'SQL statement execution time')
+connections_opened = registry.counter('sqlite_connections_opened_total', 'SQLite connections opened')
+payment_outcomes = registry.counter(
+    'payment_outcomes_total', 'Simulated payment outcomes', ('status',))
+payment_failures = registry.counter(
+    'payment_failures_total', 'Simulated payment failures by reason', ('error_code', 'error_reason'))
+payment_gateway_duration = registry.histogram(
+    'payment_gateway_duration_seconds', 'Simulated payment gateway latency')
+
+# Per-thread SQL totals for the request currently being served
+_request_stats = threading.local()
+
+
+def start_request():
+    _request_stats.queries = 0
+    _request_stats.seconds = 0.0
+
+
+def request_totals():
+    return getattr(_request_stats, 'queries', 0), getattr(_request_stats, 'seconds', 0.0)
+
+
+def record_query(seconds):
+    sql_query_duration.observe(seconds)
+    if hasattr(_request_stats, 'queries'):
+        _request_stats.queries += 1
+        _request_stats.seconds += seconds
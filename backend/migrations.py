@@ -0,0 +1,378 @@
+"""Versioned schema migrations.
+
+Each migration is a (version, name, statements) entry applied in order and
+recorded in the schema_version table. Never edit a migration that has
+shipped; append a new one instead.
+"""
+
+MIGRATIONS = [
+    (1, 'initial schema', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            name TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS plans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            price REAL NOT NULL,
+            billing_cycle TEXT NOT NULL,
+            features TEXT NOT NULL,
+            is_active BOOLEAN DEFAULT 1
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            plan_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            start_date TIMESTAMP NOT NULL,
+            end_date TIMESTAMP NOT NULL,
+            next_billing_date TIMESTAMP,
+            auto_renew BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (plan_id) REFERENCES plans (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            subscription_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            status TEXT NOT NULL,
+            payment_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            transaction_id TEXT UNIQUE,
+            FOREIGN KEY (subscription_id) REFERENCES subscriptions (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS payment_attempts (
+            id TEXT PRIMARY KEY,
+            subscription_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            http_status INTEGER,
+            result TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (subscription_id) REFERENCES subscriptions (id)
+        )
+        '''
+    ]),
+    (2, 'indexes for subscription and payment lookups', [
+        # Active-subscription check in subscribe
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_user_status ON subscriptions (user_id, status)',
+        # Per-user subscription listing ordered by creation
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_user_created ON subscriptions (user_id, created_at)',
+        # Payment history and latest-payment lookups, covering the selected columns
+        '''
+        CREATE INDEX IF NOT EXISTS idx_payments_subscription_date
+        ON payments (subscription_id, payment_date, status, transaction_id, amount)
+        '''
+    ]),
+    (3, 'billing runs', [
+        '''
+        CREATE TABLE IF NOT EXISTS billing_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            window_start TIMESTAMP,
+            window_end TIMESTAMP NOT NULL,
+            status TEXT NOT NULL,
+            cursor_date TEXT NOT NULL,
+            cursor_id INTEGER NOT NULL,
+            processed INTEGER NOT NULL DEFAULT 0,
+            amount REAL NOT NULL DEFAULT 0,
+            error TEXT,
+            duration_seconds REAL,
+            per_second REAL,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        ''',
+        # Only renewable subscriptions, walked in (next_billing_date, id) order
+        '''
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_due
+        ON subscriptions (next_billing_date)
+        WHERE auto_renew = 1 AND status IN ('active', 'expiring_soon')
+        '''
+    ]),
+    (4, 'idempotency keys', [
+        '''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            endpoint TEXT NOT NULL,
+            idempotency_key TEXT NOT NULL,
+            request_hash TEXT NOT NULL,
+            status TEXT NOT NULL,
+            status_code INTEGER,
+            body BLOB,
+            content_type TEXT,
+            created_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (endpoint, idempotency_key)
+        )
+        '''
+    ]),
+    (5, 'keyset index for payment history', [
+        # Adds id right after payment_date so (payment_date, id) keyset pages
+        # are read in index order without sorting ties
+        'DROP INDEX IF EXISTS idx_payments_subscription_date',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_payments_subscription_history
+        ON payments (subscription_id, payment_date, id, status, transaction_id, amount)
+        '''
+    ]),
+    (6, 'lifecycle sweeper index', [
+        # Date-driven status transitions: one index range per (status, end_date cutoff)
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_status_end ON subscriptions (status, end_date)'
+    ]),
+    (7, 'analytics rollups', [
+        'ALTER TABLE payments ADD COLUMN failure_reason TEXT',
+        # Current subscriptions per plan and status
+        '''
+        CREATE TABLE IF NOT EXISTS analytics_subscription_counts (
+            plan_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            subscriptions INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (plan_id, status)
+        ) WITHOUT ROWID
+        ''',
+        # Subscriptions created ('created') or entering a status, per UTC day
+        '''
+        CREATE TABLE IF NOT EXISTS analytics_daily_subscriptions (
+            day TEXT NOT NULL,
+            plan_id INTEGER NOT NULL,
+            event TEXT NOT NULL,
+            subscriptions INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, plan_id, event)
+        ) WITHOUT ROWID
+        ''',
+        # Payments per UTC day, plan, outcome and failure reason ('' if none)
+        '''
+        CREATE TABLE IF NOT EXISTS analytics_daily_payments (
+            day TEXT NOT NULL,
+            plan_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            failure_reason TEXT NOT NULL DEFAULT '',
+            payments INTEGER NOT NULL DEFAULT 0,
+            amount REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, plan_id, status, failure_reason)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS analytics_subscription_insert
+        AFTER INSERT ON subscriptions
+        BEGIN
+            INSERT INTO analytics_subscription_counts (plan_id, status, subscriptions)
+            VALUES (NEW.plan_id, NEW.status, 1)
+            ON CONFLICT (plan_id, status) DO UPDATE SET subscriptions = subscriptions + 1;
+            INSERT INTO analytics_daily_subscriptions (day, plan_id, event, subscriptions)
+            VALUES (date('now'), NEW.plan_id, 'created', 1)
+            ON CONFLICT (day, plan_id, event) DO UPDATE SET subscriptions = subscriptions + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS analytics_subscription_update
+        AFTER UPDATE OF status, plan_id ON subscriptions
+        WHEN OLD.status IS NOT NEW.status OR OLD.plan_id IS NOT NEW.plan_id
+        BEGIN
+            UPDATE analytics_subscription_counts SET subscriptions = subscriptions - 1
+            WHERE plan_id = OLD.plan_id AND status = OLD.status;
+            INSERT INTO analytics_subscription_counts (plan_id, status, subscriptions)
+            VALUES (NEW.plan_id, NEW.status, 1)
+            ON CONFLICT (plan_id, status) DO UPDATE SET subscriptions = subscriptions + 1;
+            -- A cancelled subscription reaching its end date was already
+            -- counted as churn when it was cancelled
+            INSERT INTO analytics_daily_subscriptions (day, plan_id, event, subscriptions)
+            VALUES (
+                date('now'), NEW.plan_id,
+                CASE WHEN OLD.status = 'cancelled' AND NEW.status = 'expired' THEN 'cancellation_ended' ELSE NEW.status END,
+                1
+            )
+            ON CONFLICT (day, plan_id, event) DO UPDATE SET subscriptions = subscriptions + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS analytics_subscription_delete
+        AFTER DELETE ON subscriptions
+        BEGIN
+            UPDATE analytics_subscription_counts SET subscriptions = subscriptions - 1
+            WHERE plan_id = OLD.plan_id AND status = OLD.status;
+        END
+        ''',
+        # Payment rollups are history: archiving or deleting payments leaves them alone
+        '''
+        CREATE TRIGGER IF NOT EXISTS analytics_payment_insert
+        AFTER INSERT ON payments
+        BEGIN
+            INSERT INTO analytics_daily_payments (day, plan_id, status, failure_reason, payments, amount)
+            SELECT date(NEW.payment_date), s.plan_id, NEW.status, coalesce(NEW.failure_reason, ''), 1, NEW.amount
+            FROM subscriptions s WHERE s.id = NEW.subscription_id
+            ON CONFLICT (day, plan_id, status, failure_reason)
+            DO UPDATE SET payments = payments + 1, amount = amount + excluded.amount;
+        END
+        ''',
+        # Backfill from existing rows
+        '''
+        INSERT INTO analytics_subscription_counts (plan_id, status, subscriptions)
+        SELECT plan_id, status, COUNT(*) FROM subscriptions GROUP BY plan_id, status
+        ''',
+        '''
+        INSERT INTO analytics_daily_subscriptions (day, plan_id, event, subscriptions)
+        SELECT date(created_at), plan_id, 'created', COUNT(*) FROM subscriptions
+        GROUP BY date(created_at), plan_id
+        ''',
+        '''
+        INSERT INTO analytics_daily_payments (day, plan_id, status, failure_reason, payments, amount)
+        SELECT date(p.payment_date), s.plan_id, p.status, coalesce(p.failure_reason, ''), COUNT(*), SUM(p.amount)
+        FROM payments p JOIN subscriptions s ON s.id = p.subscription_id
+        GROUP BY 1, 2, 3, 4
+        '''
+    ]),
+    (8, 'sharding', [
+        # Bucket -> shard map and sharding metadata, used on the control shard only
+        'CREATE TABLE IF NOT EXISTS shard_map (bucket INTEGER PRIMARY KEY, shard INTEGER NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS shard_meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+        # Per-shard ID sequences for users, subscriptions and payments
+        'CREATE TABLE IF NOT EXISTS id_sequences (name TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+        # Billing runs walk the shards in order
+        'ALTER TABLE billing_runs ADD COLUMN cursor_shard INTEGER NOT NULL DEFAULT 0',
+        # Moving a bucket's payment attempts
+        'CREATE INDEX IF NOT EXISTS idx_payment_attempts_subscription ON payment_attempts (subscription_id)'
+    ]),
+    (9, 'payment archive index', [
+        # One row per archived gzip member: a subscription's payments from one
+        # month and run, with their position range and the newest payment
+        '''
+        CREATE TABLE IF NOT EXISTS payment_archive (
+            subscription_id INTEGER NOT NULL,
+            newest_date TEXT NOT NULL,
+            newest_id INTEGER NOT NULL,
+            oldest_date TEXT NOT NULL,
+            oldest_id INTEGER NOT NULL,
+            payments INTEGER NOT NULL,
+            segment TEXT NOT NULL,
+            byte_offset INTEGER NOT NULL,
+            byte_length INTEGER NOT NULL,
+            newest_amount REAL NOT NULL,
+            newest_status TEXT NOT NULL,
+            newest_transaction_id TEXT,
+            PRIMARY KEY (subscription_id, newest_date, newest_id)
+        ) WITHOUT ROWID
+        '''
+    ]),
+    (10, 'payment attempt recovery index', [
+        # Finding queued/processing attempts that a lost worker left behind
+        'CREATE INDEX IF NOT EXISTS idx_payment_attempts_status_updated ON payment_attempts (status, updated_at)'
+    ]),
+    (11, 'idempotency key leases', [
+        # An in-progress key whose lease ran out was left by a request that died
+        'ALTER TABLE idempotency_keys ADD COLUMN locked_until TIMESTAMP'
+    ]),
+    (12, 'read cache versions', [
+        # Bumped by every write that changes a cached view, keyed '<view>:<key>',
+        # so each worker's read cache sees writes made by any process
+        '''
+        CREATE TABLE IF NOT EXISTS read_cache_versions (
+            key TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS read_cache_subscription_insert
+        AFTER INSERT ON subscriptions
+        BEGIN
+            INSERT INTO read_cache_versions (key, version) VALUES ('user_subscriptions:' || NEW.user_id, 1)
+            ON CONFLICT (key) DO UPDATE SET version = version + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS read_cache_subscription_update
+        AFTER UPDATE ON subscriptions
+        BEGIN
+            INSERT INTO read_cache_versions (key, version) VALUES ('subscription_status:' || NEW.id, 1)
+            ON CONFLICT (key) DO UPDATE SET version = version + 1;
+            INSERT INTO read_cache_versions (key, version) VALUES ('user_subscriptions:' || NEW.user_id, 1)
+            ON CONFLICT (key) DO UPDATE SET version = version + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS read_cache_payment_insert
+        AFTER INSERT ON payments
+        BEGIN
+            INSERT INTO read_cache_versions (key, version) VALUES ('subscription_status:' || NEW.subscription_id, 1)
+            ON CONFLICT (key) DO UPDATE SET version = version + 1;
+            INSERT INTO read_cache_versions (key, version)
+            SELECT 'user_subscriptions:' || user_id, 1 FROM subscriptions WHERE id = NEW.subscription_id
+            ON CONFLICT (key) DO UPDATE SET version = version + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS read_cache_payment_update
+        AFTER UPDATE ON payments
+        BEGIN
+            INSERT INTO read_cache_versions (key, version) VALUES ('subscription_status:' || NEW.subscription_id, 1)
+            ON CONFLICT (key) DO UPDATE SET version = version + 1;
+            INSERT INTO read_cache_versions (key, version)
+            SELECT 'user_subscriptions:' || user_id, 1 FROM subscriptions WHERE id = NEW.subscription_id
+            ON CONFLICT (key) DO UPDATE SET version = version + 1;
+        END
+        ''',
+        # Email and name show up in the user view and in both subscription views
+        '''
+        CREATE TRIGGER IF NOT EXISTS read_cache_user_update
+        AFTER UPDATE ON users
+        BEGIN
+            INSERT INTO read_cache_versions (key, version) VALUES ('user:' || OLD.email, 1)
+            ON CONFLICT (key) DO UPDATE SET version = version + 1;
+            INSERT INTO read_cache_versions (key, version) VALUES ('user:' || NEW.email, 1)
+            ON CONFLICT (key) DO UPDATE SET version = version + 1;
+            INSERT INTO read_cache_versions (key, version) VALUES ('user_subscriptions:' || NEW.id, 1)
+            ON CONFLICT (key) DO UPDATE SET version = version + 1;
+            INSERT INTO read_cache_versions (key, version)
+            SELECT 'subscription_status:' || id, 1 FROM subscriptions WHERE user_id = NEW.id
+            ON CONFLICT (key) DO UPDATE SET version = version + 1;
+        END
+        '''
+    ])
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def current_version(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+
+def migrate(conn):
+    """Apply pending migrations and return the resulting schema version"""
+    # Fast path for worker boot: a single read when the schema is current
+    if current_version(conn) >= LATEST_VERSION:
+        return LATEST_VERSION
+
+    # Take the write lock before re-reading the version so concurrently
+    # booting workers apply each migration exactly once
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        version = current_version(conn)
+        for step_version, name, statements in MIGRATIONS:
+            if step_version <= version:
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute('INSERT INTO schema_version (version, name) VALUES (?, ?)', (step_version, name))
+            version = step_version
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return version
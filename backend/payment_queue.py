@@ -0,0 +1,64 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+PAYMENT_WORKERS = int(os.environ.get('PAYMENT_WORKERS', 8))
+
+
+class PaymentQueue:
+    """Run queued payment attempts on a background worker pool"""
+
+    def __init__(self, handler, max_workers=PAYMENT_WORKERS):
+        self.handler = handler
+        self.max_workers = max_workers
+        self._executor = None
+        self._pid = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # gunicorn forks workers after importing the app, so the pool has to be
+        # created lazily inside the process that actually serves the request
+        pid = os.getpid()
+        if self._executor is None or self._pid != pid:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix='payment-worker'
+            )
+            self._pid = pid
+            self._pending = {}
+        return self._executor
+
+    def submit(self, attempt_id, *args):
+        """Queue an attempt; the handler is called as handler(attempt_id, *args)"""
+        done = threading.Event()
+        with self._lock:
+            executor = self._get_executor()
+            self._pending[attempt_id] = done
+        executor.submit(self._run, attempt_id, done, args)
+
+    def _run(self, attempt_id, done, args):
+        try:
+            self.handler(attempt_id, *args)
+        finally:
+            done.set()
+            with self._lock:
+                self._pending.pop(attempt_id, None)
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def wait(self, attempt_id, timeout):
+        """Wait for an attempt queued by this process.
+
+        Returns False when the attempt is not running here (already finished
+        or queued by another worker process), so the caller can fall back to
+        polling the database.
+        """
+        with self._lock:
+            done = self._pending.get(attempt_id)
+        if done is None:
+            return False
+        done.wait(timeout)
+        return True
@@ -0,0 +1,69 @@
+import hashlib
+import os
+import threading
+import time
+
+# Plans are only changed by deploys or manual edits; workers reload the catalog
+# at least this often so an edit made outside the app is eventually picked up
+PLAN_CACHE_TTL = float(os.environ.get('PLAN_CACHE_TTL', 300))
+
+
+def make_etag(body):
+    return hashlib.sha1(body).hexdigest()[:20]
+
+
+class CatalogSnapshot:
+    """Parsed plans plus their pre-serialized JSON bodies and ETags"""
+
+    def __init__(self, version, plans, dumps):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.plans = plans
+        self.by_id = {plan['id']: plan for plan in plans}
+        self.list_body = dumps(plans).encode('utf-8')
+        self.list_etag = make_etag(self.list_body)
+        self.plan_bodies = {}
+        for plan in plans:
+            body = dumps(plan).encode('utf-8')
+            self.plan_bodies[plan['id']] = (body, make_etag(body))
+
+
+class PlanCatalog:
+    """In-process cache of the active plan catalog.
+
+    The snapshot is rebuilt from the loader whenever the catalog version is
+    bumped by invalidate() or the TTL runs out; every other read is served
+    from memory.
+    """
+
+    def __init__(self, loader, dumps, ttl=PLAN_CACHE_TTL):
+        self._loader = loader
+        self._dumps = dumps
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self.version = 0
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+
+    def _is_stale(self, snapshot):
+        return (
+            snapshot is None
+            or snapshot.version != self.version
+            or (self._ttl and time.monotonic() - snapshot.loaded_at > self._ttl)
+        )
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        if self._is_stale(snapshot):
+            with self._lock:
+                snapshot = self._snapshot
+                if self._is_stale(snapshot):
+                    snapshot = CatalogSnapshot(self.version, self._loader(), self._dumps)
+                    self._snapshot = snapshot
+        return snapshot
+
+    def get(self, plan_id):
+        return self.snapshot().by_id.get(plan_id)
@@ -0,0 +1,222 @@
+"""SQL of the hot-path queries.
+
+The endpoints and background jobs run these constants, and query_plans.py
+checks the very same text with EXPLAIN QUERY PLAN (the check-query-plans
+command and tests/test_query_plans.py). A query changed here is checked as
+it runs. Templates with {placeholders} are formatted by their callers.
+"""
+
+# Plans
+ACTIVE_PLANS = 'SELECT * FROM plans WHERE is_active = 1'
+ACTIVE_PLAN = 'SELECT * FROM plans WHERE id = ? AND is_active = 1'
+
+# Users
+USER_BY_EMAIL = 'SELECT * FROM users WHERE email = ?'
+USER_ID_BY_EMAIL = 'SELECT id FROM users WHERE email = ?'
+
+# Subscriptions
+ACTIVE_SUBSCRIPTION_OF_USER = '''
+    SELECT id FROM subscriptions
+    WHERE user_id = ? AND status IN ('active', 'expiring_soon', 'trialing')
+'''
+
+SUBSCRIPTION_WITH_PRICE = '''
+    SELECT s.*, p.price, p.billing_cycle
+    FROM subscriptions s
+    JOIN plans p ON s.plan_id = p.id
+    WHERE s.id = ?
+'''
+
+SUBSCRIPTION_STATUS = '''
+    SELECT s.*, p.name as plan_name, p.price, p.billing_cycle, p.features,
+           u.email, u.name as user_name
+    FROM subscriptions s
+    JOIN plans p ON s.plan_id = p.id
+    JOIN users u ON s.user_id = u.id
+    WHERE s.id = ?
+'''
+
+SUBSCRIPTION_STATUSES = '''
+    SELECT s.*, p.name as plan_name, p.price, p.billing_cycle, p.features,
+           u.email, u.name as user_name
+    FROM subscriptions s
+    JOIN plans p ON s.plan_id = p.id
+    JOIN users u ON s.user_id = u.id
+    WHERE s.id IN (SELECT value FROM json_each(?))
+'''
+
+# Each subscription is joined to its latest payment in the same query instead
+# of running one payment lookup per subscription. The newest archived payment
+# comes from the archive index and wins when it is newer. The two sides are
+# joined separately: each gets an automatic index, which a window over their
+# UNION would not. Takes the user ID three times.
+USER_SUBSCRIPTIONS = '''
+    SELECT s.*, p.name as plan_name, p.price, p.billing_cycle, p.features,
+           u.email, u.name as user_name,
+           CASE WHEN lp.id IS NULL OR (la.newest_date, la.newest_id) > (lp.payment_date, lp.id) THEN la.newest_status ELSE lp.status END as last_payment_status,
+           CASE WHEN lp.id IS NULL OR (la.newest_date, la.newest_id) > (lp.payment_date, lp.id) THEN la.newest_transaction_id ELSE lp.transaction_id END as last_payment_transaction_id,
+           CASE WHEN lp.id IS NULL OR (la.newest_date, la.newest_id) > (lp.payment_date, lp.id) THEN la.newest_date ELSE lp.payment_date END as last_payment_date
+    FROM subscriptions s
+    JOIN plans p ON s.plan_id = p.id
+    JOIN users u ON s.user_id = u.id
+    LEFT JOIN (
+        SELECT subscription_id, id, status, transaction_id, payment_date,
+               ROW_NUMBER() OVER (
+                   PARTITION BY subscription_id
+                   ORDER BY payment_date DESC, id DESC
+               ) as rn
+        FROM payments
+        WHERE subscription_id IN (SELECT id FROM subscriptions WHERE user_id = ?)
+    ) lp ON lp.subscription_id = s.id AND lp.rn = 1
+    LEFT JOIN (
+        SELECT subscription_id, newest_id, newest_status, newest_transaction_id, newest_date,
+               ROW_NUMBER() OVER (
+                   PARTITION BY subscription_id
+                   ORDER BY newest_date DESC, newest_id DESC
+               ) as rn
+        FROM payment_archive
+        WHERE subscription_id IN (SELECT id FROM subscriptions WHERE user_id = ?)
+    ) la ON la.subscription_id = s.id AND la.rn = 1
+    WHERE s.user_id = ?
+    ORDER BY s.created_at DESC
+'''
+
+# Status fields and latest hot payment of one subscription, for event streams
+STATUS_SNAPSHOT = '''
+    SELECT s.id, s.status, s.end_date, s.next_billing_date, s.auto_renew,
+           p.id AS payment_id, p.amount, p.status AS payment_status,
+           p.transaction_id, p.payment_date
+    FROM subscriptions s
+    LEFT JOIN payments p ON p.id = (
+        SELECT id FROM payments
+        WHERE subscription_id = s.id
+        ORDER BY payment_date DESC, id DESC
+        LIMIT 1
+    )
+    WHERE s.id = ?
+'''
+
+# Payment history, newest first, keyed on (payment_date, id)
+PAYMENT_PAGE = '''
+    SELECT id, amount, status, transaction_id, payment_date FROM payments
+    WHERE subscription_id = ?
+    ORDER BY payment_date DESC, id DESC
+    LIMIT ?
+'''
+
+PAYMENT_PAGE_AFTER = '''
+    SELECT id, amount, status, transaction_id, payment_date FROM payments
+    WHERE subscription_id = ? AND (payment_date, id) < (?, ?)
+    ORDER BY payment_date DESC, id DESC
+    LIMIT ?
+'''
+
+# The first page of many subscriptions: at most LIMIT index entries each,
+# grouped by subscription
+PAYMENT_PAGES = '''
+    SELECT p.id, p.amount, p.status, p.transaction_id, p.payment_date, p.subscription_id
+    FROM json_each(?) j
+    JOIN payments p ON p.id IN (
+        SELECT id FROM payments
+        WHERE subscription_id = j.value
+        ORDER BY payment_date DESC, id DESC
+        LIMIT ?
+    )
+    ORDER BY p.subscription_id, p.payment_date DESC, p.id DESC
+'''
+
+# Read cache versions, bumped by triggers on every write to a cached view
+READ_CACHE_VERSION = 'SELECT version FROM read_cache_versions WHERE key = ?'
+
+# Payment attempts
+PAYMENT_ATTEMPT = 'SELECT * FROM payment_attempts WHERE id = ?'
+
+EXPIRE_STALE_ATTEMPTS = '''
+    UPDATE payment_attempts
+    SET status = 'expired', http_status = 503, result = ?, updated_at = CURRENT_TIMESTAMP
+    WHERE status IN ('queued', 'processing') AND updated_at < datetime('now', ?)
+    RETURNING subscription_id
+'''
+
+REOPEN_SUBSCRIPTIONS = '''
+    UPDATE subscriptions SET status = 'pending'
+    WHERE id IN (SELECT value FROM json_each(?)) AND status = 'processing'
+    AND NOT EXISTS (
+        SELECT 1 FROM payment_attempts a
+        WHERE a.subscription_id = subscriptions.id AND a.status IN ('queued', 'processing')
+    )
+    RETURNING id, user_id
+'''
+
+# Payment archive index
+ARCHIVE_MEMBERS = '''
+    SELECT * FROM payment_archive WHERE subscription_id = ?
+    ORDER BY newest_date DESC, newest_id DESC
+'''
+
+ARCHIVE_MEMBERS_BEFORE = '''
+    SELECT * FROM payment_archive
+    WHERE subscription_id = ? AND (oldest_date, oldest_id) < (?, ?)
+    ORDER BY newest_date DESC, newest_id DESC
+'''
+
+ARCHIVE_MEMBERS_OF = '''
+    SELECT * FROM payment_archive
+    WHERE subscription_id IN (SELECT value FROM json_each(?))
+    ORDER BY subscription_id, newest_date DESC, newest_id DESC
+'''
+
+ARCHIVE_LATEST = '''
+    SELECT newest_id, newest_amount, newest_status, newest_transaction_id, newest_date
+    FROM payment_archive WHERE subscription_id = ?
+    ORDER BY newest_date DESC, newest_id DESC
+    LIMIT 1
+'''
+
+ARCHIVE_SUBSCRIPTION_BATCH = 'SELECT id FROM subscriptions WHERE id > ? ORDER BY id LIMIT ?'
+
+# Formatted with the archived columns
+ARCHIVE_OLD_PAYMENTS = '''
+    SELECT {columns} FROM payments
+    WHERE subscription_id IN (SELECT value FROM json_each(?)) AND payment_date < ?
+    ORDER BY subscription_id, payment_date DESC, id DESC
+'''
+
+# Billing runs
+BILLING_NEXT_DUE = '''
+    SELECT id, next_billing_date FROM subscriptions
+    WHERE status IN ('active', 'expiring_soon') AND auto_renew = 1
+      AND (next_billing_date, id) > (?, ?)
+      AND next_billing_date <= ?
+    ORDER BY next_billing_date, id
+    LIMIT ?
+'''
+
+BILLING_RENEW_CHUNK = '''
+    SELECT s.id, s.user_id, s.end_date, s.next_billing_date, p.price, p.billing_cycle
+    FROM subscriptions s
+    JOIN plans p ON s.plan_id = p.id
+    WHERE s.id IN (SELECT value FROM json_each(?))
+      AND s.status IN ('active', 'expiring_soon') AND s.auto_renew = 1
+      AND s.next_billing_date <= ?
+'''
+
+# Lifecycle sweeps, formatted with a transition's condition
+LIFECYCLE_TRANSITION = '''
+    UPDATE subscriptions SET status = :new_status
+    WHERE id IN (
+        SELECT id FROM subscriptions WHERE {condition} LIMIT :limit
+    )
+    RETURNING id, user_id
+'''
+
+# Analytics rollups
+ANALYTICS_DAILY_PAYMENTS = '''
+    SELECT day, status, failure_reason, SUM(payments) AS payments, SUM(amount) AS amount
+    FROM analytics_daily_payments
+    WHERE day >= ?
+    GROUP BY day, status, failure_reason
+'''
+
+# Moving a bucket between shards, formatted per bucketed table
+BUCKET_ROWS = 'SELECT {columns} FROM {table} WHERE {column} BETWEEN ? AND ?'
@@ -0,0 +1,76 @@
+"""EXPLAIN QUERY PLAN checks over the hot-path queries.
+
+Every check runs the statement the application runs: the constants in
+queries.py, or the SQL a module builds from one of its templates. A query
+that falls back to a full scan of a table fails check-query-plans and
+tests/test_query_plans.py.
+"""
+from datetime import datetime
+
+import archive
+import export
+import lifecycle
+import queries
+import shards
+
+# Tables that grow with traffic and must never be scanned in full
+HOT_TABLES = ('users', 'subscriptions', 'payments', 'payment_attempts', 'payment_archive', 'idempotency_keys',
+              'read_cache_versions')
+
+_SWEEP_PARAMS = {'now': '2024-01-01', 'grace': '2024-01-01', 'soon': '2024-01-01', 'new_status': 'expired', 'limit': 500}
+
+# (name, sql, sample params, tables the query may scan in full)
+QUERY_PLAN_CHECKS = [
+    ('get_plans', queries.ACTIVE_PLANS, (), ('plans',)),
+    ('subscribe: plan lookup', queries.ACTIVE_PLAN, (1,), ()),
+    ('subscribe: user lookup', queries.USER_ID_BY_EMAIL, ('a@example.com',), ()),
+    ('subscribe: active subscription check', queries.ACTIVE_SUBSCRIPTION_OF_USER, (1,), ()),
+    ('simulate_payment / renew_subscription', queries.SUBSCRIPTION_WITH_PRICE, (1,), ()),
+    ('get_payment_attempt', queries.PAYMENT_ATTEMPT, ('a',), ()),
+    ('attempt recovery: expire stale attempts', queries.EXPIRE_STALE_ATTEMPTS, ('{}', '-600 seconds'), ()),
+    ('attempt recovery: reopen subscriptions', queries.REOPEN_SUBSCRIPTIONS, ('[1]',), ()),
+    ('get_user_subscriptions', queries.USER_SUBSCRIPTIONS, (1, 1, 1), ()),
+    ('get_subscription_status', queries.SUBSCRIPTION_STATUS, (1,), ()),
+    ('status batch: subscriptions', queries.SUBSCRIPTION_STATUSES, ('[1, 2]',), ()),
+    ('status batch: payment pages', queries.PAYMENT_PAGES, ('[1, 2]', 21), ()),
+    ('payment history: first page', queries.PAYMENT_PAGE, (1, 21), ()),
+    ('payment history: next page', queries.PAYMENT_PAGE_AFTER, (1, '2024-01-01', 1, 21), ()),
+    ('get_user_by_email', queries.USER_BY_EMAIL, ('a@example.com',), ()),
+    ('read cache: key version', queries.READ_CACHE_VERSION, ('user:a@example.com',), ()),
+    ('subscription events: status snapshot', queries.STATUS_SNAPSHOT, (1,), ()),
+    ('archive: members', queries.ARCHIVE_MEMBERS, (1,), ()),
+    ('archive: members before a position', queries.ARCHIVE_MEMBERS_BEFORE, (1, '2024-01-01', 1), ()),
+    ('archive: members of many subscriptions', queries.ARCHIVE_MEMBERS_OF, ('[1, 2]',), ()),
+    ('archive: latest archived payment', queries.ARCHIVE_LATEST, (1,), ()),
+    ('archive: subscription batch', queries.ARCHIVE_SUBSCRIPTION_BATCH, (0, 500), ()),
+    ('archive: old payments of a batch',
+     queries.ARCHIVE_OLD_PAYMENTS.format(columns=', '.join(archive.ARCHIVED_COLUMNS)), ('[1]', '2024-01-01'), ()),
+    ('billing: next due chunk', queries.BILLING_NEXT_DUE, ('', 0, '2100-01-01', 1000), ()),
+    ('billing: renew chunk', queries.BILLING_RENEW_CHUNK, ('[1]', '2100-01-01'), ()),
+    ('analytics: daily payments', queries.ANALYTICS_DAILY_PAYMENTS, ('2024-01-01',), ()),
+    ('export: payments in a date range',
+     *export.export_query('payments', datetime(2024, 1, 1), datetime(2024, 2, 1)), ()),
+    *[(f'lifecycle: {name}', queries.LIFECYCLE_TRANSITION.format(condition=condition), _SWEEP_PARAMS, ())
+      for name, _, condition in lifecycle.TRANSITIONS],
+    *[(f'rebalance: bucket {table}', queries.BUCKET_ROWS.format(columns='*', table=table, column=column),
+       (0, 1 << 40), ()) for table, column in shards.BUCKETED_TABLES]
+]
+
+
+def find_table_scans(conn, checks=QUERY_PLAN_CHECKS):
+    """Return (check name, plan detail) for every query that scans a table"""
+    problems = []
+    for name, sql, params, allowed_scans in checks:
+        plan = conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+        # Materialized subqueries and CTEs show up as SCAN of their own name
+        derived = {row[3].split()[1] for row in plan if row[3].startswith(('MATERIALIZE ', 'CO-ROUTINE '))}
+        for row in plan:
+            detail = row[3]
+            if not detail.startswith('SCAN '):
+                continue
+            target = detail.split()[1]
+            if (target.startswith('(') or target in derived or target in allowed_scans
+                    or 'VIRTUAL TABLE' in detail):
+                continue
+            problems.append((name, detail))
+    return problems
@@ -0,0 +1,93 @@
+"""Read-through cache for user lookups and subscription views.
+
+The lookup flow reads the same records over and over: GET /api/users/<email>,
+then /api/subscriptions/<user_id>, then the status of each subscription.
+Those responses are cached per worker process as finished JSON bodies in a
+size-bounded LRU (READ_CACHE_SIZE entries per view) whose entries expire
+after READ_CACHE_TTL seconds. Only found records are cached, and a status
+view only with the default payments page.
+
+Every cached body carries the version of its key in the
+read_cache_versions table on the key's shard ('subscription_status:<id>',
+'user_subscriptions:<user id>', 'user:<email>'). Triggers (migration 12)
+bump a key's version in the same transaction as any write that changes its
+view, whichever process makes it: another gunicorn worker, a billing run,
+a lifecycle sweep or an import. A hit costs one primary-key read on a
+pooled connection and is served only while the version still matches, so
+no stale body is served after a write anywhere, and a write only
+invalidates the keys it touched.
+
+Write paths in this process also evict their keys right after they commit,
+so the memory is freed at once.
+"""
+import os
+
+import metrics
+import queries
+from db import db_connection
+from ttl_cache import TTLCache
+
+READ_CACHE_SIZE = int(os.environ.get('READ_CACHE_SIZE', 10000))
+READ_CACHE_TTL = float(os.environ.get('READ_CACHE_TTL', 30))
+
+lookups = metrics.registry.counter('read_cache_lookups_total', 'Read cache lookups by result', ('view', 'result'))
+evictions = metrics.registry.counter('read_cache_evictions_total', 'Read cache keys evicted by write paths', ('view',))
+
+
+class ReadCache:
+    """Read-through cache of one view's response bodies"""
+
+    def __init__(self, view, maxsize=READ_CACHE_SIZE, ttl=READ_CACHE_TTL):
+        self.view = view
+        self._entries = TTLCache(maxsize, ttl)
+        # Bumped by every eviction, so a load that raced with a write is not stored
+        self._generation = 0
+
+    def version(self, key, path):
+        """Current version of key on its shard; 0 until a write first touches it"""
+        with db_connection(path) as conn:
+            row = conn.execute(queries.READ_CACHE_VERSION, (f'{self.view}:{key}',)).fetchone()
+        return row[0] if row else 0
+
+    def get_or_load(self, key, path, loader):
+        """The cached body for key, else loader()'s result, cached unless it is None"""
+        # Read before loading: a write racing the load leaves the entry behind its key
+        version = self.version(key, path)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            lookups.inc(self.view, 'hit')
+            return entry[1]
+        lookups.inc(self.view, 'miss' if entry is None else 'stale')
+        generation = self._generation
+        body = loader()
+        if body is not None and generation == self._generation:
+            self._entries.set(key, (version, body))
+        return body
+
+    def evict(self, key):
+        self._generation += 1
+        self._entries.delete(key)
+        evictions.inc(self.view)
+
+    def __contains__(self, key):
+        return self._entries.get(key) is not None
+
+    def size(self):
+        return self._entries.stats()['size']
+
+
+users = ReadCache('user')
+user_subscriptions = ReadCache('user_subscriptions')
+subscription_status = ReadCache('subscription_status')
+
+metrics.registry.gauge('read_cache_entries', 'Cached response bodies in this process',
+                       lambda: users.size() + user_subscriptions.size() + subscription_status.size())
+
+
+def user_changed(email):
+    users.evict(email)
+
+
+def subscription_changed(subscription_id, user_id):
+    subscription_status.evict(subscription_id)
+    user_subscriptions.evict(user_id)
@@ -0,0 +1,169 @@
+"""Response serialization: an optional fast JSON encoder and precompiled row mappers.
+
+The list and status endpoints map SQLite rows straight to JSON text with a
+RowMapper. A mapper's output shape is compiled once per query into a
+function that reads columns by position and splices values between
+pre-encoded keys, so no dict is built per row. Columns that already hold
+JSON, such as plan features, are embedded exactly as stored, with no
+parse/dump round trip.
+
+Everything else goes through jsonify. When orjson is installed,
+FastJSONProvider serializes with it, keeping Flask's sorted keys and
+date formatting. Without orjson the standard library is used, and the
+response bodies are the same JSON either way.
+"""
+import json
+import re
+from json.encoder import encode_basestring_ascii
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_KEY = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _encode_float(value):
+    # Same text as json.dumps, which uses float.__repr__
+    return json.dumps(value) if value != value or value in (float('inf'), float('-inf')) else repr(value)
+
+
+_ENCODERS = {
+    str: encode_basestring_ascii,
+    int: int.__repr__,
+    float: _encode_float,
+    bool: lambda value: 'true' if value else 'false',
+    type(None): lambda value: 'null',
+}
+
+
+def encode(value):
+    """JSON text of a scalar column value (anything else goes through json.dumps)"""
+    encoder = _ENCODERS.get(type(value))
+    return encoder(value) if encoder else json.dumps(value)
+
+
+def raw_object(**members):
+    """JSON object text from members that are already JSON text"""
+    return '{' + ','.join(f'{encode(name)}:{text}' for name, text in members.items()) + '}'
+
+
+class Raw:
+    """A column holding JSON text, embedded as is (NULL becomes null)"""
+
+    def __init__(self, column):
+        self.column = column
+
+
+class Flag:
+    """An integer column rendered as true/false"""
+
+    def __init__(self, column):
+        self.column = column
+
+
+class Nested:
+    """A nested object built from the same row, or null when `when` is NULL"""
+
+    def __init__(self, when, shape):
+        self.when = when
+        self.shape = shape
+
+
+class Extra:
+    """A member passed by the caller as JSON text, e.g. a separately mapped list"""
+
+
+class RowMapper:
+    """Maps rows of a query to JSON object text following a fixed output shape.
+
+    The shape is a dict of output key -> column name, Raw, Flag, Nested or
+    Extra. Mapping functions are generated per result layout (the query's
+    column names) and cached, so rows are read by index.
+    """
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.extras = [key for key, field in self._walk(shape) if isinstance(field, Extra)]
+        self._compiled = {}
+
+    @classmethod
+    def _walk(cls, shape):
+        for key, field in shape.items():
+            yield key, field
+            if isinstance(field, Nested):
+                yield from cls._walk(field.shape)
+
+    def compile(self, description):
+        """The mapping function for a cursor.description"""
+        columns = tuple(column[0] for column in description)
+        function = self._compiled.get(columns)
+        if function is None:
+            function = self._compiled[columns] = self._build(columns)
+        return function
+
+    def _build(self, columns):
+        index = {name: position for position, name in enumerate(columns)}
+        helpers = []
+        body = self._template(self.shape, index, helpers)
+        source = ''.join(
+            f'def nested_{number}(row):\n    return {template}\n' for number, template in enumerate(helpers)
+        ) + f"def map_row(row{''.join(f', {name}' for name in self.extras)}):\n    return {body}\n"
+        namespace = {'encode': encode}
+        exec(compile(source, f'<row mapper {", ".join(columns)}>', 'exec'), namespace)
+        return namespace['map_row']
+
+    def _template(self, shape, index, helpers):
+        """An f-string expression producing the object; nested objects become helper functions"""
+        parts = []
+        for key, field in shape.items():
+            if not _KEY.match(key):
+                raise ValueError(f'unsupported output key {key!r}')
+            if isinstance(field, Extra):
+                value = key
+            elif isinstance(field, Raw):
+                value = f'row[{index[field.column]}] or "null"'
+            elif isinstance(field, Flag):
+                value = f'"true" if row[{index[field.column]}] else "false"'
+            elif isinstance(field, Nested):
+                helpers.append(self._template(field.shape, index, helpers))
+                value = f'nested_{len(helpers) - 1}(row) if row[{index[field.when]}] is not None else "null"'
+            else:
+                value = f'encode(row[{index[field]}])'
+            parts.append(f'"{key}":{{{value}}}')
+        return "f'{{" + ','.join(parts) + "}}'"
+
+    def object(self, row, description, **extras):
+        return self.compile(description)(row, **extras)
+
+    def array(self, rows, description):
+        """JSON array text of the rows"""
+        return '[' + ','.join(map(self.compile(description), rows)) + ']'
+
+
+def json_text_response(app, body, status=200):
+    """Response for an already serialized JSON body, shaped like jsonify's"""
+    return app.response_class(body + '\n', status=status, mimetype=app.json.mimetype)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, using orjson for compact output when it is installed"""
+
+    def _options(self):
+        options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        return options | orjson.OPT_SORT_KEYS if self.sort_keys else options
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs.keys() - {'separators'}:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._options()).decode()
+
+    def response(self, *args, **kwargs):
+        if orjson is None or (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self._options() | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
@@ -0,0 +1,137 @@
+"""Micro-benchmark for response serialization on large subscription lists.
+
+Seeds one user with many subscriptions in a throwaway SQLite file, reads the
+GET /api/subscriptions/<user_id> result once, and times turning those rows
+into a response body three ways:
+
+- dicts + stdlib: a dict per row, features parsed with json.loads, then
+  Flask's default JSON provider (how the endpoint used to work)
+- dicts + provider: the same dicts through FastJSONProvider (orjson when
+  installed)
+- row mapper: the precompiled USER_SUBSCRIPTION mapper, features embedded raw
+
+It checks that all three bodies decode to the same value, and also times
+the whole endpoint through the Flask test client:
+
+    python serialization_bench.py --subscriptions 10000 --repeat 20
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def legacy_dicts(rows):
+    result = []
+    for sub in rows:
+        result.append({
+            'id': sub['id'],
+            'plan_name': sub['plan_name'],
+            'price': sub['price'],
+            'billing_cycle': sub['billing_cycle'],
+            'features': json.loads(sub['features']),
+            'status': sub['status'],
+            'start_date': sub['start_date'] if sub['start_date'] else None,
+            'end_date': sub['end_date'] if sub['end_date'] else None,
+            'next_billing_date': sub['next_billing_date'] if sub['next_billing_date'] else None,
+            'auto_renew': bool(sub['auto_renew']),
+            'last_payment': {
+                'status': sub['last_payment_status'],
+                'transaction_id': sub['last_payment_transaction_id'],
+                'payment_date': sub['last_payment_date']
+            } if sub['last_payment_status'] else None
+        })
+    return result
+
+
+def seed(conn, subscriptions):
+    user_id = conn.execute("INSERT INTO users (email, name) VALUES ('bench@example.com', 'Bench User')").lastrowid
+    conn.executemany('''
+        INSERT INTO subscriptions (user_id, plan_id, status, start_date, end_date, next_billing_date, auto_renew)
+        VALUES (?, ?, ?, datetime('now'), datetime('now', '+30 days'), datetime('now', '+30 days'), ?)
+    ''', [(user_id, 1 + i % 6, 'cancelled' if i % 10 else 'active', i % 2) for i in range(subscriptions)])
+    # Every other subscription has a payment, so last_payment is both set and null
+    conn.execute('''
+        INSERT INTO payments (subscription_id, amount, status, transaction_id)
+        SELECT id, 9.99, 'completed', 'BENCH' || id FROM subscriptions WHERE id % 2 = 0
+    ''')
+    conn.commit()
+    return user_id
+
+
+def best_of(repeat, function):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--subscriptions', type=int, default=10000, help='subscriptions on the benchmark user')
+    parser.add_argument('--repeat', type=int, default=20, help='runs per approach; the fastest is reported')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='serialization-bench-')
+    os.environ['DATABASE_PATH'] = os.path.join(workdir, 'bench.db')
+    # Time the endpoint itself, not the read cache in front of it
+    os.environ['READ_CACHE_SIZE'] = '0'
+    sys.path.insert(0, BACKEND_DIR)
+    from flask.json.provider import DefaultJSONProvider
+
+    import app as api
+    import serialization
+    from db import db_connection
+
+    api.init_db()
+    with db_connection() as conn:
+        user_id = seed(conn, args.subscriptions)
+    url = f'/api/subscriptions/{user_id}'
+    with db_connection() as conn:
+        cursor = api.query_user_subscriptions(conn, user_id)
+        rows, description = cursor.fetchall(), cursor.description
+
+    stdlib = DefaultJSONProvider(api.app)
+    with api.app.app_context():
+        approaches = {
+            'dicts_stdlib': lambda: stdlib.response(legacy_dicts(rows)).get_data(),
+            'dicts_provider': lambda: api.app.json.response(legacy_dicts(rows)).get_data(),
+            'row_mapper': lambda: serialization.json_text_response(
+                api.app, api.USER_SUBSCRIPTION.array(rows, description)).get_data()
+        }
+        results = {}
+        bodies = {}
+        for name, function in approaches.items():
+            seconds, bodies[name] = best_of(args.repeat, function)
+            results[name] = {'ms': round(seconds * 1000, 3), 'bytes': len(bodies[name])}
+    decoded = [json.loads(body) for body in bodies.values()]
+    identical = all(value == decoded[0] for value in decoded[1:])
+
+    client = api.app.test_client()
+    seconds, response = best_of(args.repeat, lambda: client.get(url))
+    endpoint_ms = round(seconds * 1000, 3)
+    baseline = results['dicts_stdlib']['ms']
+    for result in results.values():
+        result['speedup'] = round(baseline / result['ms'], 2) if result['ms'] else None
+
+    report = {
+        'subscriptions': args.subscriptions,
+        'repeat': args.repeat,
+        'orjson': serialization.orjson is not None,
+        'serialization': results,
+        'bodies_identical': identical and json.loads(response.get_data()) == decoded[0],
+        'endpoint_ms': endpoint_ms
+    }
+    print(json.dumps(report, indent=2))
+    if not report['bodies_identical']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,416 @@
+"""Sharded storage: users and everything they own spread over several SQLite files.
+
+With DB_SHARDS=1 (the default) there is a single database and nothing here
+changes how rows are stored. With DB_SHARDS=N every user belongs to one of
+SHARD_BUCKETS buckets, chosen by a CRC32 of their email. The user's
+subscriptions, payments and payment attempts live in the same bucket, so
+every request touches one shard and keeps its single-file transaction.
+
+IDs of users, subscriptions and payments carry their bucket in the high bits:
+
+    bucket << 40 | origin shard << 32 | per-shard sequence
+
+Any ID therefore routes without a lookup. The origin shard keeps IDs unique
+when a bucket later moves, and IDs stay below 2**53, so they are safe as
+JavaScript numbers. The bucket -> shard map lives on shard 0, the control
+shard. Rebalancing moves whole buckets between files and rewrites the map.
+IDs never change.
+
+Shard 0 is DATABASE; shard i is <DATABASE without extension>-<i><extension>.
+The plan catalog is replicated to every shard, so plan joins stay local.
+Deployment-wide tables (billing_runs, idempotency_keys) live on shard 0.
+Archived payments sit in segment files shared by all shards (see archive.py);
+only their index rows belong to a bucket and move with it.
+
+Rows written before sharding was enabled keep their small IDs, which put them
+in bucket 0. Email lookups that miss on a user's hashed shard fall back to
+bucket 0's shard for as long as such users exist.
+"""
+import os
+import threading
+import zlib
+from contextlib import ExitStack, contextmanager
+
+import db
+import queries
+from db import db_connection
+
+DB_SHARDS = int(os.environ.get('DB_SHARDS', 1))
+SHARD_BUCKETS = 1024
+MAX_SHARDS = 256
+BUCKET_SHIFT = 40
+ORIGIN_SHIFT = 32
+SEQUENCE_MASK = (1 << ORIGIN_SHIFT) - 1
+
+# Tables whose rows belong to a bucket, with the column that carries it
+BUCKETED_TABLES = (
+    ('users', 'id'),
+    ('subscriptions', 'id'),
+    ('payments', 'id'),
+    ('payment_attempts', 'subscription_id'),
+    ('payment_archive', 'subscription_id')
+)
+ID_TABLES = ('users', 'subscriptions', 'payments')
+
+
+def shard_path(index):
+    if index == 0:
+        return db.DATABASE
+    root, ext = os.path.splitext(db.DATABASE)
+    return f'{root}-{index}{ext}'
+
+
+def bucket_for_email(email):
+    return zlib.crc32(email.encode('utf-8')) % SHARD_BUCKETS
+
+
+def bucket_for_id(value):
+    """Bucket of a user, subscription or payment ID"""
+    return int(value) >> BUCKET_SHIFT
+
+
+def bucket_range(bucket):
+    """Inclusive (first, last) ID range of a bucket"""
+    return bucket << BUCKET_SHIFT, ((bucket + 1) << BUCKET_SHIFT) - 1
+
+
+def seed_sequences(conn):
+    """Start each ID sequence above the rows a shard already has (no-op once seeded)"""
+    for table in ID_TABLES:
+        conn.execute(f'''
+            INSERT OR IGNORE INTO id_sequences (name, value)
+            SELECT ?, COALESCE(MAX(id), 0) FROM {table} WHERE id <= ?
+        ''', (table, SEQUENCE_MASK))
+
+
+def copy_plans(source, target):
+    """Replicate the plan catalog from the control shard"""
+    plans = source.execute('SELECT id, name, price, billing_cycle, features, is_active FROM plans').fetchall()
+    target.executemany('''
+        INSERT OR REPLACE INTO plans (id, name, price, billing_cycle, features, is_active)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [tuple(plan) for plan in plans])
+
+
+class ShardRouter:
+    def __init__(self, count=DB_SHARDS):
+        if not 1 <= count <= MAX_SHARDS:
+            raise ValueError(f'DB_SHARDS must be between 1 and {MAX_SHARDS}')
+        self.count = count
+        self._buckets = None
+        self._legacy_users = False
+        self._loaded_pid = None
+        self._lock = threading.Lock()
+
+    def initialize(self, conn):
+        """Create the bucket map on the control shard if sharding is enabled for the first time"""
+        existing, highest = conn.execute('SELECT COUNT(*), MAX(shard) FROM shard_map').fetchone()
+        if existing and highest >= self.count:
+            raise RuntimeError(
+                f'The shard map uses {highest + 1} shards but DB_SHARDS is {self.count}; '
+                'set DB_SHARDS or run rebalance-shards')
+        if not existing and self.count > 1:
+            create_map(conn, self.count)
+        self._loaded_pid = None
+
+    def _load(self):
+        # Reloaded once per process: rebalancing runs with the API stopped
+        if self._loaded_pid == os.getpid():
+            return
+        with self._lock:
+            if self._loaded_pid == os.getpid():
+                return
+            with db_connection(db.DATABASE) as conn:
+                rows = conn.execute('SELECT bucket, shard FROM shard_map ORDER BY bucket').fetchall()
+                legacy = conn.execute("SELECT value FROM shard_meta WHERE name = 'legacy_max_user_id'").fetchone()
+            self._buckets = [shard for _, shard in rows] if rows else None
+            self._legacy_users = bool(legacy and legacy[0])
+            self._loaded_pid = os.getpid()
+
+    @property
+    def sharded(self):
+        self._load()
+        return self._buckets is not None
+
+    def paths(self):
+        """Every shard file, control shard first"""
+        self._load()
+        if self._buckets is None:
+            return [db.DATABASE]
+        return [shard_path(index) for index in range(self.count)]
+
+    def shard_for_bucket(self, bucket):
+        self._load()
+        return self._buckets[bucket] if self._buckets else 0
+
+    def path_for_id(self, value):
+        """Shard holding a user, subscription or payment ID. IDs that cannot
+        exist route to the control shard, where the lookup simply misses."""
+        self._load()
+        if self._buckets is None:
+            return db.DATABASE
+        try:
+            bucket = bucket_for_id(value)
+        except (TypeError, ValueError):
+            return db.DATABASE
+        if not 0 <= bucket < SHARD_BUCKETS:
+            return db.DATABASE
+        return shard_path(self._buckets[bucket])
+
+    def legacy_shard(self):
+        """Shard of the users created before sharding, or None if there are none"""
+        self._load()
+        return self._buckets[0] if self._buckets is not None and self._legacy_users else None
+
+    def path_for_email(self, email):
+        """Shard holding the user with this email, or where a new one would go"""
+        self._load()
+        if self._buckets is None:
+            return db.DATABASE
+        home = self._buckets[bucket_for_email(email)]
+        legacy = self.legacy_shard()
+        if legacy is not None and legacy != home:
+            with db_connection(shard_path(home)) as conn:
+                found = conn.execute('SELECT 1 FROM users WHERE email = ?', (email,)).fetchone()
+            if not found:
+                with db_connection(shard_path(legacy)) as conn:
+                    if conn.execute('SELECT 1 FROM users WHERE email = ?', (email,)).fetchone():
+                        return shard_path(legacy)
+        return shard_path(home)
+
+    def new_attempt_id(self, subscription_id, token):
+        """Payment attempt ID: a 32-digit hex token whose first 3 digits carry the bucket"""
+        if not self.sharded:
+            return token
+        return f'{bucket_for_id(subscription_id):03x}{token[3:]}'
+
+    def path_for_attempt(self, attempt_id):
+        self._load()
+        if self._buckets is None:
+            return db.DATABASE
+        try:
+            bucket = int(attempt_id[:3], 16)
+        except ValueError:
+            return db.DATABASE
+        return shard_path(self._buckets[bucket]) if bucket < SHARD_BUCKETS else db.DATABASE
+
+    def new_ids(self, conn, table, buckets):
+        """Allocate one ID per bucket on the shard behind conn (all buckets must live there).
+
+        Unsharded, every ID is None and SQLite assigns it. Call inside the
+        write transaction that inserts the rows.
+        """
+        if not buckets or not self.sharded:
+            return [None] * len(buckets)
+        origin = self._buckets[buckets[0]]
+        last = conn.execute(
+            'UPDATE id_sequences SET value = value + ? WHERE name = ? RETURNING value',
+            (len(buckets), table)
+        ).fetchall()[0][0]
+        first = last - len(buckets) + 1
+        return [
+            bucket << BUCKET_SHIFT | origin << ORIGIN_SHIFT | (first + offset)
+            for offset, bucket in enumerate(buckets)
+        ]
+
+    def new_id(self, conn, table, bucket):
+        return self.new_ids(conn, table, [bucket])[0]
+
+    @contextmanager
+    def connections(self):
+        """One pooled connection per shard, for scatter-gather reads"""
+        with ExitStack() as stack:
+            yield [stack.enter_context(db_connection(path)) for path in self.paths()]
+
+
+def create_map(conn, count, buckets=None):
+    """Write the bucket -> shard map on the control shard (bucket % count by default)"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('DELETE FROM shard_map')
+        conn.executemany('INSERT INTO shard_map (bucket, shard) VALUES (?, ?)', [
+            (bucket, buckets[bucket] if buckets else bucket % count) for bucket in range(SHARD_BUCKETS)
+        ])
+        # Users created before sharding all sit in bucket 0
+        conn.execute('''
+            INSERT OR IGNORE INTO shard_meta (name, value)
+            SELECT 'legacy_max_user_id', COALESCE(MAX(id), 0) FROM users
+        ''')
+        seed_sequences(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+router = ShardRouter()
+
+
+def plan_moves(current, count):
+    """(bucket, from shard, to shard) for each bucket that bucket % count places elsewhere"""
+    return [(bucket, shard, bucket % count) for bucket, shard in enumerate(current) if shard != bucket % count]
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def count_bucket(conn, bucket):
+    first, last = bucket_range(bucket)
+    return {
+        table: conn.execute(f'SELECT COUNT(*) FROM {table} WHERE {column} BETWEEN ? AND ?', (first, last)).fetchone()[0]
+        for table, column in BUCKETED_TABLES
+    }
+
+
+def delete_buckets(conn, buckets):
+    """Delete every row of the given buckets from one shard, in one transaction"""
+    deleted = 0
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for bucket in buckets:
+            first, last = bucket_range(bucket)
+            for table, column in reversed(BUCKETED_TABLES):
+                deleted += conn.execute(f'DELETE FROM {table} WHERE {column} BETWEEN ? AND ?', (first, last)).rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return deleted
+
+
+def copy_bucket(source, target, bucket):
+    """Copy a bucket's rows to the target shard, leaving its rollups as if they had always been there.
+
+    The insert triggers count the copied subscriptions as created today and
+    add the copied payments to the daily payment rollups, but that history
+    stays on the source shard, so both are subtracted again. The current
+    subscription counts move with the rows.
+    """
+    first, last = bucket_range(bucket)
+    copied = {}
+    target.execute('BEGIN IMMEDIATE')
+    try:
+        for table, column in BUCKETED_TABLES:
+            columns = ', '.join(_columns(target, table))
+            rows = source.execute(queries.BUCKET_ROWS.format(columns=columns, table=table, column=column), (first, last))
+            placeholders = ', '.join('?' * len(rows.description))
+            copied[table] = target.executemany(
+                f'INSERT INTO {table} ({columns}) VALUES ({placeholders})', rows).rowcount
+        target.execute('''
+            UPDATE analytics_daily_subscriptions SET subscriptions = subscriptions - moved.created
+            FROM (
+                SELECT plan_id, COUNT(*) AS created FROM subscriptions
+                WHERE id BETWEEN ? AND ? GROUP BY plan_id
+            ) AS moved
+            WHERE day = date('now') AND event = 'created'
+              AND analytics_daily_subscriptions.plan_id = moved.plan_id
+        ''', (first, last))
+        target.execute('''
+            UPDATE analytics_daily_payments
+            SET payments = payments - moved.payment_count, amount = amount - moved.total
+            FROM (
+                SELECT date(p.payment_date) AS day, s.plan_id, p.status,
+                       coalesce(p.failure_reason, '') AS failure_reason,
+                       COUNT(*) AS payment_count, SUM(p.amount) AS total
+                FROM payments p JOIN subscriptions s ON s.id = p.subscription_id
+                WHERE p.id BETWEEN ? AND ?
+                GROUP BY 1, 2, 3, 4
+            ) AS moved
+            WHERE analytics_daily_payments.day = moved.day
+              AND analytics_daily_payments.plan_id = moved.plan_id
+              AND analytics_daily_payments.status = moved.status
+              AND analytics_daily_payments.failure_reason = moved.failure_reason
+        ''', (first, last))
+        target.execute("DELETE FROM analytics_daily_subscriptions WHERE subscriptions = 0 AND event = 'created'")
+        target.execute('DELETE FROM analytics_daily_payments WHERE payments = 0')
+        target.commit()
+    except Exception:
+        target.rollback()
+        raise
+    return copied
+
+
+def fold_rollups(source, target):
+    """Add a shard's daily rollup history to another shard and clear it on the source"""
+    days = source.execute('SELECT day, plan_id, event, subscriptions FROM analytics_daily_subscriptions').fetchall()
+    payments = source.execute(
+        'SELECT day, plan_id, status, failure_reason, payments, amount FROM analytics_daily_payments').fetchall()
+    target.execute('BEGIN IMMEDIATE')
+    try:
+        target.executemany('''
+            INSERT INTO analytics_daily_subscriptions (day, plan_id, event, subscriptions) VALUES (?, ?, ?, ?)
+            ON CONFLICT (day, plan_id, event) DO UPDATE SET subscriptions = subscriptions + excluded.subscriptions
+        ''', [tuple(row) for row in days])
+        target.executemany('''
+            INSERT INTO analytics_daily_payments (day, plan_id, status, failure_reason, payments, amount)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (day, plan_id, status, failure_reason)
+            DO UPDATE SET payments = payments + excluded.payments, amount = amount + excluded.amount
+        ''', [tuple(row) for row in payments])
+        target.commit()
+    except Exception:
+        target.rollback()
+        raise
+    source.execute('DELETE FROM analytics_daily_subscriptions')
+    source.execute('DELETE FROM analytics_daily_payments')
+    source.commit()
+
+
+def rebalance(count, dry_run=False, report=None):
+    """Move buckets so that bucket b lives on shard b % count. Run with the API stopped.
+
+    Every shard file below count must already have the schema. Each bucket is
+    copied to its new shard, then the map is updated, then the old copy is
+    deleted, each step committed on its own. An interrupted run is resumed by
+    running it again: rows a shard holds for buckets the map places elsewhere
+    are purged first. Subscription and payment history stays in the rollups
+    of the shard it happened on; when shrinking, the rollups of the shards
+    dropped are added to the control shard's. Shards left empty keep their
+    files, whose ID sequences must not be reused.
+    """
+    if not 1 <= count <= MAX_SHARDS:
+        raise ValueError(f'shard count must be between 1 and {MAX_SHARDS}')
+    with db_connection(db.DATABASE) as control:
+        if not dry_run and not control.execute('SELECT 1 FROM shard_map LIMIT 1').fetchone():
+            create_map(control, 1)
+        current = [shard for (shard,) in control.execute('SELECT shard FROM shard_map ORDER BY bucket')]
+        current = current or [0] * SHARD_BUCKETS
+        moves = plan_moves(current, count)
+        summary = {
+            'from_shards': max(current) + 1,
+            'to_shards': count,
+            'buckets_moved': len(moves),
+            'rows_moved': {table: 0 for table, _ in BUCKETED_TABLES},
+            'rows_purged': 0,
+            'dry_run': dry_run
+        }
+        if dry_run:
+            for bucket, source, _ in moves:
+                with db_connection(shard_path(source)) as conn:
+                    for table, rows in count_bucket(conn, bucket).items():
+                        summary['rows_moved'][table] += rows
+            return summary
+
+        for shard in range(max(summary['from_shards'], count)):
+            foreign = [bucket for bucket, owner in enumerate(current) if owner != shard]
+            with db_connection(shard_path(shard)) as conn:
+                summary['rows_purged'] += delete_buckets(conn, foreign)
+
+        for done, (bucket, source, target) in enumerate(moves, 1):
+            with db_connection(shard_path(source)) as source_conn, db_connection(shard_path(target)) as target_conn:
+                copied = copy_bucket(source_conn, target_conn, bucket)
+                control.execute('UPDATE shard_map SET shard = ? WHERE bucket = ?', (target, bucket))
+                control.commit()
+                delete_buckets(source_conn, [bucket])
+            for table, rows in copied.items():
+                summary['rows_moved'][table] += rows
+            if report:
+                report(done, len(moves))
+
+        # Shards beyond the new count are no longer read, so their rollup history joins the control shard's
+        for shard in range(count, summary['from_shards']):
+            with db_connection(shard_path(shard)) as conn:
+                fold_rollups(conn, control)
+    router._loaded_pid = None
+    return summary
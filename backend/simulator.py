@@ -0,0 +1,216 @@
+"""Simulated payment gateway.
+
+A PaymentSimulator decides how long a payment takes and whether it
+succeeds, and if not, why. Profiles bundle a success rate, a latency
+distribution and a failure mix. The failure scenarios and their cumulative
+weights are built once per simulator, so a decision is a couple of random
+draws and a bisect. Each simulator has its own random.Random, so a fixed
+seed replays the same sequence of outcomes.
+
+Environment (all optional):
+
+- PAYMENT_SIMULATOR_PROFILE: profile name from PROFILES (default 'default')
+- PAYMENT_SIMULATOR_SEED: integer seed for reproducible runs
+- PAYMENT_SUCCESS_RATE: overrides the profile's success rate (0-1)
+- PAYMENT_LATENCY: overrides the latency distribution, e.g. 'fixed:0',
+  'uniform:1:3', 'normal:2:0.5' or 'lognormal:1.5:0.4' (median, sigma)
+- PAYMENT_FAILURE_MIX: overrides the failure weights, e.g.
+  'insufficient_funds=5,network_error=2'. Reasons left out never occur.
+- PAYMENT_LATENCY_SCALE: multiplies every delay (0 disables them)
+"""
+import bisect
+import math
+import os
+import random
+from collections import namedtuple
+
+PAYMENT_SIMULATOR_PROFILE = os.environ.get('PAYMENT_SIMULATOR_PROFILE', 'default')
+PAYMENT_SIMULATOR_SEED = os.environ.get('PAYMENT_SIMULATOR_SEED')
+PAYMENT_LATENCY_SCALE = float(os.environ.get('PAYMENT_LATENCY_SCALE', 1.0))
+
+FailureScenario = namedtuple('FailureScenario', 'code reason message')
+# failure is None for a successful payment
+Outcome = namedtuple('Outcome', 'success failure')
+
+FAILURE_SCENARIOS = (
+    FailureScenario('card_declined', 'insufficient_funds',
+                    'Your card was declined due to insufficient funds. Please use a different payment method.'),
+    FailureScenario('card_declined', 'generic_decline',
+                    'Your card was declined. Please contact your bank or use a different card.'),
+    FailureScenario('card_declined', 'expired_card',
+                    'Your card has expired. Please use a different payment method.'),
+    FailureScenario('processing_error', 'network_error',
+                    'Payment processing encountered a network error. Please try again.'),
+    FailureScenario('authentication_required', '3d_secure_failed',
+                    'Payment authentication failed. Please try again with a different card.'),
+    FailureScenario('card_declined', 'lost_card',
+                    'Your card was declined. Please contact your bank.'),
+    FailureScenario('card_declined', 'stolen_card',
+                    'Your card was declined for security reasons. Please use a different payment method.'),
+)
+FAILURES_BY_REASON = {scenario.reason: scenario for scenario in FAILURE_SCENARIOS}
+
+# failure_mix maps reason -> relative weight; None weighs every scenario equally
+PROFILES = {
+    'default': {'success_rate': 0.95, 'latency': ('uniform', 1.0, 3.0), 'failure_mix': None},
+    # No gateway delay, for load tests of everything around the gateway
+    'load_test': {'success_rate': 0.95, 'latency': ('fixed', 0.0), 'failure_mix': None},
+    'always_succeed': {'success_rate': 1.0, 'latency': ('fixed', 0.0), 'failure_mix': None},
+    # A struggling gateway: slow, long-tailed and failing mostly on the network
+    'degraded': {
+        'success_rate': 0.7,
+        'latency': ('lognormal', 2.5, 0.6),
+        'failure_mix': {'network_error': 6, 'generic_decline': 2, 'insufficient_funds': 1, '3d_secure_failed': 1}
+    },
+    # Realistic card-issuer decline mix at a production-like success rate
+    'production_like': {
+        'success_rate': 0.97,
+        'latency': ('lognormal', 0.8, 0.5),
+        'failure_mix': {'insufficient_funds': 45, 'generic_decline': 30, 'expired_card': 10,
+                        '3d_secure_failed': 8, 'network_error': 5, 'lost_card': 1, 'stolen_card': 1}
+    }
+}
+
+
+def parse_latency(spec):
+    """Parse 'kind:param:...' (e.g. 'uniform:1:3') into a latency tuple"""
+    kind, *params = spec.split(':')
+    return (kind, *(float(param) for param in params))
+
+
+def parse_failure_mix(spec):
+    """Parse 'reason=weight,...' into a failure mix dict"""
+    mix = {}
+    for item in spec.split(','):
+        if item.strip():
+            reason, _, weight = item.partition('=')
+            mix[reason.strip()] = float(weight or 1)
+    return mix
+
+
+def _latency_sampler(rng, latency, scale):
+    """Return a zero-argument function drawing one delay in seconds"""
+    kind, *params = latency
+    if kind == 'fixed' or scale == 0:
+        value = (params[0] if params else 0.0) * scale
+        return lambda: value
+    if kind == 'uniform':
+        low, high = params
+        return lambda: rng.uniform(low, high) * scale
+    if kind == 'normal':
+        mean, stddev = params
+        return lambda: max(0.0, rng.gauss(mean, stddev)) * scale
+    if kind == 'lognormal':
+        median, sigma = params
+        mu = math.log(median)
+        return lambda: rng.lognormvariate(mu, sigma) * scale
+    raise ValueError(f'Unknown latency distribution: {kind}')
+
+
+class PaymentSimulator:
+    def __init__(self, success_rate=0.95, latency=('uniform', 1.0, 3.0), failure_mix=None,
+                 latency_scale=1.0, seed=None):
+        if not 0 <= success_rate <= 1:
+            raise ValueError('success_rate must be between 0 and 1')
+        if failure_mix:
+            unknown = set(failure_mix) - set(FAILURES_BY_REASON)
+            if unknown:
+                raise ValueError(f'Unknown failure reasons: {", ".join(sorted(unknown))}')
+            scenarios = [FAILURES_BY_REASON[reason] for reason, weight in failure_mix.items() if weight > 0]
+            weights = [failure_mix[scenario.reason] for scenario in scenarios]
+        else:
+            scenarios = list(FAILURE_SCENARIOS)
+            weights = [1] * len(scenarios)
+        if not scenarios:
+            raise ValueError('failure_mix needs at least one positive weight')
+
+        self.success_rate = success_rate
+        self.latency = tuple(latency)
+        self.latency_scale = latency_scale
+        self.seed = seed
+        self._rng = random.Random(seed)
+        self._success = Outcome(True, None)
+        self._failures = [Outcome(False, scenario) for scenario in scenarios]
+        self._forced = {scenario.reason: Outcome(False, scenario) for scenario in FAILURE_SCENARIOS}
+        self._cum_weights = []
+        total = 0
+        for weight in weights:
+            total += weight
+            self._cum_weights.append(total)
+        self._total_weight = total
+        self._sample_latency = _latency_sampler(self._rng, self.latency, latency_scale)
+        if seed is None and hasattr(os, 'register_at_fork'):
+            # Workers forked from a preloaded app would otherwise share one sequence
+            os.register_at_fork(after_in_child=self._rng.seed)
+
+    @classmethod
+    def from_profile(cls, name, seed=None, latency_scale=1.0, **overrides):
+        if name not in PROFILES:
+            raise ValueError(f'Unknown payment simulator profile: {name}')
+        settings = {**PROFILES[name], **{key: value for key, value in overrides.items() if value is not None}}
+        return cls(latency_scale=latency_scale, seed=seed, **settings)
+
+    @classmethod
+    def from_environment(cls):
+        env = os.environ
+        return cls.from_profile(
+            PAYMENT_SIMULATOR_PROFILE,
+            seed=int(PAYMENT_SIMULATOR_SEED) if PAYMENT_SIMULATOR_SEED else None,
+            latency_scale=PAYMENT_LATENCY_SCALE,
+            success_rate=float(env['PAYMENT_SUCCESS_RATE']) if env.get('PAYMENT_SUCCESS_RATE') else None,
+            latency=parse_latency(env['PAYMENT_LATENCY']) if env.get('PAYMENT_LATENCY') else None,
+            failure_mix=parse_failure_mix(env['PAYMENT_FAILURE_MIX']) if env.get('PAYMENT_FAILURE_MIX') else None
+        )
+
+    def delay(self):
+        """Simulated gateway processing time in seconds"""
+        return self._sample_latency()
+
+    def decide(self, force_success=None, force_failure_reason=None):
+        """Outcome of one attempt. A true force_success wins over force_failure_reason;
+        a forced failure uses force_failure_reason when given, and an unknown
+        reason falls back to the first scenario."""
+        if force_success:
+            return self._success
+        if force_failure_reason:
+            return self._forced.get(force_failure_reason) or self._forced[FAILURE_SCENARIOS[0].reason]
+        if force_success is not None:
+            return self._pick_failure()
+        if self._rng.random() < self.success_rate:
+            return self._success
+        return self._pick_failure()
+
+    def _pick_failure(self):
+        draw = self._rng.random() * self._total_weight
+        return self._failures[bisect.bisect_right(self._cum_weights, draw)]
+
+    def decide_batch(self, count):
+        """Outcomes of `count` attempts in one call, e.g. for a billing chunk"""
+        rng = self._rng.random
+        success_rate = self.success_rate
+        success = self._success
+        failures = self._failures
+        cum_weights = self._cum_weights
+        total_weight = self._total_weight
+        return [
+            success if rng() < success_rate
+            else failures[bisect.bisect_right(cum_weights, rng() * total_weight)]
+            for _ in range(count)
+        ]
+
+    def delays(self, count):
+        """`count` gateway delays in one call"""
+        sample = self._sample_latency
+        return [sample() for _ in range(count)]
+
+    def describe(self):
+        return {
+            'success_rate': self.success_rate,
+            'latency': list(self.latency),
+            'latency_scale': self.latency_scale,
+            'seed': self.seed,
+            'failure_mix': {
+                outcome.failure.reason: weight - previous
+                for outcome, weight, previous in zip(self._failures, self._cum_weights, [0] + self._cum_weights)
+            }
+        }
@@ -0,0 +1,57 @@
+"""Shared fixtures: the Flask app on a throwaway SQLite file.
+
+The app reads its settings from the environment at import time, so they are
+set here before anything imports it.
+"""
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = tempfile.mkdtemp(prefix='subscription-tests-')
+
+os.environ['DATABASE_PATH'] = os.path.join(DATA_DIR, 'test.db')
+os.environ['PAYMENT_LATENCY_SCALE'] = '0'
+os.environ['PAYMENT_PROCESSING_MODE'] = 'sync'
+os.environ['ADMIN_TOKEN'] = 'test-admin-token'
+sys.path.insert(0, BACKEND_DIR)
+
+import app as api  # noqa: E402
+from db import db_connection  # noqa: E402
+
+ADMIN_HEADERS = {'X-Admin-Token': os.environ['ADMIN_TOKEN']}
+
+_emails = itertools.count(1)
+
+
+@pytest.fixture(scope='session')
+def client():
+    api.bootstrapper.ensure()
+    return api.app.test_client()
+
+
+@pytest.fixture
+def subscribe(client):
+    """Create a pending subscription for a new user; returns (subscription_id, user_id, email)"""
+    def create(plan_id=1):
+        email = f'user{next(_emails)}@example.com'
+        response = client.post('/api/subscribe', json={'email': email, 'name': 'Test User', 'plan_id': plan_id})
+        assert response.status_code == 201, response.get_json()
+        subscription_id = response.get_json()['subscription_id']
+        with db_connection() as conn:
+            user_id = conn.execute('SELECT user_id FROM subscriptions WHERE id = ?', (subscription_id,)).fetchone()[0]
+        return subscription_id, user_id, email
+    return create
+
+
+@pytest.fixture
+def archive_dir(monkeypatch, tmp_path):
+    """A throwaway ARCHIVE_DIR; the index rows pointing into it go away with it"""
+    monkeypatch.setenv('ARCHIVE_DIR', str(tmp_path))
+    yield tmp_path
+    with db_connection() as conn:
+        conn.execute('DELETE FROM payment_archive')
+        conn.commit()
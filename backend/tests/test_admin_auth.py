@@ -0,0 +1,30 @@
+import pytest
+
+import app as api
+from conftest import ADMIN_HEADERS
+
+ADMIN_REQUESTS = [
+    ('post', '/api/admin/billing/run', {'json': {}}),
+    ('post', '/api/admin/lifecycle/sweep', {'json': {}}),
+    ('post', '/api/admin/import', {'data': 'email,name,plan_id\n', 'content_type': 'text/csv'}),
+    ('get', '/api/admin/export/users', {}),
+    ('get', '/api/analytics/summary', {}),
+]
+
+
+@pytest.mark.parametrize('method, url, kwargs', ADMIN_REQUESTS)
+def test_admin_endpoints_are_closed_without_a_configured_token(client, monkeypatch, method, url, kwargs):
+    monkeypatch.setattr(api, 'ADMIN_TOKEN', None)
+    response = getattr(client, method)(url, headers=ADMIN_HEADERS, **kwargs)
+    assert response.status_code == 403
+
+
+@pytest.mark.parametrize('method, url, kwargs', ADMIN_REQUESTS)
+def test_admin_endpoints_reject_missing_or_wrong_tokens(client, method, url, kwargs):
+    assert getattr(client, method)(url, **kwargs).status_code == 403
+    assert getattr(client, method)(url, headers={'X-Admin-Token': 'wrong'}, **kwargs).status_code == 403
+
+
+def test_admin_endpoints_accept_the_token(client):
+    response = client.get('/api/analytics/summary', headers=ADMIN_HEADERS)
+    assert response.status_code == 200
@@ -0,0 +1,39 @@
+from datetime import datetime, timezone
+
+import analytics
+import archive
+from db import db_connection
+
+
+def _day_totals(day):
+    with db_connection() as conn:
+        return tuple(conn.execute('''
+            SELECT COALESCE(SUM(payments), 0), COALESCE(SUM(amount), 0) FROM analytics_daily_payments WHERE day = ?
+        ''', (day,)).fetchone())
+
+
+def test_rebuild_keeps_archived_payments(client, subscribe, archive_dir):
+    subscription_id, _, _ = subscribe()
+    with db_connection() as conn:
+        conn.executemany('''
+            INSERT INTO payments (subscription_id, amount, status, payment_date, transaction_id, failure_reason)
+            VALUES (?, 9.99, ?, ?, ?, ?)
+        ''', [(subscription_id, 'completed', datetime(2000, 6, 15, 12), f'ROLLUP-{subscription_id}-1', None),
+              (subscription_id, 'failed', datetime(2000, 6, 15, 13), f'ROLLUP-{subscription_id}-2', 'expired_card')])
+        conn.commit()
+    archived_day = _day_totals('2000-06-15')
+    assert archived_day[0] >= 2
+
+    # Only payments from before 2001 are old enough to move
+    assert archive.run_archive(horizon_days=(datetime.now() - datetime(2001, 1, 1)).days)['archived'] >= 2
+    response = client.post('/api/payment/simulate', json={'subscription_id': subscription_id, 'force_success': True})
+    assert response.status_code == 200
+    today = datetime.now(timezone.utc).date().isoformat()
+    hot_day = _day_totals(today)
+
+    with db_connection() as conn:
+        report = analytics.rebuild(conn)
+
+    assert report['payments_rebuilt_from'] == '2000-07-01'
+    assert _day_totals('2000-06-15') == archived_day
+    assert _day_totals(today) == hot_day
@@ -0,0 +1,71 @@
+import http.client
+import os
+import threading
+import time
+
+import pytest
+
+import app as api
+import bench
+
+
+@pytest.fixture
+def stream_limit(monkeypatch):
+    monkeypatch.setattr(api, 'sse_stream_slots', threading.BoundedSemaphore(2))
+
+
+def test_streams_beyond_the_limit_are_refused(client, subscribe, stream_limit):
+    subscription_id, _, _ = subscribe()
+    url = f'/api/subscriptions/{subscription_id}/events'
+    streams = [client.get(url, buffered=False) for _ in range(2)]
+    assert [stream.status_code for stream in streams] == [200, 200]
+
+    refused = client.get(url)
+    assert refused.status_code == 503
+    assert refused.headers['Retry-After']
+    assert refused.get_json()['status_url'] == f'/api/subscriptions/status/{subscription_id}'
+    assert client.get('/api/health').status_code == 200
+
+    # A closed stream frees its slot
+    streams[0].close()
+    reopened = client.get(url, buffered=False)
+    assert reopened.status_code == 200
+    for stream in (streams[1], reopened):
+        stream.close()
+
+
+def test_unknown_subscription_does_not_hold_a_slot(client, stream_limit):
+    for _ in range(3):
+        assert client.get('/api/subscriptions/999999999/events').status_code == 404
+
+
+def test_health_responds_while_every_stream_slot_is_taken(tmp_path):
+    """Open streams never take all of a gthread worker's threads"""
+    env = dict(os.environ, DATABASE_PATH=str(tmp_path / 'streams.db'), SSE_MAX_STREAMS='2',
+               SSE_HEARTBEAT_SECONDS='1', SSE_MAX_STREAM_SECONDS='5', PAYMENT_LATENCY_SCALE='0')
+    server = bench.start_gunicorn(env, workers=1, threads=4, worker_class='gthread')
+    streams = []
+    try:
+        status, data = server.request('POST', '/api/subscribe',
+                                      {'email': 'streams@example.com', 'name': 'Streams', 'plan_id': 1})
+        assert status == 201
+        statuses = []
+        # More streams than the worker has threads
+        for _ in range(6):
+            conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+            conn.request('GET', f"/api/subscriptions/{data['subscription_id']}/events")
+            response = conn.getresponse()
+            statuses.append(response.status)
+            streams.append(conn)
+        assert sorted(statuses) == [200, 200, 503, 503, 503, 503]
+
+        started = time.monotonic()
+        health = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+        health.request('GET', '/api/health')
+        assert health.getresponse().status == 200
+        assert time.monotonic() - started < 2
+        health.close()
+    finally:
+        for conn in streams:
+            conn.close()
+        server.close()
@@ -0,0 +1,99 @@
+import json
+from datetime import datetime, timedelta
+
+import app as api
+import archive
+from conftest import ADMIN_HEADERS
+from db import db_connection
+
+
+def _export(client, table, **params):
+    return client.get(f'/api/admin/export/{table}', query_string=params, headers=ADMIN_HEADERS)
+
+
+def test_payments_export_includes_failure_reason(client, subscribe, archive_dir):
+    subscription_id, _, _ = subscribe()
+    response = client.post('/api/payment/simulate', json={
+        'subscription_id': subscription_id, 'force_success': False, 'force_failure_reason': 'expired_card'})
+    assert response.status_code == 400
+
+    exported = _export(client, 'payments', start=(datetime.now() - timedelta(days=1)).isoformat())
+    assert exported.status_code == 200
+    rows = [json.loads(line) for line in exported.get_data(as_text=True).splitlines()]
+    failed = [row for row in rows if row['subscription_id'] == subscription_id]
+    assert len(failed) == 1
+    assert failed[0]['status'] == 'failed'
+    assert failed[0]['failure_reason'] == 'expired_card'
+
+
+def test_payments_export_refuses_archived_months(client, subscribe, archive_dir):
+    subscription_id, _, _ = subscribe()
+    paid_at = datetime(2001, 3, 15)
+    with db_connection() as conn:
+        conn.execute('''
+            INSERT INTO payments (subscription_id, amount, status, payment_date, transaction_id)
+            VALUES (?, 9.99, 'completed', ?, ?)
+        ''', (subscription_id, paid_at, f'OLD-{subscription_id}'))
+        conn.commit()
+    # Only payments from before 2002 are old enough to move
+    archive.run_archive(horizon_days=(datetime.now() - datetime(2002, 1, 1)).days)
+    assert archive.archived_before() == datetime(2001, 4, 1)
+
+    for params in ({}, {'start': '2001-01-01'}, {'start': '2001-03-31T23:59:59'}):
+        response = _export(client, 'payments', **params)
+        assert response.status_code == 400
+        assert response.get_json()['archived_before'] == '2001-04-01'
+
+    assert _export(client, 'payments', start='2001-04-01').status_code == 200
+    assert _export(client, 'users').status_code == 200
+
+
+def test_payments_export_can_include_the_archive(client, subscribe, archive_dir):
+    subscription_id, _, _ = subscribe()
+    with db_connection() as conn:
+        conn.executemany('''
+            INSERT INTO payments (subscription_id, amount, status, payment_date, transaction_id, failure_reason)
+            VALUES (?, 9.99, ?, ?, ?, ?)
+        ''', [(subscription_id, 'completed', datetime(2001, 5, 10), f'ARCHIVED-{subscription_id}', None),
+              (subscription_id, 'failed', datetime(2001, 6, 10), f'ARCHIVED-FAILED-{subscription_id}', 'expired_card')])
+        conn.commit()
+    archive.run_archive(horizon_days=(datetime.now() - datetime(2002, 1, 1)).days)
+    response = client.post('/api/payment/simulate', json={'subscription_id': subscription_id, 'force_success': True})
+    assert response.status_code == 200
+
+    exported = _export(client, 'payments', include_archive=1)
+    assert exported.status_code == 200
+    rows = [json.loads(line) for line in exported.get_data(as_text=True).splitlines()]
+    mine = {row['transaction_id']: row for row in rows if row['subscription_id'] == subscription_id}
+    assert len(mine) == 3
+    assert len([row for row in rows if row['subscription_id'] == subscription_id]) == 3
+    assert mine[f'ARCHIVED-FAILED-{subscription_id}']['failure_reason'] == 'expired_card'
+    with db_connection() as conn:
+        hot = conn.execute('SELECT COUNT(*) FROM payments').fetchone()[0]
+        archived = conn.execute('SELECT COALESCE(SUM(payments), 0) FROM payment_archive').fetchone()[0]
+    assert len(rows) == hot + archived
+
+    # The range filter applies to archived rows too
+    june = _export(client, 'payments', include_archive=1, start='2001-06-01', end='2001-07-01')
+    assert [json.loads(line)['transaction_id'] for line in june.get_data(as_text=True).splitlines()] == [
+        f'ARCHIVED-FAILED-{subscription_id}']
+
+    assert _export(client, 'payments', include_archive=1, after_id=1).status_code == 400
+    assert _export(client, 'users', include_archive=1).status_code == 400
+
+
+def test_export_command_includes_the_archive(client, subscribe, archive_dir):
+    subscription_id, _, _ = subscribe()
+    with db_connection() as conn:
+        conn.execute('''
+            INSERT INTO payments (subscription_id, amount, status, payment_date, transaction_id)
+            VALUES (?, 9.99, 'completed', ?, ?)
+        ''', (subscription_id, datetime(2001, 8, 10), f'CLI-ARCHIVED-{subscription_id}'))
+        conn.commit()
+    archive.run_archive(horizon_days=(datetime.now() - datetime(2002, 1, 1)).days)
+    runner = api.app.test_cli_runner()
+
+    assert runner.invoke(args=['export', 'payments']).exit_code != 0
+    result = runner.invoke(args=['export', 'payments', '--include-archive'])
+    assert result.exit_code == 0, result.output
+    assert f'CLI-ARCHIVED-{subscription_id}' in result.output
@@ -0,0 +1,67 @@
+import hashlib
+import itertools
+import json
+from datetime import datetime, timedelta
+
+import idempotency
+from db import db_connection
+
+_keys = itertools.count(1)
+
+
+def _subscribe_request(email):
+    return '/api/subscribe', json.dumps({'email': email, 'name': 'Retry User', 'plan_id': 1})
+
+
+def _left_behind(url, body, key, locked_until):
+    """The in-progress row of a request whose worker died before it finished"""
+    fingerprint = hashlib.sha256(b'POST' + url.encode() + body.encode()).hexdigest()
+    with db_connection() as conn:
+        conn.execute('''
+            INSERT INTO idempotency_keys (endpoint, idempotency_key, request_hash, status, created_at, locked_until)
+            VALUES ('subscribe', ?, ?, 'in_progress', ?, ?)
+        ''', (key, fingerprint, datetime.now(), locked_until))
+        conn.commit()
+
+
+def _post(client, url, body, key):
+    return client.post(url, data=body, content_type='application/json', headers={'Idempotency-Key': key})
+
+
+def test_retry_takes_over_an_expired_lease(client):
+    key = f'crashed-{next(_keys)}'
+    url, body = _subscribe_request(f'{key}@example.com')
+    _left_behind(url, body, key, datetime.now() - timedelta(seconds=1))
+
+    response = _post(client, url, body, key)
+    assert response.status_code == 201
+    replay = _post(client, url, body, key)
+    assert replay.headers['Idempotent-Replayed'] == 'true'
+    assert replay.get_json() == response.get_json()
+
+
+def test_live_lease_still_blocks_the_key(client, monkeypatch):
+    monkeypatch.setattr(idempotency, 'IDEMPOTENCY_WAIT_SECONDS', 0.2)
+    key = f'running-{next(_keys)}'
+    url, body = _subscribe_request(f'{key}@example.com')
+    _left_behind(url, body, key, datetime.now() + timedelta(seconds=60))
+
+    assert _post(client, url, body, key).status_code == 409
+
+
+def test_expired_lease_is_not_taken_over_by_a_different_request(client):
+    key = f'other-{next(_keys)}'
+    url, body = _subscribe_request(f'{key}@example.com')
+    _left_behind(url, body, key, datetime.now() - timedelta(seconds=1))
+
+    _, other_body = _subscribe_request(f'{key}-other@example.com')
+    assert _post(client, url, other_body, key).status_code == 422
+
+
+def test_waiting_duplicate_takes_over_when_the_lease_runs_out(client, monkeypatch):
+    monkeypatch.setattr(idempotency, 'IDEMPOTENCY_WAIT_SECONDS', 5)
+    key = f'lost-{next(_keys)}'
+    url, body = _subscribe_request(f'{key}@example.com')
+    _left_behind(url, body, key, datetime.now() + timedelta(seconds=0.3))
+
+    assert _post(client, url, body, key).status_code == 201
@@ -0,0 +1,50 @@
+import json
+
+from conftest import ADMIN_HEADERS
+
+
+def _import(client, lines):
+    body = ''.join(line + '\n' for line in lines)
+    response = client.post('/api/admin/import', data=body, content_type='application/x-ndjson', headers=ADMIN_HEADERS)
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return response.get_json()
+
+
+def test_malformed_rows_are_reported_per_line(client):
+    lines = [
+        json.dumps({'email': 'import-ok@example.com', 'name': 'Imported', 'plan_id': 1}),
+        json.dumps({'email': 42, 'name': 'Number'}),
+        json.dumps({'email': 'import-list@example.com', 'name': ['a', 'b']}),
+        json.dumps({'email': {'nested': True}, 'name': 'Object'}),
+        json.dumps({'email': 'import-bool@example.com', 'name': 'Bool', 'plan_id': True}),
+        json.dumps({'email': 'import-float@example.com', 'name': 'Float', 'plan_id': 1.5}),
+        json.dumps({'email': 'import-status@example.com', 'name': 'Status', 'plan_id': 1, 'status': ['active']}),
+        json.dumps({'email': 'import-date@example.com', 'name': 'Date', 'plan_id': 1, 'start_date': 20240101}),
+        json.dumps(['not', 'an', 'object']),
+        '{not json',
+        json.dumps({'email': 'import-ok-2@example.com', 'name': 'Imported too'}),
+    ]
+    report = _import(client, lines)
+
+    assert report['rows'] == 11
+    assert report['users_created'] == 2
+    assert report['subscriptions_created'] == 1
+    assert report['failed'] == 9
+    errors = {error['line']: error for error in report['errors']}
+    assert sorted(errors) == [2, 3, 4, 5, 6, 7, 8, 9, 10]
+    assert errors[2] == {'line': 2, 'email': None, 'error': 'email and name must be strings'}
+    assert errors[3]['error'] == 'email and name must be strings'
+    assert errors[4]['email'] is None
+    assert errors[5]['error'] == errors[6]['error'] == 'Plan not found'
+    assert errors[7]['error'].startswith('status must be one of')
+    assert errors[8]['error'] == 'Invalid start_date'
+    assert errors[9]['error'] == errors[10]['error'] == 'Invalid JSON object'
+
+
+def test_csv_rows_with_missing_fields_are_reported(client):
+    body = 'email,name,plan_id\nimport-csv@example.com,CSV User,1\n,No Email,1\nimport-short@example.com\n'
+    response = client.post('/api/admin/import', data=body, content_type='text/csv', headers=ADMIN_HEADERS)
+    assert response.status_code == 200
+    report = response.get_json()
+    assert report['users_created'] == 1
+    assert [error['error'] for error in report['errors']] == ['Missing required fields', 'Missing required fields']
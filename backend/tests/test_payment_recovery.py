@@ -0,0 +1,102 @@
+import json
+import time
+
+import app as api
+import lifecycle
+from db import db_connection
+
+
+def _leave_attempt(subscription_id, attempt_id, status, age_seconds):
+    """What a worker that died mid-payment leaves behind"""
+    with db_connection() as conn:
+        conn.execute("UPDATE subscriptions SET status = 'processing' WHERE id = ?", (subscription_id,))
+        conn.execute('''
+            INSERT INTO payment_attempts (id, subscription_id, status, created_at, updated_at)
+            VALUES (?, ?, ?, datetime('now', ?), datetime('now', ?))
+        ''', (attempt_id, subscription_id, status, f'-{age_seconds} seconds', f'-{age_seconds} seconds'))
+        conn.commit()
+
+
+def _status(subscription_id):
+    with db_connection() as conn:
+        return conn.execute('SELECT status FROM subscriptions WHERE id = ?', (subscription_id,)).fetchone()[0]
+
+
+def test_stale_attempts_are_expired_and_subscription_reopened(client, subscribe):
+    queued_id, _, _ = subscribe()
+    processing_id, _, _ = subscribe()
+    _leave_attempt(queued_id, f'lost-queued-{queued_id}', 'queued', 3600)
+    _leave_attempt(processing_id, f'lost-processing-{processing_id}', 'processing', 3600)
+    # The cached view must not keep showing 'processing'
+    assert client.get(f'/api/subscriptions/status/{queued_id}').get_json()['status'] == 'processing'
+
+    assert lifecycle.recover_stale_attempts(stale_seconds=600) >= 2
+
+    for subscription_id, attempt_id in ((queued_id, f'lost-queued-{queued_id}'),
+                                        (processing_id, f'lost-processing-{processing_id}')):
+        assert _status(subscription_id) == 'pending'
+        attempt = client.get(f'/api/payment/attempts/{attempt_id}').get_json()
+        assert attempt['status'] == 'expired'
+        assert attempt['http_status'] == 503
+    assert client.get(f'/api/subscriptions/status/{queued_id}').get_json()['status'] == 'pending'
+
+    response = client.post('/api/payment/simulate', json={'subscription_id': queued_id, 'force_success': True})
+    assert response.status_code == 200
+    assert _status(queued_id) == 'active'
+
+
+def test_recent_attempts_are_left_alone(client, subscribe):
+    subscription_id, _, _ = subscribe()
+    _leave_attempt(subscription_id, f'recent-{subscription_id}', 'queued', 5)
+
+    lifecycle.recover_stale_attempts(stale_seconds=600)
+
+    assert _status(subscription_id) == 'processing'
+    with db_connection() as conn:
+        row = conn.execute('SELECT status FROM payment_attempts WHERE id = ?', (f'recent-{subscription_id}',)).fetchone()
+    assert row[0] == 'queued'
+
+
+def test_recorded_payment_is_not_reopened(client, subscribe):
+    subscription_id, _, _ = subscribe()
+    _leave_attempt(subscription_id, f'recorded-{subscription_id}', 'processing', 3600)
+    # The worker recorded the payment, then died before updating the attempt
+    with db_connection() as conn:
+        conn.execute("UPDATE subscriptions SET status = 'active' WHERE id = ?", (subscription_id,))
+        conn.commit()
+
+    lifecycle.recover_stale_attempts(stale_seconds=600)
+
+    assert _status(subscription_id) == 'active'
+
+
+def test_expired_attempt_is_not_run_by_the_queue(client, subscribe):
+    subscription_id, _, _ = subscribe()
+    attempt_id = f'late-{subscription_id}'
+    _leave_attempt(subscription_id, attempt_id, 'queued', 3600)
+    lifecycle.recover_stale_attempts(stale_seconds=600)
+
+    # A worker that was only slow picks the attempt up after recovery
+    api.run_payment_attempt(attempt_id, subscription_id, 9.99, True, None)
+
+    assert _status(subscription_id) == 'pending'
+    with db_connection() as conn:
+        row = conn.execute('SELECT status, result FROM payment_attempts WHERE id = ?', (attempt_id,)).fetchone()
+    assert row[0] == 'expired'
+    assert 'interrupted' in json.loads(row[1])['error']
+
+
+def test_attempt_wait_rejects_non_finite_values(client, subscribe):
+    subscription_id, _, _ = subscribe()
+    attempt_id = f'waited-{subscription_id}'
+    _leave_attempt(subscription_id, attempt_id, 'queued', 5)
+
+    for wait in ('nan', 'inf', '-inf'):
+        response = client.get(f'/api/payment/attempts/{attempt_id}', query_string={'wait': wait})
+        assert response.status_code == 400
+
+    started = time.monotonic()
+    response = client.get(f'/api/payment/attempts/{attempt_id}', query_string={'wait': -5})
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'queued'
+    assert time.monotonic() - started < 1
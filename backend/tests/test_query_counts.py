@@ -0,0 +1,65 @@
+"""SQL statements per request must not grow with a subscription's payment history"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import metrics
+import read_cache
+from db import db_connection
+
+
+def _add_history(subscription_id, count):
+    start = datetime.now() - timedelta(days=count)
+    with db_connection() as conn:
+        conn.executemany('''
+            INSERT INTO payments (subscription_id, amount, status, payment_date, transaction_id)
+            VALUES (?, 9.99, 'success', ?, ?)
+        ''', [(subscription_id, start + timedelta(days=n), f'HIST-{subscription_id}-{n}') for n in range(count)])
+        conn.execute("UPDATE subscriptions SET status = 'active' WHERE id = ?", (subscription_id,))
+        conn.commit()
+
+
+def _statements(client, method, url, **kwargs):
+    response = getattr(client, method)(url, **kwargs)
+    assert response.status_code == 200, response.get_json()
+    queries, _ = metrics.request_totals()
+    assert queries > 0
+    return queries
+
+
+@pytest.fixture
+def histories(subscribe):
+    """A subscription with 1 payment and one with 500"""
+    short, short_user, _ = subscribe()
+    long, long_user, _ = subscribe()
+    _add_history(short, 1)
+    _add_history(long, 500)
+    return (short, short_user), (long, long_user)
+
+
+def test_status_statements_do_not_grow_with_history(client, histories):
+    (short, _), (long, _) = histories
+    counts = []
+    for subscription_id in (short, long):
+        # Count the statements of a load, not of a cache hit
+        read_cache.subscription_status.evict(subscription_id)
+        counts.append(_statements(client, 'get', f'/api/subscriptions/status/{subscription_id}'))
+    assert counts[0] == counts[1]
+
+
+def test_user_subscriptions_statements_do_not_grow_with_history(client, histories):
+    (_, short_user), (_, long_user) = histories
+    counts = []
+    for user_id in (short_user, long_user):
+        read_cache.user_subscriptions.evict(user_id)
+        counts.append(_statements(client, 'get', f'/api/subscriptions/{user_id}'))
+    assert counts[0] == counts[1]
+
+
+def test_status_batch_statements_do_not_grow_with_batch_size(client, histories, subscribe):
+    (short, _), (long, _) = histories
+    many = [subscribe()[0] for _ in range(20)]
+    small = _statements(client, 'post', '/api/subscriptions/status:batch', json={'subscription_ids': [short, long]})
+    large = _statements(client, 'post', '/api/subscriptions/status:batch',
+                        json={'subscription_ids': [short, long] + many})
+    assert small == large
@@ -0,0 +1,28 @@
+import queries
+from db import db_connection
+from query_plans import HOT_TABLES, QUERY_PLAN_CHECKS, find_table_scans
+
+
+def test_hot_path_queries_use_indexes(client):
+    with db_connection() as conn:
+        assert find_table_scans(conn) == []
+
+
+def test_hot_tables_are_never_allowed_a_scan():
+    for name, _, _, allowed_scans in QUERY_PLAN_CHECKS:
+        assert not set(allowed_scans) & set(HOT_TABLES), name
+
+
+def test_every_shared_query_is_checked():
+    checked = {sql for _, sql, _, _ in QUERY_PLAN_CHECKS}
+    constants = {name: value for name, value in vars(queries).items() if name.isupper() and isinstance(value, str)}
+    # Templates are checked in their formatted form
+    unchecked = [name for name, sql in constants.items() if '{' not in sql and sql not in checked]
+    assert unchecked == []
+
+
+def test_a_full_scan_is_reported(client):
+    checks = [('unindexed', 'SELECT * FROM payments WHERE amount > ?', (1,), ())]
+    with db_connection() as conn:
+        problems = find_table_scans(conn, checks)
+    assert [name for name, _ in problems] == ['unindexed']
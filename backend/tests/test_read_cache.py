@@ -0,0 +1,290 @@
+"""Every write path evicts the cached views it changed, and no stale view is served after it"""
+import json
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+import billing
+import db
+import importer
+import lifecycle
+import read_cache
+import shards
+from db import db_connection
+
+
+def _status(client, subscription_id):
+    response = client.get(f'/api/subscriptions/status/{subscription_id}')
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def _user_subscriptions(client, user_id):
+    response = client.get(f'/api/subscriptions/{user_id}')
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def _cache_views(client, subscription_id, user_id):
+    """Load both views of a subscription so the next write has something to evict"""
+    status = _status(client, subscription_id)
+    subscriptions = _user_subscriptions(client, user_id)
+    assert subscription_id in read_cache.subscription_status
+    assert user_id in read_cache.user_subscriptions
+    return status, subscriptions
+
+
+def _assert_evicted(subscription_id, user_id):
+    assert subscription_id not in read_cache.subscription_status
+    assert user_id not in read_cache.user_subscriptions
+
+
+def _pay(client, subscription_id):
+    response = client.post('/api/payment/simulate', json={'subscription_id': subscription_id, 'force_success': True})
+    assert response.status_code == 200, response.get_json()
+
+
+def _set_dates(subscription_id, when):
+    with db_connection() as conn:
+        conn.execute('UPDATE subscriptions SET end_date = ?, next_billing_date = ? WHERE id = ?',
+                     (when, when, subscription_id))
+        conn.commit()
+
+
+def test_cached_reads_are_hits(client, subscribe):
+    subscription_id, user_id, email = subscribe()
+    _cache_views(client, subscription_id, user_id)
+    assert client.get(f'/api/users/{email}').status_code == 200
+    assert email in read_cache.users
+
+    # Repeat reads are served from the cache until a write evicts them
+    assert _status(client, subscription_id)['status'] == 'pending'
+    assert subscription_id in read_cache.subscription_status
+
+
+def test_subscribe_evicts_the_user_views(client, subscribe):
+    subscription_id, user_id, email = subscribe()
+    _pay(client, subscription_id)
+    client.post(f'/api/subscriptions/{subscription_id}/cancel')
+    _cache_views(client, subscription_id, user_id)
+    client.get(f'/api/users/{email}')
+
+    response = client.post('/api/subscribe', json={'email': email, 'name': 'Test User', 'plan_id': 1})
+    assert response.status_code == 201, response.get_json()
+
+    assert email not in read_cache.users
+    assert user_id not in read_cache.user_subscriptions
+    assert len(_user_subscriptions(client, user_id)) == 2
+
+
+def test_sync_payment_evicts_the_subscription(client, subscribe):
+    subscription_id, user_id, _ = subscribe()
+    _cache_views(client, subscription_id, user_id)
+
+    _pay(client, subscription_id)
+
+    _assert_evicted(subscription_id, user_id)
+    assert _status(client, subscription_id)['status'] == 'active'
+    assert _user_subscriptions(client, user_id)[0]['last_payment']['status'] == 'completed'
+
+
+def test_failed_payment_evicts_the_subscription(client, subscribe):
+    subscription_id, user_id, _ = subscribe()
+    _cache_views(client, subscription_id, user_id)
+
+    response = client.post('/api/payment/simulate', json={'subscription_id': subscription_id, 'force_success': False})
+    assert response.status_code == 400
+
+    _assert_evicted(subscription_id, user_id)
+    assert _status(client, subscription_id)['status'] == 'payment_failed'
+
+
+def test_queued_payment_evicts_on_claim_and_on_completion(client, subscribe):
+    subscription_id, user_id, _ = subscribe()
+    _cache_views(client, subscription_id, user_id)
+
+    response = client.post('/api/payment/simulate',
+                           json={'subscription_id': subscription_id, 'force_success': True, 'async': True})
+    assert response.status_code == 202, response.get_json()
+    status_url = response.get_json()['status_url']
+
+    deadline = time.monotonic() + 5
+    while client.get(status_url).get_json()['status'] in ('queued', 'processing'):
+        # Keep re-caching the in-flight view: completion must still evict it
+        _status(client, subscription_id)
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    assert _status(client, subscription_id)['status'] == 'active'
+    assert _user_subscriptions(client, user_id)[0]['status'] == 'active'
+
+
+def test_renew_evicts_the_subscription(client, subscribe):
+    subscription_id, user_id, _ = subscribe()
+    _pay(client, subscription_id)
+    before, _ = _cache_views(client, subscription_id, user_id)
+
+    response = client.post(f'/api/subscriptions/{subscription_id}/renew')
+    assert response.status_code == 200, response.get_json()
+
+    _assert_evicted(subscription_id, user_id)
+    assert _status(client, subscription_id)['end_date'] > before['end_date']
+
+
+def test_cancel_evicts_the_subscription(client, subscribe):
+    subscription_id, user_id, _ = subscribe()
+    _pay(client, subscription_id)
+    _cache_views(client, subscription_id, user_id)
+
+    assert client.post(f'/api/subscriptions/{subscription_id}/cancel').status_code == 200
+
+    _assert_evicted(subscription_id, user_id)
+    assert _status(client, subscription_id)['status'] == 'cancelled'
+    assert _user_subscriptions(client, user_id)[0]['status'] == 'cancelled'
+
+
+def test_created_user_is_found_after_a_miss(client):
+    email = f'created-{time.monotonic_ns()}@example.com'
+    assert client.get(f'/api/users/{email}').status_code == 404
+
+    response = client.post('/api/users', json={'email': email, 'name': 'Created User'})
+    assert response.status_code == 201, response.get_json()
+
+    assert client.get(f'/api/users/{email}').status_code == 200
+
+
+def test_lifecycle_sweep_evicts_moved_subscriptions(client, subscribe):
+    subscription_id, user_id, _ = subscribe()
+    _pay(client, subscription_id)
+    client.post(f'/api/subscriptions/{subscription_id}/cancel')
+    _set_dates(subscription_id, datetime.now() - timedelta(days=1))
+    _cache_views(client, subscription_id, user_id)
+
+    lifecycle.sweep()
+
+    _assert_evicted(subscription_id, user_id)
+    assert _status(client, subscription_id)['status'] == 'expired'
+
+
+def test_billing_chunk_evicts_renewed_subscriptions(client, subscribe):
+    subscription_id, user_id, _ = subscribe()
+    _pay(client, subscription_id)
+    _set_dates(subscription_id, datetime.now() - timedelta(hours=1))
+    before, _ = _cache_views(client, subscription_id, user_id)
+
+    assert billing.bill_chunk([subscription_id], billing.format_timestamp(datetime.now()))[0] == 1
+
+    _assert_evicted(subscription_id, user_id)
+    after = _status(client, subscription_id)
+    assert after['end_date'] > before['end_date']
+    assert len(after['payments']) == len(before['payments']) + 1
+
+
+def test_import_evicts_the_user_subscription_list(client, subscribe):
+    subscription_id, user_id, email = subscribe()
+    _pay(client, subscription_id)
+    client.post(f'/api/subscriptions/{subscription_id}/cancel')
+    _cache_views(client, subscription_id, user_id)
+    assert len(_user_subscriptions(client, user_id)) == 1
+
+    report = importer.import_rows([(2, {'email': email, 'name': 'Test User', 'plan_id': '1', 'status': 'active'})])
+    assert report['subscriptions_created'] == 1
+
+    assert user_id not in read_cache.user_subscriptions
+    assert len(_user_subscriptions(client, user_id)) == 2
+
+
+def test_attempt_recovery_evicts_reopened_subscriptions(client, subscribe):
+    subscription_id, user_id, _ = subscribe()
+    with db_connection() as conn:
+        conn.execute("UPDATE subscriptions SET status = 'processing' WHERE id = ?", (subscription_id,))
+        conn.execute('''
+            INSERT INTO payment_attempts (id, subscription_id, status, created_at, updated_at)
+            VALUES (?, ?, 'processing', datetime('now', '-1 hour'), datetime('now', '-1 hour'))
+        ''', (f'cache-lost-{subscription_id}', subscription_id))
+        conn.commit()
+    _cache_views(client, subscription_id, user_id)
+
+    lifecycle.recover_stale_attempts(stale_seconds=600)
+
+    _assert_evicted(subscription_id, user_id)
+    assert _status(client, subscription_id)['status'] == 'pending'
+
+
+def test_writes_are_scoped_to_their_keys(client, subscribe):
+    changed, changed_user, _ = subscribe()
+    other, other_user, _ = subscribe()
+    _cache_views(client, changed, changed_user)
+    _cache_views(client, other, other_user)
+
+    _pay(client, changed)
+
+    _assert_evicted(changed, changed_user)
+    assert other in read_cache.subscription_status
+    assert other_user in read_cache.user_subscriptions
+
+
+def _write_elsewhere(sql, params):
+    """Run a write from another process, as another gunicorn worker or a cron job would"""
+    script = 'import sqlite3, sys; conn = sqlite3.connect(sys.argv[1]); conn.execute(sys.argv[2], sys.argv[3:]); conn.commit()'
+    subprocess.run([sys.executable, '-c', script, db.DATABASE, sql, *map(str, params)], check=True)
+
+
+def test_write_by_another_process_is_not_served_stale(client, subscribe):
+    subscription_id, user_id, _ = subscribe()
+    other, other_user, _ = subscribe()
+    _pay(client, subscription_id)
+    _cache_views(client, subscription_id, user_id)
+    other_body, _ = _cache_views(client, other, other_user)
+
+    _write_elsewhere("UPDATE subscriptions SET status = 'cancelled', auto_renew = 0 WHERE id = ?", (subscription_id,))
+
+    assert _status(client, subscription_id)['status'] == 'cancelled'
+    assert _user_subscriptions(client, user_id)[0]['status'] == 'cancelled'
+
+    # Keys the write did not touch are still served from the cache
+    def unexpected_load():
+        raise AssertionError('an unchanged view was reloaded')
+    path = shards.router.path_for_id(other)
+    assert json.loads(read_cache.subscription_status.get_or_load(other, path, unexpected_load)) == other_body
+
+
+def test_payment_by_another_process_is_not_served_stale(client, subscribe):
+    subscription_id, user_id, _ = subscribe()
+    _pay(client, subscription_id)
+    before, _ = _cache_views(client, subscription_id, user_id)
+
+    _write_elsewhere("""
+        INSERT INTO payments (subscription_id, amount, status, transaction_id)
+        VALUES (?, 9.99, 'completed', ?)
+    """, (subscription_id, f'ELSEWHERE-{subscription_id}'))
+
+    assert len(_status(client, subscription_id)['payments']) == len(before['payments']) + 1
+    assert _user_subscriptions(client, user_id)[0]['last_payment']['transaction_id'] == f'ELSEWHERE-{subscription_id}'
+
+
+def test_load_racing_an_eviction_is_not_stored(client):
+    cache = read_cache.ReadCache('race')
+
+    def load():
+        # A write commits and evicts while this load is still reading
+        cache.evict('key')
+        return 'old body'
+
+    assert cache.get_or_load('key', db.DATABASE, load) == 'old body'
+    assert 'key' not in cache
+    assert cache.get_or_load('key', db.DATABASE, lambda: 'new body') == 'new body'
+    assert 'key' in cache
+
+
+def test_load_racing_a_write_elsewhere_is_reloaded(client):
+    cache = read_cache.ReadCache('race_elsewhere')
+
+    def load():
+        # Another process commits while this load is still reading
+        _write_elsewhere("INSERT INTO read_cache_versions (key, version) VALUES ('race_elsewhere:key', 1)", ())
+        return 'old body'
+
+    assert cache.get_or_load('key', db.DATABASE, load) == 'old body'
+    assert cache.get_or_load('key', db.DATABASE, lambda: 'new body') == 'new body'
@@ -0,0 +1,39 @@
+import pytest
+
+from simulator import FAILURE_SCENARIOS, PaymentSimulator
+
+
+@pytest.fixture
+def simulator():
+    return PaymentSimulator(success_rate=0.5, seed=7, latency_scale=0)
+
+
+@pytest.mark.parametrize('force_success', [False, None])
+@pytest.mark.parametrize('reason', [scenario.reason for scenario in FAILURE_SCENARIOS])
+def test_forced_failure_reason_is_used(simulator, force_success, reason):
+    for _ in range(20):
+        outcome = simulator.decide(force_success, reason)
+        assert not outcome.success
+        assert outcome.failure.reason == reason
+
+
+def test_forced_success_wins_over_a_failure_reason(simulator):
+    assert simulator.decide(True, 'expired_card').success
+
+
+def test_unknown_reason_falls_back_to_the_first_scenario(simulator):
+    assert simulator.decide(False, 'no_such_reason').failure == FAILURE_SCENARIOS[0]
+
+
+def test_forced_failure_without_reason_picks_a_scenario(simulator):
+    outcomes = [simulator.decide(False) for _ in range(50)]
+    assert not any(outcome.success for outcome in outcomes)
+    assert len({outcome.failure.reason for outcome in outcomes}) > 1
+
+
+def test_payment_endpoint_records_the_forced_reason(client, subscribe):
+    subscription_id, _, _ = subscribe()
+    response = client.post('/api/payment/simulate', json={
+        'subscription_id': subscription_id, 'force_success': False, 'force_failure_reason': 'expired_card'})
+    assert response.status_code == 400
+    assert response.get_json()['error_reason'] == 'expired_card'
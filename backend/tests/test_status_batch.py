@@ -0,0 +1,23 @@
+import pytest
+
+
+def _batch(client, **body):
+    return client.post('/api/subscriptions/status:batch', json=body)
+
+
+@pytest.mark.parametrize('payments_limit', [5.5, 5.0, True, False, '5', [5], 0, -1])
+def test_invalid_payments_limit_is_rejected(client, subscribe, payments_limit):
+    subscription_id, _, _ = subscribe()
+    response = _batch(client, subscription_ids=[subscription_id], payments_limit=payments_limit)
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'Invalid payments_limit'
+
+
+def test_payments_limit_limits_each_page(client, subscribe):
+    subscription_id, _, _ = subscribe()
+    client.post('/api/payment/simulate', json={'subscription_id': subscription_id, 'force_success': True})
+    for _ in range(2):
+        assert client.post(f'/api/subscriptions/{subscription_id}/renew').status_code == 200
+    response = _batch(client, subscription_ids=[subscription_id], payments_limit=2)
+    assert response.status_code == 200
+    assert len(response.get_json()['subscriptions'][0]['payments']) == 2
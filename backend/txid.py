@@ -0,0 +1,94 @@
+"""Transaction IDs that are unique without asking the database.
+
+An ID is 'TXN' followed by 24 Crockford base32 characters, ULID-style:
+
+- 10 chars: milliseconds since the Unix epoch
+- 8 chars: node, the process ID (22 bits) plus 18 random bits drawn when
+  the process starts, so a recycled PID or another host gets a new node
+- 6 chars: per-process sequence (30 bits)
+
+The alphabet sorts in ASCII order, so IDs sort by creation time, and the
+IDs any one thread draws are strictly increasing. Time comes from the
+monotonic clock, anchored to the wall clock once per process, so it never
+steps back. The sequence is an itertools.count, whose next() is atomic under the GIL, so
+threads never take a lock. The sequence only wraps after 2**30 IDs, and IDs
+from one process could only collide if that many were drawn within a single
+millisecond. The state is rebuilt after
+fork, so gunicorn workers forked from a preloaded app get their own node.
+"""
+import itertools
+import os
+import random
+import time
+from datetime import datetime, timezone
+
+PREFIX = 'TXN'
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+TIME_CHARS = 10
+NODE_CHARS = 8
+SEQUENCE_CHARS = 6
+PID_BITS = 22
+SEQUENCE_MASK = (1 << 5 * SEQUENCE_CHARS) - 1
+LENGTH = len(PREFIX) + TIME_CHARS + NODE_CHARS + SEQUENCE_CHARS
+# Two characters per 10 bits, so encoding is a handful of table lookups
+_PAIRS = [high + low for high in ALPHABET for low in ALPHABET]
+
+
+def _encode(value, chars):
+    digits = []
+    for _ in range(chars):
+        digits.append(ALPHABET[value & 31])
+        value >>= 5
+    return ''.join(reversed(digits))
+
+
+def _decode(text):
+    value = 0
+    for char in text:
+        value = value * 32 + ALPHABET.index(char)
+    return value
+
+
+class TransactionIdGenerator:
+    def __init__(self, prefix=PREFIX):
+        self.prefix = prefix
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self.pid = os.getpid()
+        salt = random.SystemRandom().getrandbits(5 * NODE_CHARS - PID_BITS)
+        node = (self.pid & ((1 << PID_BITS) - 1)) << (5 * NODE_CHARS - PID_BITS) | salt
+        self._head = self.prefix
+        self._node = _encode(node, NODE_CHARS)
+        self._epoch_ms = time.time_ns() // 1_000_000
+        self._monotonic_ns = time.monotonic_ns()
+        self._sequence = itertools.count()
+
+    def new(self):
+        millis = self._epoch_ms + (time.monotonic_ns() - self._monotonic_ns) // 1_000_000
+        sequence = next(self._sequence) & SEQUENCE_MASK
+        pairs = _PAIRS
+        return (f'{self._head}{pairs[millis >> 40 & 1023]}{pairs[millis >> 30 & 1023]}'
+                f'{pairs[millis >> 20 & 1023]}{pairs[millis >> 10 & 1023]}{pairs[millis & 1023]}'
+                f'{self._node}{pairs[sequence >> 20]}{pairs[sequence >> 10 & 1023]}{pairs[sequence & 1023]}')
+
+
+def parse(transaction_id):
+    """Split a generated ID into (created_at UTC, pid, sequence); None for other formats"""
+    if len(transaction_id) != LENGTH or not transaction_id.startswith(PREFIX):
+        return None
+    body = transaction_id[len(PREFIX):]
+    try:
+        millis = _decode(body[:TIME_CHARS])
+        node = _decode(body[TIME_CHARS:TIME_CHARS + NODE_CHARS])
+        sequence = _decode(body[TIME_CHARS + NODE_CHARS:])
+    except ValueError:
+        return None
+    created_at = datetime.fromtimestamp(millis / 1000, timezone.utc)
+    return created_at, node >> (5 * NODE_CHARS - PID_BITS), sequence
+
+
+generator = TransactionIdGenerator()
+new_transaction_id = generator.new
@@ -0,0 +1,134 @@
+"""Stress test for the transaction ID generator (txid.py).
+
+Forks worker processes, each drawing IDs from several threads at once. Every
+thread checks that its own IDs strictly increase and streams them to a file.
+The files are then merged in sorted order, so any ID produced twice, by any
+thread in any process, shows up as two equal neighbours. Only one ID per file
+is held in memory at a time:
+
+    python txid_stress.py --processes 8 --threads 4 --ids 20000000
+
+The parent draws IDs before forking. If the generator did not rebuild its
+state in each child, the children would share the parent's node and
+sequence and duplicate each other. Exits non-zero on any duplicate or
+out-of-order ID.
+"""
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import txid
+
+WRITE_BATCH = 100000
+
+
+def generate(path, count, errors):
+    new_id = txid.new_transaction_id
+    previous = ''
+    with open(path, 'w') as handle:
+        remaining = count
+        while remaining:
+            batch = [new_id() for _ in range(min(WRITE_BATCH, remaining))]
+            remaining -= len(batch)
+            if batch[0] <= previous or any(a >= b for a, b in zip(batch, batch[1:])):
+                errors.append(path)
+            previous = batch[-1]
+            handle.write('\n'.join(batch))
+            handle.write('\n')
+
+
+def run_worker(workdir, index, threads, count):
+    errors = []
+    workers = [
+        threading.Thread(target=generate, args=(
+            os.path.join(workdir, f'p{index}-t{thread}.txt'), count // threads + (thread < count % threads), errors))
+        for thread in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    # Exit code tells the parent whether every thread saw increasing IDs
+    os._exit(1 if errors else 0)
+
+
+def merge_check(paths):
+    """Merge the sorted files; returns (total, duplicates, node count)"""
+    handles = [open(path) for path in paths]
+    total = duplicates = 0
+    nodes = set()
+    previous = None
+    try:
+        for line in heapq.merge(*handles):
+            total += 1
+            if line == previous:
+                duplicates += 1
+            previous = line
+            nodes.add(line[13:21])
+    finally:
+        for handle in handles:
+            handle.close()
+    return total, duplicates, len(nodes)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=4, help='threads per process')
+    parser.add_argument('--ids', type=int, default=20_000_000, help='IDs to generate in total')
+    parser.add_argument('--keep', action='store_true', help='keep the ID files for inspection')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='txid-stress-')
+    # Draw from the parent before forking so the children inherit live state
+    parent_path = os.path.join(workdir, 'parent.txt')
+    generate(parent_path, 1000, [])
+
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+    per_process = args.ids // args.processes
+    started = time.perf_counter()
+    processes = [
+        context.Process(target=run_worker, args=(workdir, index, args.threads,
+                                                 per_process + (index < args.ids % args.processes)))
+        for index in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    generated = time.perf_counter() - started
+
+    out_of_order = sum(1 for process in processes if process.exitcode != 0)
+    paths = [os.path.join(workdir, name) for name in os.listdir(workdir)]
+    started = time.perf_counter()
+    total, duplicates, nodes = merge_check(paths)
+    merged = time.perf_counter() - started
+    if not args.keep:
+        shutil.rmtree(workdir)
+
+    report = {
+        'processes': args.processes,
+        'threads_per_process': args.threads,
+        'ids': total,
+        'nodes': nodes,
+        'duplicates': duplicates,
+        'processes_with_out_of_order_ids': out_of_order,
+        'generate_seconds': round(generated, 3),
+        'ids_per_second': round(total / generated) if generated else None,
+        'merge_check_seconds': round(merged, 3),
+        'files': workdir if args.keep else None
+    }
+    print(json.dumps(report, indent=2))
+    if duplicates or out_of_order or total != args.ids + 1000:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
-from app import app, init_db
+from app import app, bootstrapper
 
 if __name__ == "__main__":
-    init_db()
+    bootstrapper.ensure()
     app.run()
 
 
@@ -9,6 +9,16 @@ if (process.env.NODE_ENV === 'development') {
   console.log('API Base URL:', API_BASE_URL);
 }
 
+// Wait for a queued payment attempt to finish and return its result
+async function waitForPayment(attemptId) {
+  while (true) {
+    const response = await axios.get(`${API_BASE_URL}/payment/attempts/${attemptId}`, { params: { wait: 25 } });
+    if (!['queued', 'processing'].includes(response.data.status)) {
+      return response.data.result || {};
+    }
+  }
+}
+
 // Header Component
 function Header() {
   return (
@@ -236,19 +246,21 @@ function PaymentPage() {
       }
 
       const response = await axios.post(`${API_BASE_URL}/payment/simulate`, requestData);
+      // With PAYMENT_PROCESSING_MODE=async the payment is queued (202) and finishes later
+      const payment = response.status === 202 ? await waitForPayment(response.data.attempt_id) : response.data;
 
-      if (response.data.success) {
+      if (payment.success) {
         setSuccess(true);
-        setTransactionInfo(response.data);
+        setTransactionInfo(payment);
         setTimeout(() => {
           navigate(`/subscription/${subscriptionId}`);
         }, 2500);
       } else {
-        setError(response.data.message);
+        setError(payment.message || payment.error || 'Payment processing failed');
         setErrorDetails({
-          code: response.data.error_code,
-          reason: response.data.error_reason,
-          transaction_id: response.data.transaction_id
+          code: payment.error_code,
+          reason: payment.error_reason,
+          transaction_id: payment.transaction_id
         });
         setProcessing(false);
       }
@@ -376,6 +388,7 @@ function SubscriptionStatusPage() {
   const [error, setError] = useState(null);
   const [renewing, setRenewing] = useState(false);
   const [cancelling, setCancelling] = useState(false);
+  const [loadingPayments, setLoadingPayments] = useState(false);
 
   const fetchSubscription = useCallback(async () => {
     try {
@@ -392,6 +405,58 @@ function SubscriptionStatusPage() {
     fetchSubscription();
   }, [fetchSubscription]);
 
+  // Status changes (payments, renewals, cancellations) are pushed by the server
+  useEffect(() => {
+    const source = new EventSource(`${API_BASE_URL}/subscriptions/${subscriptionId}/events`);
+    const applyUpdate = (event) => {
+      const update = JSON.parse(event.data);
+      setSubscription((current) => {
+        if (!current) return current;
+        const payments = current.payments || [];
+        const lastPayment = update.last_payment;
+        const isNewPayment = lastPayment && !payments.some((payment) => payment.id === lastPayment.id);
+        return {
+          ...current,
+          status: update.status,
+          end_date: update.end_date,
+          next_billing_date: update.next_billing_date,
+          auto_renew: update.auto_renew,
+          payments: isNewPayment ? [lastPayment, ...payments] : payments
+        };
+      });
+    };
+    ['status', 'payment', 'renewed', 'cancelled'].forEach((name) => source.addEventListener(name, applyUpdate));
+    // A server at its stream limit answers 503, which closes the EventSource for good; poll instead
+    let pollTimer = null;
+    source.onerror = () => {
+      if (source.readyState === EventSource.CLOSED && !pollTimer) {
+        pollTimer = setInterval(fetchSubscription, 10000);
+      }
+    };
+    return () => {
+      source.close();
+      clearInterval(pollTimer);
+    };
+  }, [subscriptionId, fetchSubscription]);
+
+  const handleLoadMorePayments = async () => {
+    setLoadingPayments(true);
+    try {
+      const response = await axios.get(`${API_BASE_URL}/subscriptions/${subscriptionId}/payments`, {
+        params: { cursor: subscription.payments_next_cursor }
+      });
+      setSubscription({
+        ...subscription,
+        payments: [...subscription.payments, ...response.data.payments],
+        payments_next_cursor: response.data.next_cursor
+      });
+    } catch (err) {
+      alert('Failed to load more payments');
+    } finally {
+      setLoadingPayments(false);
+    }
+  };
+
   const handleRenew = async () => {
     if (!window.confirm('Are you sure you want to renew this subscription now?')) return;
 
@@ -431,7 +496,9 @@ function SubscriptionStatusPage() {
       active: 'badge-active',
       pending: 'badge-pending',
       cancelled: 'badge-cancelled',
-      payment_failed: 'badge-payment_failed'
+      payment_failed: 'badge-payment_failed',
+      expiring_soon: 'badge-pending',
+      expired: 'badge-cancelled'
     };
     return badges[status] || 'badge';
   };
@@ -550,6 +617,16 @@ function SubscriptionStatusPage() {
               ))}
             </tbody>
           </table>
+          {subscription.payments_next_cursor && (
+            <button
+              onClick={handleLoadMorePayments}
+              className="btn btn-secondary"
+              disabled={loadingPayments}
+              style={{ marginTop: '20px' }}
+            >
+              {loadingPayments ? 'Loading...' : 'Load More'}
+            </button>
+          )}
         </div>
       )}
     </div>
@@ -650,7 +727,9 @@ function getStatusBadge(status) {
     active: 'badge-active',
     pending: 'badge-pending',
     cancelled: 'badge-cancelled',
-    payment_failed: 'badge-payment_failed'
+    payment_failed: 'badge-payment_failed',
+    expiring_soon: 'badge-pending',
+    expired: 'badge-cancelled'
   };
   return badges[status] || 'badge';
 }